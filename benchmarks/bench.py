@@ -0,0 +1,442 @@
+#! /usr/bin/env python3
+
+import os
+import sys
+import csv
+import json
+import time
+import queue
+import shutil
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import proxyvenom
+
+# Interpreter command line for each proxy language
+INTERPRETERS = {
+    "pl": ["perl"],
+    "py": ["python3", "-u"],
+    "rb": ["ruby"],
+    "php": ["php"],
+    "ps1": ["pwsh", "-NoProfile", "-File"],
+    "js": ["node"]
+}
+
+# Target server modes, selected by the first byte of a connection
+ECHO = b"E"
+SINK = b"S"
+SOURCE = b"D"
+
+############################
+### FUNCTION DEFINITIONS ###
+############################
+class TargetServer:
+
+    def __init__(self, host: str="127.0.0.1") -> None:
+        '''Initialize the loopback echo/sink/source server'''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.data_size = 65536
+
+    def start(self) -> None:
+        '''Serve connections from a background thread'''
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self) -> None:
+        '''Accept connections'''
+        while 1:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn: socket.socket) -> None:
+        '''Serve one connection in the mode chosen by its first byte'''
+        try:
+            mode = conn.recv(1)
+            if mode == ECHO:
+                while 1:
+                    data = conn.recv(self.data_size)
+                    if not data:
+                        break
+                    conn.sendall(data)
+            elif mode == SINK:
+                total = 0
+                while 1:
+                    data = conn.recv(self.data_size)
+                    if not data:
+                        break
+                    total += len(data)
+                conn.sendall(struct.pack(">Q", total))
+            elif mode == SOURCE:
+                size = struct.unpack(">Q", recv_exact(conn, 8))[0]
+                chunk = b"\x00" * self.data_size
+                while size > 0:
+                    n = min(size, len(chunk))
+                    conn.sendall(chunk[:n])
+                    size -= n
+        except:
+            pass
+        finally:
+            conn.close()
+
+    def close(self) -> None:
+        '''Stop accepting connections'''
+        self.sock.close()
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    '''TCP recv exactly n bytes'''
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed early")
+        data += chunk
+    return bytes(data)
+
+def free_port() -> int:
+    '''Return a free TCP port on the loopback interface'''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def percentiles(samples: list) -> dict:
+    '''Summarize latency samples in milliseconds'''
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return {
+        "min": round(ordered[0] * 1000, 3),
+        "p50": round(pick(50) * 1000, 3),
+        "p90": round(pick(90) * 1000, 3),
+        "p99": round(pick(99) * 1000, 3),
+        "max": round(ordered[-1] * 1000, 3)
+    }
+
+def wait_for_port(port: int, proc: subprocess.Popen, timeout: float) -> bool:
+    '''Wait until something accepts connections on a loopback port'''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def wait_for_output(proc: subprocess.Popen, text: str, timeout: float) -> bool:
+    '''Wait until a process prints a line containing text'''
+    lines = queue.Queue()
+    def reader() -> None:
+        for line in proc.stdout:
+            lines.put(line)
+    threading.Thread(target=reader, daemon=True).start()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            line = lines.get(timeout=deadline - time.monotonic())
+        except queue.Empty:
+            break
+        if text in line:
+            return True
+    return False
+
+def stop(proc: subprocess.Popen) -> None:
+    '''Terminate a benchmark process'''
+    if proc and proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=3)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+def launch(lang: str, path: str, stdout: int=subprocess.DEVNULL) -> subprocess.Popen:
+    '''Run a generated payload with its interpreter'''
+    return subprocess.Popen(
+        INTERPRETERS[lang] + [path],
+        stdout=stdout,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+
+def write_payload(workdir: str, args: argparse.Namespace, proxy_path: str="", name: str="") -> str:
+    '''Generate a payload into the work directory and return its path'''
+    code = proxyvenom.generate_proxy_payload(args, proxy_path)
+    if args.lang == "php" and not proxy_path:
+        code = "<?php\n\n" + code + "\n\n?>"
+    path = os.path.join(workdir, name or f"{args.type}.{args.lang}")
+    proxyvenom.write_file(path, code)
+    return path
+
+def measure_setup(port: int, rounds: int, timeout: float) -> dict:
+    '''Time from connect() to the first echoed byte'''
+    samples = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        s = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+        s.sendall(ECHO + b"x")
+        recv_exact(s, 1)
+        samples.append(time.perf_counter() - start)
+        s.close()
+    return percentiles(samples)
+
+def measure_latency(port: int, rounds: int, size: int, timeout: float) -> dict:
+    '''Round-trip times of small messages on one connection'''
+    s = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.sendall(ECHO)
+    msg = b"m" * size
+    samples = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        s.sendall(msg)
+        recv_exact(s, size)
+        samples.append(time.perf_counter() - start)
+    s.close()
+    return percentiles(samples)
+
+def upload(port: int, size: int, timeout: float) -> float:
+    '''Send size bytes to the sink and return seconds taken'''
+    chunk = b"\x00" * 65536
+    start = time.perf_counter()
+    s = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+    s.sendall(SINK)
+    left = size
+    while left > 0:
+        n = min(left, len(chunk))
+        s.sendall(chunk[:n])
+        left -= n
+    s.shutdown(socket.SHUT_WR)
+    total = struct.unpack(">Q", recv_exact(s, 8))[0]
+    s.close()
+    if total != size:
+        raise ConnectionError(f"sink received {total} of {size} bytes")
+    return time.perf_counter() - start
+
+def download(port: int, size: int, timeout: float) -> float:
+    '''Read size bytes from the source and return seconds taken'''
+    start = time.perf_counter()
+    s = socket.create_connection(("127.0.0.1", port), timeout=timeout)
+    s.sendall(SOURCE + struct.pack(">Q", size))
+    left = size
+    while left > 0:
+        data = s.recv(min(left, 262144))
+        if not data:
+            raise ConnectionError(f"source sent {size - left} of {size} bytes")
+        left -= len(data)
+    s.close()
+    return time.perf_counter() - start
+
+def measure_scaling(port: int, size: int, levels: list, timeout: float) -> list:
+    '''Aggregate download throughput with parallel connections'''
+    results = []
+    for level in levels:
+        errors = []
+        def worker() -> None:
+            try:
+                download(port, size // level, timeout)
+            except Exception as e:
+                errors.append(str(e))
+        threads = [threading.Thread(target=worker) for i in range(level)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        row = {"connections": level, "seconds": round(elapsed, 4)}
+        if errors:
+            row["error"] = errors[0]
+        else:
+            row["mb_per_s"] = round(size / elapsed / 1e6, 2)
+        results.append(row)
+    return results
+
+def run_suite(port: int, opts: argparse.Namespace) -> dict:
+    '''Run every measurement against a listening proxy port'''
+    size = int(opts.bulk_mb * 1e6)
+    result = {}
+    steps = [
+        ("setup_ms", lambda: measure_setup(port, opts.setup_rounds, opts.timeout)),
+        ("latency_ms", lambda: measure_latency(port, opts.rounds, opts.msg_size, opts.timeout)),
+        ("upload_mb_per_s", lambda: round(size / upload(port, size, opts.timeout) / 1e6, 2)),
+        ("download_mb_per_s", lambda: round(size / download(port, size, opts.timeout) / 1e6, 2)),
+        ("scaling", lambda: measure_scaling(port, size, opts.concurrency, opts.timeout))
+    ]
+    for name, step in steps:
+        try:
+            result[name] = step()
+        except Exception as e:
+            result[name] = None
+            result.setdefault("errors", {})[name] = f"{type(e).__name__}: {e}"
+    return result
+
+def bench_bind(lang: str, target: TargetServer, workdir: str, opts: argparse.Namespace) -> dict:
+    '''Benchmark a bind proxy'''
+    lport = free_port()
+    args = argparse.Namespace(
+        type="bind", lang=lang, lhost="127.0.0.1", lport=str(lport),
+        rhost="127.0.0.1", rport=str(target.port), chost=None, cport=None,
+        workers=str(opts.workers), pool_size=None, pool_idle=None,
+        compress=None, socks=None, forwards=[], streams=None,
+        heartbeat=None, reconnect=None, connect_timeout="10", stats=None,
+        stats_interval="10", rate=None, session_rate=None, control=None
+    )
+    proc = launch(lang, write_payload(workdir, args))
+    try:
+        if not wait_for_port(lport, proc, opts.startup_timeout):
+            return {"error": "proxy did not start listening"}
+        return run_suite(lport, opts)
+    finally:
+        stop(proc)
+
+def bench_reverse(lang: str, target: TargetServer, workdir: str, opts: argparse.Namespace) -> dict:
+    '''Benchmark a reverse proxy through the generated client'''
+    lport = free_port()
+    cport = free_port()
+    args = argparse.Namespace(
+        type="reverse", lang=lang, lhost="127.0.0.1", lport=str(lport),
+        rhost="127.0.0.1", rport=str(target.port),
+        chost="127.0.0.1", cport=str(cport), workers=None,
+        pool_size=str(opts.pool_size), pool_idle="10",
+        compress=str(opts.compress), socks="False", forwards=[],
+        streams=str(opts.streams), heartbeat="10", reconnect="0",
+        connect_timeout="10", stats=None, stats_interval="10", rate="0",
+        session_rate="0", control="0"
+    )
+    client_template = os.path.join(proxyvenom_dir(), "clients", "client.py")
+    client_path = write_payload(workdir, args, client_template, f"client_{lang}.py")
+    client = launch("py", client_path, subprocess.PIPE)
+    proc = None
+    try:
+        if not wait_for_output(client, "Listening for proxy", opts.startup_timeout):
+            return {"error": "client did not start listening"}
+        proc = launch(lang, write_payload(workdir, args))
+        if not wait_for_port(lport, proc, opts.startup_timeout):
+            return {"error": "proxy did not connect to the client"}
+        return run_suite(lport, opts)
+    finally:
+        stop(proc)
+        stop(client)
+
+def proxyvenom_dir() -> str:
+    '''Return the repository root'''
+    return os.path.dirname(os.path.abspath(proxyvenom.__file__))
+
+def flatten(row: dict) -> dict:
+    '''Flatten a result row for CSV output'''
+    flat = {}
+    for key, val in row.items():
+        if isinstance(val, dict):
+            for sub, v in val.items():
+                flat[f"{key}.{sub}"] = v
+        elif isinstance(val, list):
+            for item in val:
+                for sub, v in item.items():
+                    if sub != "connections":
+                        flat[f"{key}.{item['connections']}.{sub}"] = v
+        else:
+            flat[key] = val
+    return flat
+
+def write_results(rows: list, fmt: str, path: str) -> None:
+    '''Write results as JSON or CSV'''
+    out = open(path, "w", newline="") if path else sys.stdout
+    if fmt == "json":
+        json.dump(rows, out, indent=2)
+        out.write("\n")
+    else:
+        flat = [flatten(r) for r in rows]
+        fields = []
+        for r in flat:
+            fields += [k for k in r if k not in fields]
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(flat)
+    if path:
+        out.close()
+
+def parse_args() -> argparse.Namespace:
+    '''Parse benchmark options'''
+    parser = argparse.ArgumentParser(
+        description="Benchmark generated proxies over the loopback interface."
+    )
+    parser.add_argument("--types", nargs="+", default=["bind", "reverse"],
+        choices=["bind", "reverse"], help="Proxy types to benchmark.")
+    parser.add_argument("--langs", nargs="+", default=list(INTERPRETERS),
+        choices=list(INTERPRETERS), help="Proxy languages to benchmark.")
+    parser.add_argument("--bulk-mb", type=float, default=32,
+        help="Megabytes moved per bulk transfer. (Default: 32)")
+    parser.add_argument("--rounds", type=int, default=500,
+        help="Round trips for the latency test. (Default: 500)")
+    parser.add_argument("--msg-size", type=int, default=64,
+        help="Message size for the latency test. (Default: 64)")
+    parser.add_argument("--setup-rounds", type=int, default=50,
+        help="Connections for the setup time test. (Default: 50)")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16],
+        help="Parallel connection counts for scaling. (Default: 1 4 16)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Worker processes for the Python bind proxy. (Default: 1)")
+    parser.add_argument("--pool-size", type=int, default=0,
+        help="Pooled target connections for the Python reverse proxy. (Default: 0)")
+    parser.add_argument("--compress", action="store_true",
+        help="Compress data frames in the Python reverse tunnel.")
+    parser.add_argument("--streams", type=int, default=1,
+        help="Connections the Python reverse tunnel is striped over. (Default: 1)")
+    parser.add_argument("--timeout", type=float, default=30,
+        help="Socket timeout in seconds. (Default: 30)")
+    parser.add_argument("--startup-timeout", type=float, default=10,
+        help="Seconds to wait for a proxy to start. (Default: 10)")
+    parser.add_argument("--format", choices=["json", "csv"], default="json",
+        help="Output format. (Default: json)")
+    parser.add_argument("--output", type=str, default="",
+        help="Output file. (Default: stdout)")
+    return parser.parse_args()
+
+
+#############
+### MAIN ####
+#############
+if __name__ == "__main__":
+    opts = parse_args()
+    target = TargetServer()
+    target.start()
+    rows = []
+    workdir = tempfile.mkdtemp(prefix="proxyvenom-bench-")
+    try:
+        for ptype in opts.types:
+            for lang in opts.langs:
+                row = {"type": ptype, "lang": lang}
+                template = os.path.join(proxyvenom_dir(), "proxies", ptype, f"{ptype}.{lang}")
+                if not os.path.exists(template):
+                    row["skipped"] = "no template"
+                elif not shutil.which(INTERPRETERS[lang][0]):
+                    row["skipped"] = f"{INTERPRETERS[lang][0]} not installed"
+                else:
+                    print(f"Benchmarking {ptype} {lang}...", file=sys.stderr)
+                    start = time.perf_counter()
+                    if ptype == "bind":
+                        row.update(bench_bind(lang, target, workdir, opts))
+                    else:
+                        row.update(bench_reverse(lang, target, workdir, opts))
+                    row["total_seconds"] = round(time.perf_counter() - start, 2)
+                rows.append(row)
+    finally:
+        target.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    write_results(rows, opts.format, opts.output)
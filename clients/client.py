@@ -1,133 +1,1192 @@
 #! /usr/bin/env python3
 
+import os
 import time
+import json
+import zlib
+import signal
 import struct
 import socket
+import selectors
+import collections
 
 class ProxyClient:
 
-    def __init__(self, chost: str, cport: int, lhost: str, lport: str, verbose: bool=True) -> None:
+    # Tunnel frame header: command, channel id, payload length
+    HEADER = struct.Struct(">BII")
+    # Striped tunnel frame header: sequence number, then the frame header
+    SEQ_HEADER = struct.Struct(">IBII")
+    # HELLO payload: feature flags, largest frame accepted
+    HELLO_BODY = struct.Struct(">BI")
+    # Optional HELLO payload tail: more feature flags
+    HELLO_MORE = struct.Struct(">B")
+    # OPEN payload: kind, then a target port followed by its host, or a forward index
+    OPEN_BODY = struct.Struct(">BH")
+    # SOCKS5 request: target port after the address
+    PORT = struct.Struct(">H")
+    # PING payload: sender's clock, echoed back in the PONG
+    STAMP = struct.Struct(">d")
+    # RATE payload: tunnel and session limits in bytes per second, 0 for none
+    RATE_BODY = struct.Struct(">II")
+    DATA, OPEN, CLOSE, EOF, HELLO, HEARTBEAT, PING, PONG, PAUSE, RESUME, RATE = range(11)
+    MULTIPLEX = 0x01 # HELLO flag: many channels at once
+    COMPRESS = 0x02 # HELLO flag: compressed data frames are understood
+    STRIPED = 0x10 # HELLO flag: frames may be striped over several connections
+    KEEPALIVE = 0x20 # HELLO flag: heartbeats are sent while idle
+    PINGS = 0x40 # HELLO flag: PING frames are answered
+    FLOW = 0x80 # HELLO flag: PAUSE and RESUME frames are honoured
+    SHAPING = 0x01 # More HELLO flags: RATE frames are honoured
+    # 0x04 and 0x08 in the first byte once meant OPEN payloads typed by their length
+    TARGETS = 0x02 # More HELLO flags: OPEN frames may name their own target
+    FORWARDS = 0x04 # More HELLO flags: OPEN frames may pick a forward by index
+    OPEN_TARGET, OPEN_FORWARD = 1, 2 # OPEN payload kinds, an empty OPEN dials RHOST:RPORT
+    KEEP = 0xffffffff # RATE value that leaves a limit unchanged
+    COMPRESSED = 0x80 # Command flag: payload is zlib compressed
+    ZMIN = 512 # Smaller payloads are always sent raw
+    HIGH_WATER = 1048576 # Queued bytes that stop reading the side feeding a queue
+    LOW_WATER = 262144 # Queued bytes that start reading it again
+    BULK_WATER = 65536 # Tunnel backlog that stops bulk channels being read
+    BULK = 131072 # Recent bytes that make a channel bulk rather than interactive
+    HEAT_LIFE = 1 # Seconds for a channel's count of recent bytes to halve
+    BURST = 0.05 # Seconds of traffic a token bucket holds
+    QUANTUM = 4096 # Smallest token bucket, so slow limits still read whole chunks
+    DEFAULT_FRAME = 65536 # Frame size assumed when the proxy does not say
+    COMMANDS = 16 # Control commands run per event, so relaying gets its turn
+    HANDSHAKE = 5 # Seconds a new connection has to send its HELLO
+    # SOCKS5 reply codes
+    SOCKS_OK, SOCKS_FAILED, SOCKS_REFUSED, SOCKS_COMMAND = 0x00, 0x01, 0x05, 0x07
+
+    def __init__(self, chost: str, cport: int, lhost: str, lport: str, verbose: bool=True, max_frame: int=262144, compress: bool=False, socks: bool=False, forwards: list=[], streams: int=1, heartbeat: float=10, stats: str=None, stats_interval: float=10, rate: float=0, session_rate: float=0, control: int=0) -> None:
         '''Initialize reverse TCP proxy'''
         self.chost = chost # Client port
         self.cport = cport
         self.lhost = lhost # local port
         self.lport = lport
-        self.data_size = 4096
+        self.max_frame = max_frame # Largest frame we accept
         self.verbose = verbose
+        self.sel = selectors.DefaultSelector()
+        self.streams = streams # Accept a tunnel striped over several connections
+        self.heartbeat = heartbeat # Idle seconds between heartbeats, 0 disables them
+        self._reset()
+        # Reads from local sockets land in a scratch buffer
+        self.scratch = memoryview(bytearray(max_frame))
+        self.next_chan = 0
+        self.channels = {} # channel id -> channel state
+        self.socks = {} # local socket -> channel id
+        self.sendmsg = hasattr(socket.socket, "sendmsg")
+        self.compress = compress # Compress data frames we send
+        self.zraw = 0 # Data bytes before compression
+        self.zwire = 0 # Data bytes as sent
+        self.socks5 = socks # Local listener speaks SOCKS5 and picks targets
+        self.greeting = {} # local socket -> SOCKS5 handshake state
+        self.forwards = forwards # (local port, remote host, remote port) per forward
+        self.stats = stats # JSON-lines file for stats records, None for none
+        self.stats_interval = stats_interval # Seconds between stats records and pings
+        self.totals = {"sessions": 0, "failed": 0, "bytes_up": 0, "bytes_down": 0}
+        self.tunnel = {"frames_in": 0, "frames_out": 0, "bytes_in": 0, "bytes_out": 0}
+        self.started = time.monotonic()
+        self.busy = 0 # Seconds spent handling events since the last record
+        self.busy_since = self.started
+        self.next_tick = self.started
+        # Limits on data read from local sockets, in KiB/s, 0 for none
+        self.bucket = self._bucket(rate * 1024) # shared by every channel
+        self.session_rate = session_rate * 1024 # each channel's own
+        self.control = control # Loopback port taking rate commands, 0 for none
+        self.controls = {} # control connection -> its commands and replies
 
     def start(self) -> None:
-        '''Start proxy'''
+        '''Start client, accepting the proxy again whenever the tunnel drops'''
         s = self._bind(self.chost, self.cport)
         if s:
             s.listen(25)
             if self.verbose:
                 print(f"Listening for proxy on {self.chost}:{self.cport}")
-            proxy_sock, addr = s.accept()
-            proxy_sock.setblocking(0)
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, self._dump)
+            if self.control:
+                self._console()
+            while True:
+                try:
+                    proxy_sock, addr = s.accept()
+                except KeyboardInterrupt:
+                    break
+                if not self._session(s, proxy_sock, addr):
+                    break
+            self._report()
+            self._close(s)
+
+    def _session(self, s: socket.socket, proxy_sock: socket.socket, addr: tuple) -> bool:
+        '''Relay one tunnel until it drops, False if the client should stop'''
+        self._reset()
+        if self.verbose:
+            print(f"Proxy connected to client")
+        # The proxy announces what it supports before anything else. Anything
+        # can connect to CPORT, so the HELLO must come soon and fit a frame
+        hello = b""
+        proxy_sock.settimeout(self.HANDSHAKE)
+        try:
+            header = self._recv_all(proxy_sock, self.HEADER.size)
+            if len(header) == self.HEADER.size:
+                cmd, chan, data_len = self.HEADER.unpack(header)
+                if cmd == self.HELLO and data_len <= self.max_frame:
+                    hello = self._recv_all(proxy_sock, data_len)
+        except KeyboardInterrupt:
+            self._close(proxy_sock)
+            return False
+        if not hello:
             if self.verbose:
-                ip, port = addr
-                print(f"Proxy connected to client")
-            self._listen(proxy_sock)
+                print(f"No HELLO from {addr[0]}, connection dropped")
+            self._close(proxy_sock)
+            return True
+        self.multiplex = bool(hello[0] & self.MULTIPLEX)
+        self.zpeer = self.compress and bool(hello[0] & self.COMPRESS)
+        self.beats = bool(hello[0] & self.KEEPALIVE)
+        self.pings = bool(hello[0] & self.PINGS)
+        self.flow = bool(hello[0] & self.FLOW)
+        more = hello[self.HELLO_BODY.size:]
+        self.shaping = bool(more) and bool(more[0] & self.SHAPING)
+        self.targets = bool(more) and bool(more[0] & self.TARGETS)
+        self.forward_ok = bool(more) and bool(more[0] & self.FORWARDS)
+        stripes = self.streams > 1 and bool(hello[0] & self.STRIPED)
+        if len(hello) >= self.HELLO_BODY.size:
+            flags, peer_frame = self.HELLO_BODY.unpack_from(hello)
+            self.data_size = min(self.max_frame, peer_frame)
+        self.proxy_sock = proxy_sock
+        self.proxy_ip = addr[0]
+        self._link(proxy_sock)
+        flags = self.MULTIPLEX | self.COMPRESS | self.PINGS | self.FLOW
+        if stripes:
+            flags |= self.STRIPED
+        if self.heartbeat:
+            flags |= self.KEEPALIVE
+        hello = self.HELLO_BODY.pack(flags, self.max_frame)
+        self._send_all(self.HELLO, 0, hello)
+        if stripes:
+            # Every frame after our HELLO carries a sequence number
+            self.striped = True
+            s.setblocking(0)
+            self.sel.register(s, selectors.EVENT_READ, self._join)
+        stopped = not self._listen()
+        timeout = self._wake()
+        while self.proxy_sock and not stopped:
+            try:
+                events = self.sel.select(timeout)
+                start = time.monotonic()
+                for key, mask in events:
+                    key.data(key.fileobj, mask)
+                self.busy += time.monotonic() - start
+                timeout = self._wake()
+            except KeyboardInterrupt:
+                stopped = True
+        for chan in list(self.channels):
+            self._drop(chan)
+        for sock in list(self.greeting):
+            self._ungreet(sock)
+        for sock in self.links:
+            if self.sel.get_map().get(sock):
+                self.sel.unregister(sock)
+            self._close(sock)
+        for listener in [self.local_listener, *self.listeners]:
+            if listener:
+                if self.sel.get_map().get(listener):
+                    self.sel.unregister(listener)
+                self._close(listener)
+        if stripes:
+            # Back to waiting for the proxy's first connection
+            self.sel.unregister(s)
+            s.setblocking(1)
+        return not stopped
+
+    def _reset(self) -> None:
+        '''Forget the state of a previous tunnel'''
+        self.data_size = min(self.max_frame, self.DEFAULT_FRAME) # Largest frame we send
+        self.proxy_sock = None
+        self.local_listener = None
+        self.multiplex = False # Proxy can relay many channels at once
+        self.links = {} # tunnel socket -> link state
+        self.order = [] # links in the order frames are striped over them
+        self.next_link = 0
+        self.striped = False # Frames carry sequence numbers
+        self.tx_seq = 0 # Sequence number of the next frame we send
+        self.rx_seq = 0 # Sequence number of the next frame to handle
+        self.reorder = {} # sequence number -> frame that arrived early
+        self.proxy_ip = None
+        self.zpeer = False # Compress and the proxy can decompress
+        self.targets = False # Proxy dials targets named in OPEN frames
+        self.forward_ok = False # Proxy knows the forward table
+        self.listeners = {} # forward listener -> forward index
+        self.beats = False # Proxy sends heartbeats
+        self.last_rx = self.last_tx = time.monotonic()
+        self.pings = False # Proxy answers PING frames
+        self.rtt = None # Last tunnel round trip in milliseconds
+        self.rtt_min = None
+        self.flow = False # Proxy honours PAUSE and RESUME frames
+        self.backlog = 0 # Bytes queued for the proxy on every link
+        self.choked = False # Channel sockets are not read while the backlog drains
+        self.stalled = set() # channels whose queue stops the tunnel being read
+        self.yielding = False # Bulk channels are not read while the backlog drains
+        self.throttled = {} # channel id -> time its token buckets refill
+        self.shaping = False # Proxy honours RATE frames
+
+    def _wake(self) -> float:
+        '''Run timed work and return the select timeout'''
+        waits = [t for t in (self._beat(), self._tick(), self._shape()) if t is not None]
+        return min(waits) if waits else None
+
+    def _beat(self) -> float:
+        '''Send a heartbeat when idle and drop a silent tunnel, return the next deadline'''
+        if not self.heartbeat or not self.beats or not self.proxy_sock:
+            return None
+        now = time.monotonic()
+        if now - self.last_rx >= 3 * self.heartbeat:
+            if self.verbose:
+                print("Proxy stopped responding.")
+            self._lost()
+            return None
+        if now - self.last_tx >= self.heartbeat:
+            self._send_all(self.HEARTBEAT, 0, b"")
+        wake = min(self.last_tx + self.heartbeat, self.last_rx + 3 * self.heartbeat)
+        return max(wake - now, 0)
 
-    def _listen(self, proxy_sock: socket.socket) -> None:
-        '''Listen for localhost connections'''
+    def _listen(self) -> bool:
+        '''Listen for localhost connections, False if the port is taken'''
         s = self._bind(self.lhost, self.lport)
-        if s:
+        if not s:
+            return False
+        s.listen(25)
+        s.setblocking(0)
+        self.local_listener = s
+        self.sel.register(s, selectors.EVENT_READ, self._accept)
+        if self.verbose:
+            print(
+                "Listening for localhost connections on",
+                f"{self.lhost}:{self.lport}"
+            )
+            if self.socks5:
+                print("Local connections speak SOCKS5")
+                if not self.targets:
+                    print("WARNING: The proxy cannot dial SOCKS5 targets!")
+        self._listen_forwards()
+        return True
+
+    def _listen_forwards(self) -> None:
+        '''Listen on the local port of every forward'''
+        if self.forwards and not self.forward_ok:
+            print("WARNING: The proxy cannot relay forwards, only the local port is served!")
+            return
+        for index, (lport, rhost, rport) in enumerate(self.forwards):
+            s = self._bind(self.lhost, lport)
+            if not s:
+                print(f"WARNING: Cannot listen on {self.lhost}:{lport}!")
+                continue
             s.listen(25)
+            s.setblocking(0)
+            self.listeners[s] = index
+            self.sel.register(s, selectors.EVENT_READ, self._accept)
             if self.verbose:
-                print(
-                    "Listening for localhost connections on",
-                    f"{self.lhost}:{self.lport}"
-                )
-            while 1:
+                print(f"Forwarding {self.lhost}:{lport} to {rhost}:{rport}")
+
+    def _accept(self, s: socket.socket, mask: int) -> None:
+        '''Open a tunnel channel for a new local connection'''
+        try:
+            local_sock, addr = s.accept()
+        except BlockingIOError:
+            return
+        local_sock.setblocking(0)
+        if self.verbose:
+            print("Local connection received!")
+        if s in self.listeners:
+            # The proxy looks the target up in its own forward table
+            index = self.listeners[s]
+            lport, rhost, rport = self.forwards[index]
+            self._open(local_sock, self.OPEN_BODY.pack(self.OPEN_FORWARD, index), label=f"{rhost}:{rport}")
+            return
+        if self.socks5:
+            # Learn the target before opening a channel for it
+            self.greeting[local_sock] = {"buf": bytearray(), "methods": False}
+            self.sel.register(local_sock, selectors.EVENT_READ, self._greet)
+            return
+        self._open(local_sock)
+        if not self.multiplex:
+            # Single channel proxies are served one connection at a time
+            self.sel.unregister(s)
+
+    def _open(self, local_sock: socket.socket, target: bytes=b"", wait: bool=False, label: str="default") -> int:
+        '''Open a tunnel channel for a local connection, return its id'''
+        self.next_chan = (self.next_chan + 1) & 0xffffffff
+        # Channel 0 stands for the whole tunnel in RATE frames
+        while not self.next_chan or self.next_chan in self.channels:
+            self.next_chan = (self.next_chan + 1) & 0xffffffff
+        chan = self.next_chan
+        self.channels[chan] = {
+            "sock": local_sock,
+            "queue": collections.deque(), # data waiting for the local socket
+            "eof_in": False, # proxy sent EOF
+            "eof_out": False, # local socket sent EOF
+            "shut": False, # EOF forwarded to the local socket
+            "closing": False,
+            "opening": wait, # waiting for the proxy to reach the target
+            "zskip": 0, # data frames to send raw before trying again
+            "zmiss": 8,
+            "queued": 0, # bytes in the queue
+            "paused": False, # the proxy was asked to stop sending
+            "held": False, # the proxy asked us to stop sending
+            "bucket": self._bucket(self.session_rate),
+            "heat": 0, # bytes read lately, decaying
+            "heated": time.monotonic(),
+            "target": label,
+            "start": time.monotonic(),
+            "connect_ms": None, # OPEN to the proxy acknowledging a named target
+            "ttfb_ms": None, # OPEN to the first data from the proxy
+            "bytes_up": 0, # local socket to proxy
+            "bytes_down": 0, # proxy to local socket
+            "error": None
+        }
+        self.socks[local_sock] = chan
+        if not wait:
+            self.sel.register(local_sock, selectors.EVENT_READ, self._relay)
+        # Tell proxy to connect
+        self._send_all(self.OPEN, chan, target)
+        return chan
+
+    def _greet(self, sock: socket.socket, mask: int) -> None:
+        '''Read a SOCKS5 handshake and open a channel to the requested target'''
+        state = self.greeting[sock]
+        buf = state["buf"]
+        try:
+            data = sock.recv(1024)
+        except BlockingIOError:
+            return
+        except:
+            data = b""
+        if not data:
+            self._ungreet(sock)
+            return
+        buf += data
+        if not state["methods"]:
+            # Version, method count and methods, only "no authentication" is offered
+            if len(buf) < 2 or len(buf) < 2 + buf[1]:
+                return
+            if buf[0] != 5 or 0 not in buf[2:2 + buf[1]]:
+                self._ungreet(sock, b"\x05\xff")
+                return
+            self._reply(sock, b"\x05\x00")
+            del buf[:2 + buf[1]]
+            state["methods"] = True
+        # Version, command, reserved, address type, address and port
+        if len(buf) < 5:
+            return
+        if buf[3] == 1:
+            end = 8
+        elif buf[3] == 3:
+            end = 5 + buf[4]
+        elif buf[3] == 4:
+            end = 20
+        else:
+            self._ungreet(sock, self._socks_reply(self.SOCKS_FAILED))
+            return
+        if len(buf) < end + 2:
+            return
+        if buf[0] != 5 or buf[1] != 1:
+            # Only CONNECT is relayed
+            self._ungreet(sock, self._socks_reply(self.SOCKS_COMMAND))
+            return
+        if not self.targets:
+            self._ungreet(sock, self._socks_reply(self.SOCKS_FAILED))
+            return
+        if buf[3] == 1:
+            host = socket.inet_ntop(socket.AF_INET, bytes(buf[4:end]))
+        elif buf[3] == 4:
+            host = socket.inet_ntop(socket.AF_INET6, bytes(buf[4:end]))
+        else:
+            host = bytes(buf[5:end]).decode("utf-8", "replace")
+        port, = self.PORT.unpack_from(buf, end)
+        if not host:
+            self._ungreet(sock, self._socks_reply(self.SOCKS_FAILED))
+            return
+        early = bytes(buf[end + 2:])
+        del self.greeting[sock]
+        self.sel.unregister(sock)
+        if self.verbose:
+            print(f"SOCKS5 connect to {host}:{port}")
+        target = self.OPEN_BODY.pack(self.OPEN_TARGET, port) + host.encode("utf-8")
+        chan = self._open(sock, target, True, f"{host}:{port}")
+        if early:
+            # Data sent before our reply, the proxy queues it until connected
+            self._send_all(self.DATA, chan, early)
+
+    def _socks_reply(self, code: int) -> bytes:
+        '''Return a SOCKS5 reply with an empty bound address'''
+        return bytes([5, code, 0, 1, 0, 0, 0, 0, 0, 0])
+
+    def _reply(self, sock: socket.socket, reply: bytes) -> bool:
+        '''Send a short handshake reply, False if the socket is gone'''
+        try:
+            return sock.send(reply) == len(reply)
+        except:
+            return False
+
+    def _ungreet(self, sock: socket.socket, reply: bytes=b"") -> None:
+        '''Refuse or abandon a SOCKS5 handshake and close the socket'''
+        self.greeting.pop(sock, None)
+        if reply:
+            self._reply(sock, reply)
+        try:
+            self.sel.unregister(sock)
+        except:
+            pass
+        self._close(sock)
+        if self.verbose:
+            print("Local connection closed!")
+
+    def _link(self, sock: socket.socket) -> None:
+        '''Start relaying frames over a connection from the proxy'''
+        # Frames are written whole, so do not wait to coalesce them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        rbuf = bytearray(2 * (self.SEQ_HEADER.size + self.max_frame))
+        link = {
+            "sock": sock,
+            "rbuf": rbuf, # frames are received into one reusable buffer
+            "rview": memoryview(rbuf),
+            "rend": 0,
+            "outq": collections.deque(), # buffers queued for the proxy
+            "held": 0 # frames waiting in the reorder buffer
+        }
+        self.links[sock] = link
+        self.order.append(link)
+        self.sel.register(sock, selectors.EVENT_READ, self._tunnel)
+
+    def _join(self, s: socket.socket, mask: int) -> None:
+        '''Accept another connection of a striped tunnel'''
+        try:
+            sock, addr = s.accept()
+        except BlockingIOError:
+            return
+        if addr[0] != self.proxy_ip:
+            # Only the proxy may join the tunnel
+            self._close(sock)
+            return
+        self._link(sock)
+        if self.verbose:
+            print(f"Tunnel striped over {len(self.links)} connections")
+
+    def _lost(self) -> None:
+        '''End the session, start() goes back to waiting for the proxy'''
+        if self.verbose:
+            print("Proxy disconnected!")
+        for sock in self.links:
+            if self.sel.get_map().get(sock):
+                self.sel.unregister(sock)
+        self.proxy_sock = None
+
+    def _tunnel(self, sock: socket.socket, mask: int) -> None:
+        '''Read frames from and write frames to the proxy'''
+        link = self.links[sock]
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.backlog -= self._flush(sock, link["outq"])
+                if self.choked and self.backlog <= self.LOW_WATER:
+                    self._choke(False)
+                if self.yielding and self.backlog <= self.BULK_WATER // 4:
+                    self._yield(False)
+            if mask & selectors.EVENT_READ:
+                n = sock.recv_into(link["rview"][link["rend"]:])
+                if not n:
+                    # Proxy is gone, end the session
+                    self._lost()
+                    return
+                link["rend"] += n
+                self.tunnel["bytes_in"] += n
+                self.last_rx = time.monotonic()
+                self._parse(link)
+        except BlockingIOError:
+            pass
+        except:
+            self._lost()
+            return
+        self._arm(link)
+
+    def _arm(self, link: dict) -> None:
+        '''Update the events of a connection from the proxy'''
+        if not self.proxy_sock:
+            return
+        events = 0
+        # Frames after a missing one are not read until it arrives,
+        # and none are read while a channel cannot keep up without flow control
+        if not link["held"] and not self.stalled:
+            events |= selectors.EVENT_READ
+        if link["outq"]:
+            events |= selectors.EVENT_WRITE
+        sock = link["sock"]
+        key = self.sel.get_map().get(sock)
+        if not events:
+            if key:
+                self.sel.unregister(sock)
+        elif not key:
+            self.sel.register(sock, events, self._tunnel)
+        elif key.events != events:
+            self.sel.modify(sock, events, self._tunnel)
+
+    def _parse(self, link: dict) -> None:
+        '''Handle every complete frame in a link's receive buffer'''
+        rbuf = link["rbuf"]
+        pos = 0
+        while self.proxy_sock:
+            size = self.SEQ_HEADER.size if self.striped else self.HEADER.size
+            if link["rend"] - pos < size:
+                break
+            if self.striped:
+                seq, cmd, chan, data_len = self.SEQ_HEADER.unpack_from(rbuf, pos)
+            else:
+                seq = None
+                cmd, chan, data_len = self.HEADER.unpack_from(rbuf, pos)
+            if data_len > self.max_frame:
+                # We announced max_frame, so this header is corrupt or hostile
+                if self.verbose:
+                    print(f"Frame of {data_len} bytes from the proxy, tunnel dropped")
+                self._lost()
+                return
+            end = pos + size + data_len
+            if end > link["rend"]:
+                # The buffer holds two of the largest frames, so the rest fits
+                break
+            # Payload is handed on as a view into the buffer, not a copy
+            data = link["rview"][pos + size:end]
+            pos = end
+            if seq is None:
+                self._handle(cmd, chan, data)
+            elif seq == self.rx_seq:
+                self.rx_seq = (seq + 1) & 0xffffffff
+                self._handle(cmd, chan, data)
+                self._release()
+            else:
+                # An earlier frame is still on another link
+                self.reorder[seq] = (link, cmd, chan, bytes(data))
+                link["held"] += 1
+        if pos:
+            # Keep the partial frame at the front of the buffer
+            rend = link["rend"]
+            rbuf[:rend - pos] = rbuf[pos:rend]
+            link["rend"] -= pos
+
+    def _release(self) -> None:
+        '''Handle reordered frames that are now next in sequence'''
+        while self.rx_seq in self.reorder:
+            link, cmd, chan, data = self.reorder.pop(self.rx_seq)
+            self.rx_seq = (self.rx_seq + 1) & 0xffffffff
+            link["held"] -= 1
+            self._handle(cmd, chan, data)
+            if not link["held"]:
+                self._arm(link)
+
+    def _handle(self, cmd: int, chan: int, data: memoryview) -> None:
+        '''Apply a frame from the proxy to its channel'''
+        self.tunnel["frames_in"] += 1
+        if cmd == self.HEARTBEAT:
+            return
+        if cmd == self.PING:
+            self._send_all(self.PONG, 0, bytes(data))
+            return
+        if cmd == self.PONG:
+            if len(data) == self.STAMP.size:
+                sent, = self.STAMP.unpack(data)
+                self.rtt = round((time.monotonic() - sent) * 1000, 3)
+                self.rtt_min = min(self.rtt, self.rtt_min or self.rtt)
+            return
+        if cmd == self.RATE:
+            if len(data) == self.RATE_BODY.size and self.verbose:
+                print("Proxy limits", self._rates(chan, *self.RATE_BODY.unpack(data)))
+            return
+        state = self.channels.get(chan)
+        if not state:
+            # Frame for a channel that is already gone
+            return
+        if state["opening"]:
+            # The proxy acknowledges a named target with OPEN or refuses it with CLOSE
+            if cmd == self.OPEN:
+                state["opening"] = False
+                state["connect_ms"] = round((time.monotonic() - state["start"]) * 1000, 3)
+                if not self._reply(state["sock"], self._socks_reply(self.SOCKS_OK)):
+                    self._send_all(self.CLOSE, chan, b"")
+                    self._drop(chan)
+                    return
+            elif cmd == self.CLOSE:
+                state["error"] = "refused"
+                self._reply(state["sock"], self._socks_reply(self.SOCKS_REFUSED))
+                self._drop(chan)
+                return
+        if cmd & self.COMPRESSED:
+            cmd ^= self.COMPRESSED
+            data = self._inflate(data)
+            if data is None:
+                self._send_all(self.CLOSE, chan, b"")
+                self._drop(chan)
+                return
+        if cmd == self.DATA:
+            if state["ttfb_ms"] is None:
+                state["ttfb_ms"] = round((time.monotonic() - state["start"]) * 1000, 3)
+            state["bytes_down"] += len(data)
+            if not state["queue"]:
                 try:
-                    local_sock, addr = s.accept()
-                    local_sock.setblocking(0)
-                    if self.verbose:
-                        print("Local connection received!")
-                    # Tell proxy to connect
-                    self._send_all(proxy_sock, 1, b"")
-                    self._switch(proxy_sock, local_sock)
-                    self._close(local_sock)
-                    if self.verbose:
-                        print("Local connection closed!")
-                except KeyboardInterrupt:
-                    self._close(proxy_sock)
-                    break
+                    data = data[state["sock"].send(data):]
+                except BlockingIOError:
+                    pass
+                except:
+                    self._send_all(self.CLOSE, chan, b"")
+                    self._drop(chan)
+                    return
+            if data:
+                # The receive buffer is reused, keep a copy of the rest
+                state["queue"].append(bytes(data))
+                state["queued"] += len(data)
+                if state["queued"] > self.HIGH_WATER and not state["paused"]:
+                    self._pause(chan, True)
+        elif cmd == self.PAUSE:
+            state["held"] = True
+        elif cmd == self.RESUME:
+            state["held"] = False
+        elif cmd == self.EOF:
+            state["eof_in"] = True
+        elif cmd == self.CLOSE:
+            state["closing"] = True
+        self._service(chan)
+
+    def _relay(self, sock: socket.socket, mask: int) -> None:
+        '''Relay between a local socket and its channel'''
+        chan = self.socks.get(sock)
+        if chan is None:
+            return
+        state = self.channels[chan]
+        try:
+            if mask & selectors.EVENT_READ:
+                wait = self._shaped(state)
+                if wait:
+                    # Out of tokens, read again once they refill
+                    self.throttled[chan] = time.monotonic() + wait
+                    n = None
+                else:
+                    n = sock.recv_into(self.scratch, self._quantum(state))
+                if n:
+                    self._charge(state, n)
+                    state["bytes_up"] += n
+                    cmd, data = self._deflate(state, self.scratch[:n])
+                    self._send_all(cmd, chan, data)
+                elif n == 0:
+                    state["eof_out"] = True
+                    self._send_all(self.EOF, chan, b"")
+        except BlockingIOError:
+            pass
+        except:
+            self._send_all(self.CLOSE, chan, b"")
+            self._drop(chan)
+            return
+        self._service(chan)
+
+    def _service(self, chan: int) -> None:
+        '''Flush a channel, forward EOFs and update its events'''
+        state = self.channels[chan]
+        sock = state["sock"]
+        try:
+            state["queued"] -= self._flush(sock, state["queue"])
+            if state["paused"] and state["queued"] <= self.LOW_WATER:
+                self._pause(chan, False)
+            if not state["queue"] and state["eof_in"] and not state["shut"]:
+                state["shut"] = True
+                sock.shutdown(socket.SHUT_WR)
+        except BlockingIOError:
+            pass
+        except:
+            self._send_all(self.CLOSE, chan, b"")
+            self._drop(chan)
+            return
+        if not state["queue"] and (state["closing"] or \
+                (state["eof_in"] and state["eof_out"])):
+            self._drop(chan)
+            return
+        self._watch(chan)
 
-    def _switch(self, proxy_sock: socket.socket, local_sock: socket.socket) -> None:
-        '''Switch between read/write'''
-        client_read = True
-        local_closed = False
-        if proxy_sock and local_sock:
-            while 1:
-                # Recv from client
-                if client_read:
-                    try:
-                        data = local_sock.recv(self.data_size)
-                        if data:
-                            self._send_all(proxy_sock, 0, data)
-                        else:
-                            # Local socket is closed
-                            if local_closed:
-                                self._send_all(proxy_sock, 2, b"")
-                                break
-                            local_closed = True
-                            client_read = False
-                            time.sleep(0.005)
-                    except BlockingIOError:
-                        client_read = False
-                        time.sleep(0.005)
-                    except:
-                        break
-                # Recv from server
-                if not client_read:
-                    try:
-                        header = self._recv_all(proxy_sock, 5)
-                        if header:
-                            cmd, data_len = struct.unpack(">BI", header)
-                            if cmd == 0:
-                                data = self._recv_all(proxy_sock, data_len)
-                                if not local_closed:
-                                    local_sock.sendall(data)
-                                else:
-                                    client_read = True
-                                    time.sleep(0.005)
-                            elif cmd == 2: # close socket
-                                break
-                        else:
-                            client_read = True
-                            time.sleep(0.005)
-                    except BlockingIOError:
-                        client_read = True
-                        time.sleep(0.005)
-                    except:
-                        break
-
-    def _send_all(self, sock: socket.socket, cmd: int, data: bytes) -> None:
-        '''Send data or a command'''
-        try:
-            data_len = len(data)
-            header = struct.pack(">BI", cmd, data_len)
-            msg = header + data
-            sock.sendall(msg)
+    def _watch(self, chan: int) -> None:
+        '''Select a channel's events from its state'''
+        state = self.channels[chan]
+        sock = state["sock"]
+        events = 0
+        if state["queue"]:
+            events |= selectors.EVENT_WRITE
+        # Nothing is read until the SOCKS5 reply has been sent, nor while the peer
+        # or the tunnel cannot take more or the channel waits for tokens,
+        # and bulk channels yield a backed up tunnel
+        if not state["eof_out"] and not state["closing"] and not state["opening"] and \
+                not state["held"] and not self.choked and chan not in self.throttled and \
+                not (self.yielding and self._bulk(state)):
+            events |= selectors.EVENT_READ
+        key = self.sel.get_map().get(sock)
+        if not events:
+            if key:
+                self.sel.unregister(sock)
+        elif not key:
+            self.sel.register(sock, events, self._relay)
+        elif key.events != events:
+            self.sel.modify(sock, events, self._relay)
+
+    def _drop(self, chan: int) -> None:
+        '''Close a channel's local socket and forget the channel'''
+        state = self.channels.pop(chan)
+        self._ended(chan, state)
+        if chan in self.stalled:
+            self._pause(chan, False)
+        self.throttled.pop(chan, None)
+        sock = state["sock"]
+        self.socks.pop(sock, None)
+        try:
+            self.sel.unregister(sock)
+        except:
+            pass
+        self._close(sock)
+        if self.verbose:
+            print("Local connection closed!")
+        if not self.multiplex and self.proxy_sock and not self.channels:
+            # Resume accepting now the proxy is free
+            self.sel.register(self.local_listener, selectors.EVENT_READ, self._accept)
+
+    def _deflate(self, state: dict, data: memoryview) -> tuple:
+        '''Return the command and payload for data, compressed if it pays off'''
+        self.zraw += len(data)
+        if not self.zpeer or len(data) < self.ZMIN or state["zskip"]:
+            if state["zskip"]:
+                state["zskip"] -= 1
+            self.zwire += len(data)
+            return self.DATA, data
+        packed = zlib.compress(data, 1)
+        if len(packed) > len(data) * 0.9:
+            # Not worth it, send the next frames raw and back off further
+            state["zskip"] = state["zmiss"]
+            state["zmiss"] = min(state["zmiss"] * 2, 256)
+            self.zwire += len(data)
+            return self.DATA, data
+        state["zmiss"] = 8
+        self.zwire += len(packed)
+        return self.DATA | self.COMPRESSED, packed
+
+    def _inflate(self, data: memoryview) -> bytes:
+        '''Decompress a payload, None if it is corrupt or too large'''
+        try:
+            z = zlib.decompressobj()
+            out = z.decompress(data, self.max_frame)
+            if z.unconsumed_tail or not z.eof:
+                return None
+            return out
+        except:
+            return None
+
+    def _pause(self, chan: int, on: bool) -> None:
+        '''Stop or restart the proxy sending data for a channel with a full queue'''
+        state = self.channels.get(chan)
+        if state:
+            state["paused"] = on
+        stalled = bool(self.stalled)
+        if on and not self.flow:
+            # Without flow control the only lever is to stop reading the tunnel
+            self.stalled.add(chan)
+        elif not on:
+            self.stalled.discard(chan)
+        if self.flow and state:
+            self._send_all(self.PAUSE if on else self.RESUME, chan, b"")
+        if bool(self.stalled) != stalled:
+            for link in self.order:
+                self._arm(link)
+
+    def _choke(self, on: bool) -> None:
+        '''Stop or restart reading channel sockets while the tunnel backlog drains'''
+        self.choked = on
+        for chan in self.channels:
+            self._watch(chan)
+
+    def _yield(self, on: bool) -> None:
+        '''Stop or restart reading bulk channels so interactive ones find a short queue'''
+        self.yielding = on
+        for chan in self.channels:
+            self._watch(chan)
+
+    def _bucket(self, rate: float) -> dict:
+        '''Return a full token bucket for rate bytes per second, 0 for no limit'''
+        return {"rate": rate, "tokens": self._burst(rate), "stamp": time.monotonic()}
+
+    def _burst(self, rate: float) -> int:
+        '''Return the most tokens a bucket holds'''
+        return max(int(rate * self.BURST), self.QUANTUM)
+
+    def _refill(self, bucket: dict, now: float) -> None:
+        '''Add the tokens earned since a bucket was last used'''
+        tokens = bucket["tokens"] + (now - bucket["stamp"]) * bucket["rate"]
+        bucket["tokens"] = min(tokens, self._burst(bucket["rate"]))
+        bucket["stamp"] = now
+
+    def _bulk(self, state: dict) -> bool:
+        '''Check whether a channel has moved enough lately to count as bulk'''
+        age = time.monotonic() - state["heated"]
+        return state["heat"] * 0.5 ** (age / self.HEAT_LIFE) > self.BULK
+
+    def _shaped(self, state: dict) -> float:
+        '''Return seconds until a channel may be read under the rate limits, 0 for now'''
+        now = time.monotonic()
+        buckets = [state["bucket"]]
+        if self._bulk(state):
+            # Interactive channels spend tunnel tokens but never wait for them
+            buckets.append(self.bucket)
+        wait = 0
+        for bucket in buckets:
+            if bucket["rate"]:
+                self._refill(bucket, now)
+                if bucket["tokens"] <= 0:
+                    wait = max(wait, (1 - bucket["tokens"]) / bucket["rate"])
+        return wait
+
+    def _quantum(self, state: dict) -> int:
+        '''Return how much to read from a channel without bursting past its limits'''
+        size = self.data_size
+        for bucket in (state["bucket"], self.bucket):
+            if bucket["rate"]:
+                size = min(size, self._burst(bucket["rate"]))
+        return size
+
+    def _charge(self, state: dict, n: int) -> None:
+        '''Take bytes read from a channel out of its token buckets'''
+        now = time.monotonic()
+        age = now - state["heated"]
+        state["heat"] = state["heat"] * 0.5 ** (age / self.HEAT_LIFE) + n
+        state["heated"] = now
+        for bucket in (state["bucket"], self.bucket):
+            if bucket["rate"]:
+                self._refill(bucket, now)
+                # Debt is capped so a busy interactive channel cannot starve bulk ones for long
+                bucket["tokens"] = max(bucket["tokens"] - n, -self._burst(bucket["rate"]))
+
+    def _shape(self) -> float:
+        '''Read throttled channels again once their tokens refill, return the select timeout'''
+        if not self.throttled:
+            return None
+        now = time.monotonic()
+        for chan, until in list(self.throttled.items()):
+            if until <= now:
+                del self.throttled[chan]
+                self._watch(chan)
+        if not self.throttled:
+            return None
+        return max(min(self.throttled.values()) - now, 0)
+
+    def _limit(self, chan: int, tunnel: int, session: int) -> None:
+        '''Apply new limits to our side, KEEP leaves one unchanged'''
+        if tunnel != self.KEEP:
+            self.bucket = self._bucket(tunnel)
+        if session != self.KEEP:
+            if chan:
+                self.channels[chan]["bucket"] = self._bucket(session)
+            else:
+                # Channel 0 sets the default, for open channels too
+                self.session_rate = session
+                for state in self.channels.values():
+                    state["bucket"] = self._bucket(session)
+        # Throttled channels are checked against the new limits at once
+        for other in self.throttled:
+            self.throttled[other] = 0
+
+    def _rates(self, chan: int, tunnel: float, session: float) -> str:
+        '''Describe limits in bytes per second for people'''
+        names = [f"{rate / 1024:g} KiB/s" if rate else "unlimited" for rate in (tunnel, session)]
+        who = f"session {chan}" if chan else "each session"
+        return f"tunnel {names[0]}, {who} {names[1]}"
+
+    def _console(self) -> None:
+        '''Listen on the loopback control port'''
+        s = self._bind("127.0.0.1", self.control)
+        if not s:
+            print(f"WARNING: Cannot listen for control commands on 127.0.0.1:{self.control}!")
+            return
+        s.listen(5)
+        s.setblocking(0)
+        self.sel.register(s, selectors.EVENT_READ, self._command_accept)
+        if self.verbose:
+            print(f"Listening for control commands on 127.0.0.1:{self.control}")
+
+    def _command_accept(self, s: socket.socket, mask: int) -> None:
+        '''Accept a control connection'''
+        try:
+            conn, addr = s.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(0)
+        self.controls[conn] = {
+            "buf": bytearray(), # command bytes not parsed yet
+            "outq": collections.deque(), # replies waiting to be written
+            "done": False # no more commands will be read
+        }
+        self.sel.register(conn, selectors.EVENT_READ, self._command)
+
+    def _command(self, conn: socket.socket, mask: int) -> None:
+        '''Run the control commands on a connection, one per line'''
+        control = self.controls[conn]
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(conn, control["outq"])
+            if mask & selectors.EVENT_READ:
+                data = conn.recv(4096)
+                control["buf"] += data
+                if not data:
+                    control["done"] = True
+        except BlockingIOError:
+            pass
+        except OSError:
+            control["done"] = True
+            control["buf"].clear()
+            control["outq"].clear()
+        buf = control["buf"]
+        for i in range(self.COMMANDS):
+            if b"\n" not in buf:
+                break
+            line, sep, rest = bytes(buf).partition(b"\n")
+            buf[:] = rest
+            reply = self._run(line.decode("utf-8", "replace").split())
+            control["outq"].append((reply + "\n").encode("utf-8"))
+        if len(buf) > 4096 and b"\n" not in buf:
+            # No command is this long
+            control["done"] = True
+        # Replies are queued like tunnel frames, so a slow reader never blocks relaying.
+        # Commands left over wait for the next writable event, and no more
+        # are read until the previous replies are written
+        events = 0
+        if control["outq"] or b"\n" in buf:
+            events |= selectors.EVENT_WRITE
+        elif not control["done"]:
+            events |= selectors.EVENT_READ
+        if not events:
+            self.sel.unregister(conn)
+            del self.controls[conn]
+            self._close(conn)
+        elif events != self.sel.get_key(conn).events:
+            self.sel.modify(conn, events, self._command)
+
+    def _run(self, words: list) -> str:
+        '''Run one control command and return its reply'''
+        usage = "error: commands are 'rate TUNNEL SESSION [CHANNEL]' in KiB/s with - to keep, and 'dump'"
+        if words == ["dump"]:
+            return json.dumps(self._snapshot("dump"))
+        if not words or words[0] != "rate" or len(words) not in (3, 4):
+            return usage
+        try:
+            limits = []
+            for word in words[1:3]:
+                rate = self.KEEP if word == "-" else int(float(word) * 1024)
+                if not 0 <= rate <= self.KEEP:
+                    return usage
+                limits.append(rate)
+            chan = int(words[3]) if len(words) == 4 else 0
+        except (ValueError, OverflowError):
+            return usage
+        if chan and chan not in self.channels:
+            return f"error: no open session {chan}"
+        self._limit(chan, *limits)
+        session = self.channels[chan]["bucket"]["rate"] if chan else self.session_rate
+        reply = "ok, client limits " + self._rates(chan, self.bucket["rate"], session)
+        if not self.proxy_sock:
+            return reply + ", the proxy is not connected"
+        if not self.shaping:
+            return reply + ", the proxy cannot shape its side"
+        self._send_all(self.RATE, chan, self.RATE_BODY.pack(*limits))
+        return reply + ", sent to the proxy"
+
+    def _tick(self) -> float:
+        '''Ping the proxy and write a stats record every stats_interval seconds'''
+        if not self.stats_interval:
+            return None
+        now = time.monotonic()
+        if now >= self.next_tick:
+            if self.pings and self.proxy_sock:
+                self._send_all(self.PING, 0, self.STAMP.pack(now))
+            if self.stats:
+                self._record(self._snapshot("stats"))
+            self.busy = 0
+            self.busy_since = now
+            self.next_tick = now + self.stats_interval
+        return max(self.next_tick - now, 0)
+
+    def _ended(self, chan: int, state: dict) -> None:
+        '''Fold a finished channel into the totals and record it'''
+        self.totals["sessions"] += 1
+        if state["error"]:
+            self.totals["failed"] += 1
+        self.totals["bytes_up"] += state["bytes_up"]
+        self.totals["bytes_down"] += state["bytes_down"]
+        if self.stats:
+            record = self._summary(chan, state, time.monotonic())
+            record.update(time=round(time.time(), 3), event="session", error=state["error"])
+            self._record(record)
+
+    def _summary(self, chan: int, state: dict, now: float) -> dict:
+        '''Return the counters of one channel'''
+        return {
+            "id": chan,
+            "target": state["target"],
+            "duration_s": round(now - state["start"], 3),
+            "connect_ms": state["connect_ms"],
+            "ttfb_ms": state["ttfb_ms"],
+            "bytes_up": state["bytes_up"],
+            "bytes_down": state["bytes_down"],
+            "bulk": self._bulk(state)
+        }
+
+    def _snapshot(self, event: str) -> dict:
+        '''Return client-wide counters, with open channels for a dump'''
+        now = time.monotonic()
+        record = {
+            "time": round(time.time(), 3),
+            "event": event,
+            "role": "client",
+            "pid": os.getpid(),
+            "uptime_s": round(now - self.started, 3),
+            "connected": bool(self.proxy_sock),
+            "links": len(self.links),
+            "active": len(self.channels),
+            "throttled": len(self.throttled),
+            "rate": self.bucket["rate"] / 1024, # KiB/s
+            "session_rate": self.session_rate / 1024,
+            "rtt_ms": self.rtt,
+            "rtt_min_ms": self.rtt_min,
+            # Share of time spent relaying, near 1 means the client is saturated
+            "busy": round(self.busy / max(now - self.busy_since, 0.001), 3)
+        }
+        record.update(self.totals)
+        record.update(self.tunnel)
+        for state in self.channels.values():
+            record["bytes_up"] += state["bytes_up"]
+            record["bytes_down"] += state["bytes_down"]
+        if event == "dump":
+            record["open"] = [self._summary(c, s, now) for c, s in self.channels.items()]
+        return record
+
+    def _record(self, record: dict) -> None:
+        '''Append a JSON line to the stats file'''
+        try:
+            with open(self.stats, "a") as f:
+                f.write(json.dumps(record) + "\n")
         except:
             pass
 
+    def _dump(self, signum: int, frame) -> None:
+        '''Write every counter on SIGUSR1, to stdout without a stats file'''
+        record = self._snapshot("dump")
+        if self.stats:
+            self._record(record)
+            return
+        try:
+            print(json.dumps(record), flush=True)
+        except:
+            pass
+
+    def _report(self) -> None:
+        '''Print how much compression saved on data sent'''
+        if self.verbose and self.compress and self.zraw:
+            ratio = self.zraw / max(self.zwire, 1)
+            print(f"Compressed {self.zraw} data bytes to {self.zwire} ({ratio:.2f}x)")
+
+    def _send_all(self, cmd: int, chan: int, data: bytes) -> None:
+        '''Send a frame to the proxy, queueing whatever does not fit'''
+        if not self.proxy_sock:
+            return
+        self.last_tx = time.monotonic()
+        self.tunnel["frames_out"] += 1
+        if self.striped:
+            header = self.SEQ_HEADER.pack(self.tx_seq, cmd, chan, len(data))
+            self.tx_seq = (self.tx_seq + 1) & 0xffffffff
+            link = self._pick()
+        else:
+            header = self.HEADER.pack(cmd, chan, len(data))
+            link = self.order[0]
+        self.tunnel["bytes_out"] += len(header) + len(data)
+        outq = link["outq"]
+        if outq:
+            # Older frames are still waiting, keep the order
+            outq.append(header)
+            if data:
+                outq.append(bytes(data))
+        else:
+            try:
+                if self.sendmsg:
+                    sent = link["sock"].sendmsg([header, data])
+                else:
+                    sent = link["sock"].send(header + data)
+            except BlockingIOError:
+                sent = 0
+            except:
+                self._lost()
+                return
+            if sent < len(header):
+                outq.append(header[sent:])
+                if data:
+                    outq.append(bytes(data))
+            elif sent < len(header) + len(data):
+                outq.append(bytes(data[sent - len(header):]))
+            self.backlog -= sent
+        self.backlog += len(header) + len(data)
+        if outq:
+            if self.backlog > self.BULK_WATER and not self.yielding:
+                self._yield(True)
+            if self.backlog > self.HIGH_WATER and not self.choked:
+                self._choke(True)
+            self._arm(link)
+
+    def _pick(self) -> dict:
+        '''Return the link for the next frame, preferring one with nothing queued'''
+        n = len(self.order)
+        for i in range(n):
+            link = self.order[(self.next_link + i) % n]
+            if not link["outq"]:
+                self.next_link = (self.next_link + i + 1) % n
+                return link
+        return min(self.order, key=lambda l: len(l["outq"]))
+
+    def _flush(self, sock: socket.socket, queue: collections.deque) -> int:
+        '''Write queued buffers with one gathered send per call, return bytes written'''
+        total = 0
+        while queue:
+            try:
+                if self.sendmsg:
+                    batch = [queue[i] for i in range(min(len(queue), 64))]
+                    sent = sock.sendmsg(batch)
+                else:
+                    batch = [queue[0]]
+                    sent = sock.send(queue[0])
+            except BlockingIOError:
+                break
+            total += sent
+            full = sent == sum(len(b) for b in batch)
+            while sent:
+                first = queue[0]
+                if sent >= len(first):
+                    sent -= len(first)
+                    queue.popleft()
+                else:
+                    queue[0] = memoryview(first)[sent:]
+                    sent = 0
+            if not full:
+                # Socket buffer is full, wait for writability
+                break
+        return total
+
     def _recv_all(self, sock: socket.socket, n: int) -> bytes:
         '''TCP recv n bytes'''
-        data = b""
+        data = bytearray(n)
+        view = memoryview(data)
         dlen = 0
         while dlen < n:
             try:
-                chunk = sock.recv(n - dlen)
-                if (not chunk) and (dlen == 0): # no data
+                chunk = sock.recv_into(view[dlen:])
+                if not chunk: # socket closed
                     break
-                data += chunk
-                dlen += len(chunk)
-            except:
+                dlen += chunk
+            except OSError:
                 break
-        return data
+        return bytes(data[:dlen])
 
     def _close(self, sock: socket.socket) -> None:
         '''Close socket'''
@@ -139,12 +1198,13 @@ class ProxyClient:
     def _bind(self, host: str, port: int) -> socket.socket:
         '''Bind a TCP socket listener'''
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            family = socket.AF_INET6 if ":" in host else socket.AF_INET
+            s = socket.socket(family, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s.bind((host, port))
             return s
         except:
             return None
 
-prxcli = ProxyClient("{{CHOST}}", {{CPORT}}, "{{LHOST}}", {{LPORT}})
+prxcli = ProxyClient("{{CHOST}}", {{CPORT}}, "{{LHOST}}", {{LPORT}}, compress={{COMPRESS}}, socks={{SOCKS}}, forwards={{FORWARDS}}, streams={{STREAMS}}, heartbeat={{HEARTBEAT}}, stats={{STATS}}, stats_interval={{STATS_INTERVAL}}, rate={{RATE}}, session_rate={{SESSION_RATE}}, control={{CONTROL}})
 prxcli.start()
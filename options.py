@@ -1,12 +1,32 @@
 #! /usr/bin/env python3
 
 import os
-import base64
 import argparse
+import generator
+
+class LazySubParsers(argparse._SubParsersAction):
+
+    def __init__(self, *args, **kwargs) -> None:
+        '''Subparsers that only add their arguments once they are chosen'''
+        super().__init__(*args, **kwargs)
+        self.builders = {} # parser name -> function adding its arguments
+
+    def add_lazy_parser(self, name: str, build, **kwargs) -> argparse.ArgumentParser:
+        '''Add a parser whose arguments build(parser) adds when it is used'''
+        parser = self.add_parser(name, **kwargs)
+        self.builders[name] = lambda: build(parser)
+        return parser
+
+    def __call__(self, parser, namespace, values, option_string=None) -> None:
+        '''Build the chosen parser, then let it parse the rest'''
+        build = self.builders.pop(values[0], None)
+        if build:
+            build()
+        super().__call__(parser, namespace, values, option_string)
 
 class Options:
 
-    def __init__(self) -> None:
+    def __init__(self, registry: generator.Registry=None) -> None:
         '''Initialize option parser'''
         # Define proxy types
         self.proxy_types = [
@@ -17,16 +37,16 @@ class Options:
             ["ps1", "PowerShell"],
             ["js", "Nodejs"]
         ]
-        # Define stager paths
-        self.stagers = os.path.join(os.path.dirname(__file__), "stagers")
-        self.http_stagers = os.path.join(self.stagers, "http")
-        self.tcp_stagers = os.path.join(self.stagers, "tcp")
-        self.prompt_stagers = os.path.join(self.stagers, "prompt")
-        # Build argument parser
+        # Stager names come from the template index, not the directories
+        self.registry = registry or generator.Registry(
+            os.path.dirname(os.path.abspath(__file__))
+        )
+        # Build argument parser, only the branch in use gets its arguments
         parser = argparse.ArgumentParser(
             description="A TCP proxy payload generator for offensive security."
         )
         subparsers = parser.add_subparsers(
+            action=LazySubParsers,
             dest="type",
             metavar="TYPE",
             required=True,
@@ -34,22 +54,26 @@ class Options:
         )
         self._add_bind_args(subparsers)
         self._add_reverse_args(subparsers)
+        self._add_batch_args(subparsers)
         self.args = parser.parse_args()
 
     def _add_bind_args(self, subparsers) -> None:
         '''Parse arguments for a TCP Bind proxy'''
-        bind = subparsers.add_parser(
+        subparsers.add_lazy_parser(
             "bind",
+            self._bind_args,
             help="Create a TCP proxy on the target host "
             "by binding a listener.",
             formatter_class=argparse.RawTextHelpFormatter
         )
+
+    def _bind_args(self, bind) -> None:
+        '''Add the options of a TCP Bind proxy'''
         bind.add_argument(
             "--lhost",
             type=str,
             required=False,
-            default="0.0.0.0",
-            help="The host interface to bind a proxy port.\n(Default: 0.0.0.0)"
+            help="The host interface to bind a proxy port.\n(Default: %(default)s)"
         )
         bind.add_argument(
             "--lport",
@@ -69,8 +93,40 @@ class Options:
             required=True,
             help="The target port of the proxied traffic.\n "
         )
+        bind.add_argument(
+            "--workers",
+            type=str,
+            required=False,
+            help="Worker processes sharing the proxy port with SO_REUSEPORT.\n"
+            "Python proxy only. (Default: %(default)s)"
+        )
+        bind.add_argument(
+            "--connect-timeout",
+            type=str,
+            required=False,
+            help="Seconds to reach the target before giving up\n"
+            "Python proxy only. (Default: %(default)s)"
+        )
+        bind.add_argument(
+            "--stats",
+            type=str,
+            required=False,
+            metavar="FILE",
+            help="Append JSON-lines stats records to FILE\n"
+            "SIGUSR1 dumps open sessions too. Python proxy only"
+        )
+        bind.add_argument(
+            "--stats-interval",
+            type=str,
+            required=False,
+            help="Seconds between stats records\n"
+            "(Default: %(default)s)\n "
+        )
+        # Defaults are shared with the generator API
+        bind.set_defaults(**generator.Generator.DEFAULTS["bind"])
         # Add subparsers for each code family
         proxies = bind.add_subparsers(
+            action=LazySubParsers,
             dest="lang",
             metavar="LANGUAGE",
             required=True,
@@ -78,32 +134,163 @@ class Options:
         )
         self._add_proxy_types(proxies)
 
+    def _forward(self, value: str) -> tuple:
+        '''Parse a LPORT=RHOST:RPORT forward mapping'''
+        try:
+            lport, target = value.split("=", 1)
+            rhost, rport = target.rsplit(":", 1)
+            rhost = rhost.strip("[]")
+            if not rhost:
+                raise ValueError
+            return (int(lport), rhost, int(rport))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"invalid forward '{value}', expected LPORT=RHOST:RPORT"
+            )
+
+    def _target(self, value: str) -> tuple:
+        '''Parse a RHOST:RPORT batch target'''
+        try:
+            rhost, rport = value.rsplit(":", 1)
+            rhost = rhost.strip("[]")
+            if not rhost:
+                raise ValueError
+            return (rhost, int(rport))
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"invalid target '{value}', expected RHOST:RPORT"
+            )
+
+    def _add_batch_args(self, subparsers) -> None:
+        '''Add arguments for writing many payloads at once'''
+        subparsers.add_lazy_parser(
+            "batch",
+            self._batch_args,
+            help="Write every combination of proxy types, languages, "
+            "deliveries and targets to a directory.",
+            formatter_class=argparse.RawTextHelpFormatter
+        )
+
+    def _batch_args(self, batch) -> None:
+        '''Add the options of a batch build'''
+        batch.add_argument(
+            "--outdir",
+            type=str,
+            required=True,
+            help="Directory for the payloads and manifest.json."
+        )
+        batch.add_argument(
+            "--target",
+            dest="targets",
+            type=self._target,
+            action="append",
+            required=True,
+            metavar="RHOST:RPORT",
+            help="Target of the proxied traffic, repeat for more targets."
+        )
+        batch.add_argument(
+            "--types",
+            nargs="+",
+            choices=["bind", "reverse"],
+            default=["bind", "reverse"],
+            help="Proxy types to write. (Default: both)"
+        )
+        batch.add_argument(
+            "--langs",
+            nargs="+",
+            choices=[ext for ext, name in self.proxy_types],
+            default=[ext for ext, name in self.proxy_types],
+            help="Proxy languages to write. (Default: all)"
+        )
+        batch.add_argument(
+            "--deliveries",
+            nargs="+",
+            choices=["file", "http", "tcp", "prompt"],
+            default=["file"],
+            help="Delivery methods, each with every stager for the language\n"
+            "(Default: file)"
+        )
+        batch.add_argument(
+            "--lhost",
+            type=str,
+            required=False,
+            help="Bind proxy interface or client local interface."
+        )
+        batch.add_argument(
+            "--lport",
+            type=str,
+            required=False,
+            help="Bind proxy port or client local port\n"
+            "Required for bind proxies."
+        )
+        batch.add_argument(
+            "--chost",
+            type=str,
+            required=False,
+            help="Client IP for reverse proxies\n"
+            "Required for reverse proxies."
+        )
+        batch.add_argument(
+            "--cport",
+            type=str,
+            required=False,
+            help="Client port for reverse proxies. "
+            f"(Default: {generator.Generator.DEFAULTS['reverse']['cport']})"
+        )
+        batch.add_argument(
+            "--server-ip",
+            type=str,
+            required=False,
+            help="Staging server IP, required for http and tcp deliveries."
+        )
+        batch.add_argument(
+            "--server-port",
+            type=str,
+            required=False,
+            help="Staging server port, required for http and tcp deliveries."
+        )
+        batch.add_argument(
+            "--jobs",
+            type=int,
+            required=False,
+            default=None,
+            help="Payloads written in parallel. (Default: CPU count + 4)"
+        )
+
     def _add_proxy_types(self, proxies) -> None:
         '''Add parsers for each proxy scripting language'''
         for ext, name in self.proxy_types:
-            lang=proxies.add_parser(
+            proxies.add_lazy_parser(
                 f"{ext}",
+                lambda lang, ext=ext, name=name: self._add_deliveries(lang, name, ext),
                 help=f"{name} proxy and stagers."
             )
-            # Add subparsers for delivery methods
-            delivery = lang.add_subparsers(
-                dest="delivery",
-                metavar="DELIVERY",
-                required=True,
-                help="Delivery method."
-            )
-            self._add_file_delivery_args(delivery, name)
-            self._add_http_delivery_args(delivery, name, ext)
-            self._add_tcp_delivery_args(delivery, name, ext)
-            self._add_prompt_delivery_args(delivery, name, ext)
+
+    def _add_deliveries(self, lang, name, ext) -> None:
+        '''Add parsers for each delivery method of a language'''
+        delivery = lang.add_subparsers(
+            action=LazySubParsers,
+            dest="delivery",
+            metavar="DELIVERY",
+            required=True,
+            help="Delivery method."
+        )
+        self._add_file_delivery_args(delivery, name)
+        self._add_http_delivery_args(delivery, name, ext)
+        self._add_tcp_delivery_args(delivery, name, ext)
+        self._add_prompt_delivery_args(delivery, name, ext)
 
     def _add_file_delivery_args(self, delivery, name) -> None:
         '''Add arguments for file delivery'''
-        file = delivery.add_parser(
+        delivery.add_lazy_parser(
             "file",
+            self._file_args,
             help=f"Deliver the {name} proxy manually as a file.",
             formatter_class=argparse.RawTextHelpFormatter
         )
+
+    def _file_args(self, file) -> None:
+        '''Add the options of file delivery'''
         file.add_argument(
             "--outfile",
             type=str,
@@ -113,11 +300,15 @@ class Options:
 
     def _add_http_delivery_args(self, delivery, name, ext) -> None:
         '''Add arguments for HTTP delivery'''
-        http = delivery.add_parser(
+        delivery.add_lazy_parser(
             "http",
+            lambda http: self._http_args(http, ext),
             help=f"Deliver the {name} proxy by executing a "
             f"{name} one-liner HTTP stager."
         )
+
+    def _http_args(self, http, ext) -> None:
+        '''Add the options of HTTP delivery'''
         http.add_argument(
             "--server-ip",
             type=str,
@@ -130,12 +321,11 @@ class Options:
             required=True,
             help="The port of the HTTP server."
         )
-        h = os.listdir(self.http_stagers)
         http.add_argument(
             "--stager",
             type=str,
             required=True,
-            choices=[i.replace(f".{ext}","") for i in h if i.endswith(ext)],
+            choices=self.registry.stagers("http", ext),
             help="Choose an HTTP stager."
         )
         http.add_argument(
@@ -144,14 +334,24 @@ class Options:
             required=True,
             help="The path to the output file to serve via HTTP."
         )
+        http.add_argument(
+            "--serve",
+            action="store_true",
+            help="Serve the proxy with the built-in staging server "
+            "instead of python3 -m http.server."
+        )
 
     def _add_tcp_delivery_args(self, delivery, name, ext) -> None:
         '''Add arguments for tcp payload delivery'''
-        tcp = delivery.add_parser(
+        delivery.add_lazy_parser(
             "tcp",
+            lambda tcp: self._tcp_args(tcp, ext),
             help=f"Deliver the {name} proxy by executing a "
             f"{name} one-liner TCP stager."
         )
+
+    def _tcp_args(self, tcp, ext) -> None:
+        '''Add the options of tcp payload delivery'''
         tcp.add_argument(
             "--server-ip",
             type=str,
@@ -164,12 +364,11 @@ class Options:
             required=True,
             help="The port of the TCP server."
         )
-        t = os.listdir(self.tcp_stagers)
         tcp.add_argument(
             "--stager",
             type=str,
             required=True,
-            choices=[i.replace(f".{ext}","") for i in t if i.endswith(ext)],
+            choices=self.registry.stagers("tcp", ext),
             help="Choose a TCP stager."
         )
         tcp.add_argument(
@@ -178,48 +377,59 @@ class Options:
             required=True,
             help="The path to the output file to serve via TCP."
         )
+        tcp.add_argument(
+            "--serve",
+            action="store_true",
+            help="Serve the proxy with the built-in staging server "
+            "instead of nc."
+        )
 
     def _add_prompt_delivery_args(self, delivery, name, ext) -> None:
         '''Add arguments for stdin user prompt payload delivery'''
-        prmpt = delivery.add_parser(
+        delivery.add_lazy_parser(
             "prompt",
+            lambda prmpt: self._prompt_args(prmpt, ext),
             help=f"Deliver the {name} proxy by executing a {name} one-liner "
             "that prompts the user for the full payload."
         )
-        p = os.listdir(self.prompt_stagers)
+
+    def _prompt_args(self, prmpt, ext) -> None:
+        '''Add the options of stdin user prompt payload delivery'''
         prmpt.add_argument(
             "--stager",
             type=str,
             required=True,
-            choices=[i.replace(f".{ext}","") for i in p if i.endswith(ext)],
+            choices=self.registry.stagers("prompt", ext),
             help="Choose a prompt stager."
         )
 
     def _add_reverse_args(self, subparsers) -> None:
         '''Add arguments for reverse TCP proxy'''
-        reverse = subparsers.add_parser(
+        subparsers.add_lazy_parser(
             "reverse",
+            self._reverse_args,
             help="Create a TCP proxy on the target host by creating a reverse "
             "TCP connection to a client on the attacker machine.",
             formatter_class=argparse.RawTextHelpFormatter
         )
+
+    def _reverse_args(self, reverse) -> None:
+        '''Add the options of a reverse TCP proxy'''
         reverse.add_argument(
             "--lhost",
             type=str,
             required=False,
-            default="127.0.0.1",
             help="Client interface for forwarding traffic\n"
             "TCP traffic forwarded through the proxy via this interface\n"
-            "(Default: 127.0.0.1)"
+            "(Default: %(default)s)"
         )
         reverse.add_argument(
             "--lport",
             type=str,
             required=False,
-            default="3128",
             help="Client port for forwarding traffic\n"
             "TCP traffic forwarded through the proxy via this port\n"
-            "(Default: 3128)"
+            "(Default: %(default)s)"
         )
         reverse.add_argument(
             "--chost",
@@ -232,10 +442,9 @@ class Options:
             "--cport",
             type=str,
             required=False,
-            default="4321",
             help="Reverse TCP proxy listener port\n"
             "The proxy connects to the client on this port\n"
-            "(Default: 4321)"
+            "(Default: %(default)s)"
         )
         reverse.add_argument(
             "--rhost",
@@ -249,8 +458,116 @@ class Options:
             required=True,
             help="The target port of the proxied traffic."
         )
+        reverse.add_argument(
+            "--pool-size",
+            type=str,
+            required=False,
+            help="Connections to the target kept open ahead of use\n"
+            "Python proxy only. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--pool-idle",
+            type=str,
+            required=False,
+            help="Seconds before an unused pooled connection is replaced\n"
+            "(Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--compress",
+            action="store_const",
+            const=True,
+            help="Compress tunnel data frames when it saves bytes\n"
+            "Python proxy and client only, for slow links"
+        )
+        reverse.add_argument(
+            "--streams",
+            type=str,
+            required=False,
+            help="Connections the tunnel is striped over\n"
+            "Python proxy and client only, for lossy or distant links\n"
+            "(Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--connect-timeout",
+            type=str,
+            required=False,
+            help="Seconds to reach the client or a target before giving up\n"
+            "Python proxy only. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--stats",
+            type=str,
+            required=False,
+            metavar="FILE",
+            help="Append JSON-lines stats records to FILE\n"
+            "SIGUSR1 dumps open sessions too. Python proxy and client only"
+        )
+        reverse.add_argument(
+            "--stats-interval",
+            type=str,
+            required=False,
+            help="Seconds between stats records and tunnel pings\n"
+            "(Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--heartbeat",
+            type=str,
+            required=False,
+            help="Idle seconds between tunnel heartbeats, 0 disables them\n"
+            "A tunnel silent for three heartbeats is dropped\n"
+            "Python proxy and client only. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--reconnect",
+            type=str,
+            required=False,
+            help="Seconds the proxy keeps reconnecting to a lost client\n"
+            "0 exits on the first loss. Python proxy only. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--rate",
+            type=str,
+            required=False,
+            help="KiB/s each side of the tunnel sends at most, 0 for no limit\n"
+            "Interactive sessions go first. Python proxy and client only\n"
+            "(Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--session-rate",
+            type=str,
+            required=False,
+            help="KiB/s each session sends at most per side, 0 for no limit\n"
+            "Python proxy and client only. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--control",
+            type=str,
+            required=False,
+            metavar="PORT",
+            help="Loopback port where the client takes rate commands\n"
+            "at runtime, 0 for none. (Default: %(default)s)"
+        )
+        reverse.add_argument(
+            "--socks",
+            action="store_const",
+            const=True,
+            help="Make the client's local port a SOCKS5 listener\n"
+            "Each connection names its own target. Python proxy only"
+        )
+        reverse.add_argument(
+            "--forward",
+            dest="forwards",
+            type=self._forward,
+            action="append",
+            metavar="LPORT=RHOST:RPORT",
+            help="Also forward client port LPORT to RHOST:RPORT\n"
+            "Repeat for more targets over the same tunnel. Python proxy only"
+        )
+        # Defaults are shared with the generator API
+        reverse.set_defaults(**generator.Generator.DEFAULTS["reverse"])
         # Add subparsers for each code family
         proxies = reverse.add_subparsers(
+            action=LazySubParsers,
             dest="lang",
             metavar="LANGUAGE",
             required=True,
@@ -1,15 +1,18 @@
 const net = require("net")
+const { pipeline } = require("stream")
 
 class BindProxy {
 
-    constructor(lhost, lport, rhost, rport, verbose=true) {
+    constructor(lhost, lport, rhost, rport, verbose=true, high_water=262144, no_delay=true) {
         // Initialize TCP proxy
         this.lhost = lhost;
         this.lport = lport;
         this.rhost = rhost;
         this.rport = rport;
-        this.data_size = 4096;
+        this.high_water = high_water; // Bytes buffered per direction before reads pause
+        this.no_delay = no_delay;
         this.verbose = verbose;
+        this.conns = new Set(); // Counters for each proxied connection
     }
 
     start() {
@@ -24,46 +27,87 @@ class BindProxy {
         });
     }
 
-    _connect(client_sock) {
-        const s = new net.Socket();
-        s.connect({ port: this.rport, host: this.rhost }, () => {
+    _relay(client_sock) {
+        // Pipe both directions with backpressure and half-close
+        const server_sock = this._connect();
+        const conn = {
+            client: client_sock,
+            server: server_sock,
+            up: 0, // bytes from client to server
+            down: 0, // bytes from server to client
+            buffered: 0, // bytes written but not yet taken by the kernel
+            peak: 0,
+            done: 0
+        };
+        this.conns.add(conn);
+        const finish = (err) => {
+            if (err) {
+                client_sock.destroy();
+                server_sock.destroy();
+            }
+            conn.done += 1;
+            if (conn.done < 2) {
+                // The other direction may still be flowing
+                return;
+            }
+            client_sock.destroy();
+            server_sock.destroy();
+            this.conns.delete(conn);
             if (this.verbose) {
-                console.log(`Connected to remote host on ${this.rhost}:${this.rport}`);
+                console.log(`Proxied connection closed! ${conn.up} bytes up, ` +
+                    `${conn.down} bytes down, ${conn.peak} bytes peak buffered`);
             }
+        };
+        // Ending one side only shuts down the write side of the other
+        pipeline(client_sock, server_sock, finish);
+        pipeline(server_sock, client_sock, finish);
+        client_sock.on("data", (chunk) => {
+            conn.up += chunk.length;
+            this._buffered(conn);
         });
-        // Socket recv
-        s.on("data", (data) => {
-            client_sock.write(data);
+        server_sock.on("data", (chunk) => {
+            conn.down += chunk.length;
+            this._buffered(conn);
         });
-        // Socket close
-        s.on("end", () => {
-            client_sock.end();
+    }
+
+    _buffered(conn) {
+        // Track the bytes waiting in both write buffers
+        conn.buffered = conn.client.writableLength + conn.server.writableLength;
+        if (conn.buffered > conn.peak) {
+            conn.peak = conn.buffered;
+        }
+    }
+
+    _connect() {
+        // Connect to the remote server
+        const s = new net.Socket({
+            allowHalfOpen: true,
+            readableHighWaterMark: this.high_water,
+            writableHighWaterMark: this.high_water
+        });
+        s.connect({ port: this.rport, host: this.rhost }, () => {
+            s.setNoDelay(this.no_delay);
+            if (this.verbose) {
+                console.log(`Connected to remote host on ${this.rhost}:${this.rport}`);
+            }
         });
         return s;
     }
 
     _bind() {
         // Bind a TCP socket listener
-        const server = net.createServer((client_sock) => {
-            // Connect to the remote server
+        const server = net.createServer({
+            allowHalfOpen: true,
+            highWaterMark: this.high_water
+        }, (client_sock) => {
             const ip = client_sock.remoteAddress;
             const port = client_sock.remotePort;
             if (this.verbose){
                 console.log(`Connection received from ${ip}:${port}`);
             }
-            // Connect to remote server
-            const server_sock = this._connect(client_sock);
-            // Handle socket recv
-            client_sock.on("data", (data) => {
-                server_sock.write(data);
-            });
-            // Socket close
-            client_sock.on("end", () => {
-                server_sock.end();
-                if (this.verbose) {
-                    console.log(`Proxied connection closed!`);
-                }
-            });
+            client_sock.setNoDelay(this.no_delay);
+            this._relay(client_sock);
         });
         return server;
     }
@@ -5,6 +5,7 @@ class BindProxy {
     private $rport;
     private $data_size;
     private $verbose;
+    private $conns;
 
     public function __construct($lhost, $lport, $rhost, $rport, $verbose=true) {
         $this->lhost = $lhost;
@@ -12,7 +13,8 @@ class BindProxy {
         $this->rhost = $rhost;
         $this->rport = $rport;
         $this->verbose = $verbose;
-        $this->data_size = 4096;
+        $this->data_size = 65536;
+        $this->conns = array(); # socket id -> relay state
     }
 
     public function start() {
@@ -20,130 +22,204 @@ class BindProxy {
         $s = $this->_bind();
         if ($s) {
             socket_listen($s, 25);
+            socket_set_nonblock($s);
             if ($this->verbose) {
                 echo "Listening on {$this->lhost}:{$this->lport}\n";
             }
             while (true) {
-                try {
-                    $conn = socket_accept($s);
-                    if ($this->verbose) {
-                        socket_getpeername($conn, $ip, $port);
-                        echo "Connection received from {$ip}:{$port}\n";
+                $read = array($s);
+                $write = array();
+                $except = array();
+                foreach ($this->conns as $id => $st) {
+                    if ($st["connecting"]) {
+                        # Windows reports a failed connect as an exception
+                        $write[] = $st["sock"];
+                        $except[] = $st["sock"];
+                        continue;
+                    }
+                    $peer = $this->conns[$st["peer"]];
+                    if ($st["pend"] !== "") {
+                        $write[] = $st["sock"];
+                    }
+                    # Stop reading while the peer still has bytes to write
+                    if (!$st["eof"] && $peer["pend"] === "" && !$peer["connecting"]) {
+                        $read[] = $st["sock"];
                     }
-                    $this->_switch($conn);
                 }
-                catch (Excception $e) {
+                # Block until a socket is ready, no polling while idle
+                if (@socket_select($read, $write, $except, null) === false) {
                     break;
                 }
-            }
-        }
-    }
-
-    private function _switch($client_sock) {
-        # Switch between read/write
-        $server_sock = $this->_connect();
-        if ($client_sock and $server_sock) {
-            socket_set_nonblock($client_sock);
-            socket_set_nonblock($server_sock);
-            $client_read = true;
-            while (true) {
-                # Recv from client
-                if ($client_read) {
-                    $data = "";
-                    $bytes_received = socket_recv($client_sock, $data, $this->data_size, 0);
-                    if ($bytes_received === false) {
-                        $error_code = socket_last_error($client_sock);
-                        if ($error_code == SOCKET_EAGAIN || $error_code == SOCKET_EWOULDBLOCK) {
-                            $client_read = false;
-                            usleep(5000);
-                        }
-                        else {
-                            break;
-                        }
-                    }
-                    elseif ($bytes_received === 0) {
-                        # Client gracefully closed the connection
-                        break;
-                    }
-                    else {
-                        $this->_socket_sendall($server_sock, $data);
+                foreach ($except as $sock) {
+                    if (isset($this->conns[$this->_id($sock)])) {
+                        $this->_close($this->_id($sock));
                     }
                 }
-                # Recv from server
-                if (!$client_read) {
-                    $data = "";
-                    $bytes_received = socket_recv($server_sock, $data, $this->data_size, 0);
-                    if ($bytes_received === false) {
-                        $error_code = socket_last_error($server_sock);
-                        if ($error_code == SOCKET_EAGAIN || $error_code == SOCKET_EWOULDBLOCK) {
-                            $client_read = true;
-                            usleep(5000);
+                foreach ($write as $sock) {
+                    $id = $this->_id($sock);
+                    if (isset($this->conns[$id])) {
+                        if ($this->conns[$id]["connecting"]) {
+                            $this->_connected($id);
                         }
                         else {
-                            break;
+                            $this->_flush($id);
                         }
                     }
-                    elseif ($bytes_received === 0) {
-                        # Server gracefully closed the connection
-                        break;
+                }
+                foreach ($read as $sock) {
+                    $id = $this->_id($sock);
+                    if ($sock === $s) {
+                        $this->_accept($s);
                     }
-                    else {
-                        $this->_socket_sendall($client_sock, $data);
+                    elseif (isset($this->conns[$id])) {
+                        $this->_relay($id);
                     }
                 }
             }
-            # Close the sockets if any are still open
-            $this->_close($client_sock, $server_sock);
         }
     }
 
-    private function _socket_sendall($sock, $data) {
-        $bytes_sent = 0;
-        $total_bytes = strlen($data);
-        while ($bytes_sent < $total_bytes) {
-            $sent = socket_write($sock, substr($data, $bytes_sent), $total_bytes - $bytes_sent);
-            $bytes_sent += $sent;
+    private function _accept($s) {
+        # Accept a client and start connecting to the server
+        $conn = @socket_accept($s);
+        if (!$conn) {
+            return;
         }
+        if ($this->verbose) {
+            socket_getpeername($conn, $ip, $port);
+            echo "Connection received from {$ip}:{$port}\n";
+        }
+        socket_set_nonblock($conn);
+        socket_set_option($conn, SOL_TCP, TCP_NODELAY, 1);
+        $server_sock = $this->_connect();
+        if (!$server_sock) {
+            socket_close($conn);
+            if ($this->verbose) {
+                echo "Proxied connection closed!\n";
+            }
+            return;
+        }
+        $cid = $this->_id($conn);
+        $sid = $this->_id($server_sock);
+        $this->conns[$cid] = $this->_state($conn, $sid);
+        $this->conns[$sid] = $this->_state($server_sock, $cid);
+        $this->conns[$sid]["connecting"] = true;
     }
 
-    private function _close($client, $server) {
-        # Close client and server sockets
-        # Close client
-        try {
-            socket_close($client);
+    private function _connected($id) {
+        # Finish a non-blocking connect to the server
+        $sock = $this->conns[$id]["sock"];
+        if (socket_get_option($sock, SOL_SOCKET, SO_ERROR)) {
+            $this->_close($id);
+            return;
         }
-        catch (Exception $e) {}
-        # Close server
-        try {
-            socket_close($server);
+        $this->conns[$id]["connecting"] = false;
+        socket_set_option($sock, SOL_TCP, TCP_NODELAY, 1);
+        if ($this->verbose) {
+            echo "Connected to remote host on {$this->rhost}:{$this->rport}\n";
+        }
+    }
+
+    private function _relay($id) {
+        # Read from one socket and write to its peer
+        $data = "";
+        $bytes_received = @socket_recv($this->conns[$id]["sock"], $data, $this->data_size, 0);
+        if ($bytes_received === false) {
+            if (!$this->_would_block($this->conns[$id]["sock"])) {
+                $this->_close($id);
+            }
+            return;
+        }
+        $pid = $this->conns[$id]["peer"];
+        if ($bytes_received === 0) {
+            # Half-close: forward EOF once the peer has written everything
+            $this->conns[$id]["eof"] = true;
+            $this->_finish($pid);
+            return;
+        }
+        $this->conns[$pid]["pend"] = $data;
+        $this->_flush($pid);
+    }
+
+    private function _flush($id) {
+        # Write pending bytes to a socket
+        $sock = $this->conns[$id]["sock"];
+        $sent = @socket_write($sock, $this->conns[$id]["pend"]);
+        if ($sent === false) {
+            if (!$this->_would_block($sock)) {
+                $this->_close($id);
+            }
+            return;
+        }
+        $this->conns[$id]["pend"] = (string)substr($this->conns[$id]["pend"], $sent);
+        if ($this->conns[$id]["pend"] === "") {
+            $this->_finish($id);
+        }
+    }
+
+    private function _finish($id) {
+        # Shut down a socket's write side after its peer hit EOF
+        $st = $this->conns[$id];
+        $peer = $this->conns[$st["peer"]];
+        if ($peer["eof"] && $st["pend"] === "" && !$st["shut"]) {
+            $this->conns[$id]["shut"] = true;
+            @socket_shutdown($st["sock"], 1);
+        }
+        if ($st["eof"] && $peer["eof"] && $st["pend"] === "" && $peer["pend"] === "") {
+            $this->_close($id);
+        }
+    }
+
+    private function _state($sock, $peer) {
+        # Relay state for one socket
+        return array(
+            "sock" => $sock,
+            "peer" => $peer, # id of the socket this one relays to
+            "pend" => "", # bytes waiting to be written to this socket
+            "eof" => false, # this socket sent EOF
+            "shut" => false, # EOF forwarded to this socket
+            "connecting" => false
+        );
+    }
+
+    private function _would_block($sock) {
+        # Check whether the last socket error just means try again
+        $error_code = socket_last_error($sock);
+        socket_clear_error($sock);
+        return in_array($error_code, array(SOCKET_EAGAIN, SOCKET_EWOULDBLOCK, SOCKET_EINPROGRESS));
+    }
+
+    private function _id($sock) {
+        # Sockets are objects in PHP 8 and resources before
+        return is_object($sock) ? spl_object_id($sock) : (int)$sock;
+    }
+
+    private function _close($id) {
+        # Close a socket and its peer
+        $pid = $this->conns[$id]["peer"];
+        foreach (array($id, $pid) as $i) {
+            if (isset($this->conns[$i])) {
+                @socket_close($this->conns[$i]["sock"]);
+                unset($this->conns[$i]);
+            }
         }
-        catch (Exception $e) {}
         if ($this->verbose) {
             echo "Proxied connection closed!\n";
         }
     }
 
     private function _connect() {
-        # Connect to the server
-        try {
-            $s = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
-            # Set indefinite timeouts
-            socket_set_option($s, SOL_SOCKET, SO_RCVTIMEO, ['sec' => 0, 'usec' => 0]);
-            socket_set_option($s, SOL_SOCKET, SO_SNDTIMEO, ['sec' => 0, 'usec' => 0]);
-            $result = socket_connect($s, $this->rhost, $this->rport);
-            if ($result) {
-                if ($this->verbose) {
-                    echo "Connected to remote host on {$this->rhost}:{$this->rport}\n";
-                }
-                return $s;
-            }
-            else {
-                return NULL;
-            }
+        # Start a non-blocking connection to the server
+        $s = @socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
+        if (!$s) {
+            return NULL;
         }
-        catch (Exception $e) {
+        socket_set_nonblock($s);
+        if (!@socket_connect($s, $this->rhost, $this->rport) && !$this->_would_block($s)) {
+            socket_close($s);
             return NULL;
         }
+        return $s;
     }
 
     private function _bind() {
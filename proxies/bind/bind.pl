@@ -1,126 +1,200 @@
 #! /usr/bin/perl
 
-use Time::HiRes qw(sleep);
+use IO::Select;
 use IO::Socket::INET;
+use Socket qw(SOL_SOCKET SO_ERROR IPPROTO_TCP TCP_NODELAY);
 
 # Initialize Values
 $lhost = "{{LHOST}}";
 $lport = {{LPORT}};
 $rhost = "{{RHOST}}";
 $rport = {{RPORT}};
-$data_size = 4096;
+$min_read = 4096; # Read sizes adapt between these bounds
+$max_read = 262144;
 $verbose = 1;
-$client_read = 1;
+%conns = (); # fileno -> relay state
 
 sub start {
     # Start proxy
     my $s = _bind();
+    $s->blocking(0);
     if ($verbose) {
         print "Listening on $lhost:$lport\n";
     }
     while (1) {
-        my $conn = $s->accept();
-        if ($verbose) {
-            my $ip = $conn->peerhost();
-            my $port = $conn->peerport();
-            print "Connection received from $ip:$port\n";
-        }
-        _switch($conn);
-    }
-}
-
-sub _switch {
-    # Switch between read/write
-    my $client_sock = $_[0];
-    $client_sock->blocking(0); # Non-blocking
-    my $server_sock = _connect();
-    $server_sock->blocking(0); # Non-blocking
-    my $received;
-    while (1) {
-        # Read from client
-        if ($client_read) {
-            $received = _recv($client_sock);
-            if (!defined($received)) {
-                last;
+        my $rsel = IO::Select->new($s);
+        my $wsel = IO::Select->new();
+        foreach my $st (values %conns) {
+            my $peer = $conns{$st->{peer}};
+            if ($st->{connecting} or length($st->{pend})) {
+                $wsel->add($st->{sock});
             }
-            elsif ($received) {
-                _sendall($server_sock, $received);
+            # Stop reading while the peer still has bytes to write
+            if (!$st->{connecting} and !$st->{eof} and !length($peer->{pend}) and !$peer->{connecting}) {
+                $rsel->add($st->{sock});
+            }
+        }
+        # Block until a socket is ready, no polling while idle
+        my ($readable, $writable) = IO::Select->select($rsel, $wsel, undef);
+        foreach my $sock (@$writable) {
+            my $fd = fileno($sock);
+            next unless (defined($fd) and $conns{$fd} and $conns{$fd}->{sock} == $sock);
+            if ($conns{$fd}->{connecting}) {
+                _connected($fd);
             }
             else {
-                $client_read = 0;
-                sleep(0.005);
+                _flush($fd);
             }
         }
-        # Read from server
-        if (!$client_read) {
-            $received = _recv($server_sock);
-            if (!defined($received)) {
-                last;
+        foreach my $sock (@$readable) {
+            if ($sock == $s) {
+                _accept($s);
+                next;
             }
-            elsif ($received) {
-                _sendall($client_sock, $received);
-            }
-            else {
-                $client_read = 1;
-                sleep(0.005);
+            my $fd = fileno($sock);
+            next unless (defined($fd) and $conns{$fd} and $conns{$fd}->{sock} == $sock);
+            _relay($fd);
+        }
+    }
+}
+
+sub _accept {
+    # Accept waiting clients and start connecting to the server
+    my $s = $_[0];
+    while (my $conn = $s->accept()) {
+        if ($verbose) {
+            my $ip = $conn->peerhost();
+            my $port = $conn->peerport();
+            print "Connection received from $ip:$port\n";
+        }
+        $conn->blocking(0);
+        setsockopt($conn, IPPROTO_TCP, TCP_NODELAY, 1);
+        my $server_sock = _connect();
+        if (!$server_sock) {
+            $conn->close();
+            if ($verbose) {
+                print "Proxied connection closed!\n";
             }
+            next;
         }
+        $conns{fileno($conn)} = _state($conn, fileno($server_sock));
+        $conns{fileno($server_sock)} = _state($server_sock, fileno($conn));
+        $conns{fileno($server_sock)}->{connecting} = 1;
     }
-    # Close the sockets if not already closed
-    _close($client_sock, $server_sock);
 }
 
-sub _recv {
-    # Receive bytes
-    my $recv_sock = $_[0];
+sub _connected {
+    # Finish a non-blocking connect to the server
+    my $fd = $_[0];
+    my $sock = $conns{$fd}->{sock};
+    if ($sock->sockopt(SO_ERROR)) {
+        _close($fd);
+        return;
+    }
+    $conns{$fd}->{connecting} = 0;
+    setsockopt($sock, IPPROTO_TCP, TCP_NODELAY, 1);
+    if ($verbose) {
+        print "Connected to remote host on $rhost:$rport\n";
+    }
+}
+
+sub _relay {
+    # Read from one socket and write to its peer
+    my $fd = $_[0];
+    my $st = $conns{$fd};
     my $data = "";
-    my $bytes_read;
-    if (defined($bytes_read = $recv_sock->recv($data, $data_size))) {
-        if (!$bytes_read and !$data) {
-            # Client disconnected gracefully
-            return undef;
+    my $bytes_read = sysread($st->{sock}, $data, $st->{rsize});
+    if (!defined($bytes_read)) {
+        if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+            _close($fd);
         }
-        return $data;
+        return;
     }
-    return "";
+    if ($bytes_read == 0) {
+        # Half-close: forward EOF once the peer has written everything
+        $st->{eof} = 1;
+        _finish($st->{peer});
+        return;
+    }
+    # Grow reads while they fill the buffer, shrink them for small messages
+    if ($bytes_read == $st->{rsize} and $st->{rsize} < $max_read) {
+        $st->{rsize} *= 2;
+    }
+    elsif ($bytes_read < $st->{rsize} / 4 and $st->{rsize} > $min_read) {
+        $st->{rsize} /= 2;
+    }
+    $conns{$st->{peer}}->{pend} = $data;
+    _flush($st->{peer});
 }
 
-sub _sendall {
-    my $sock = $_[0];
-    my $data_to_send = $_[1];
-    my $total_sent = 0;
-    my $data_length = length($data_to_send);
-    while ($total_sent < $data_length) {
-        my $bytes_sent = $sock->send(substr($data_to_send, $total_sent), 0);
-        if (!defined $bytes_sent) {
-            die "Error sending data: $!";
+sub _flush {
+    # Write pending bytes to a socket
+    my $fd = $_[0];
+    my $st = $conns{$fd};
+    my $sent = syswrite($st->{sock}, $st->{pend});
+    if (!defined($sent)) {
+        if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+            _close($fd);
         }
-        $total_sent += $bytes_sent;
+        return;
+    }
+    substr($st->{pend}, 0, $sent, "");
+    if (!length($st->{pend})) {
+        _finish($fd);
+    }
+}
+
+sub _finish {
+    # Shut down a socket's write side after its peer hit EOF
+    my $fd = $_[0];
+    my $st = $conns{$fd};
+    my $peer = $conns{$st->{peer}};
+    if ($peer->{eof} and !length($st->{pend}) and !$st->{shut}) {
+        $st->{shut} = 1;
+        $st->{sock}->shutdown(1);
+    }
+    if ($st->{eof} and $peer->{eof} and !length($st->{pend}) and !length($peer->{pend})) {
+        _close($fd);
     }
 }
 
+sub _state {
+    # Relay state for one socket
+    return {
+        sock => $_[0],
+        peer => $_[1], # fileno of the socket this one relays to
+        pend => "", # bytes waiting to be written to this socket
+        eof => 0, # this socket sent EOF
+        shut => 0, # EOF forwarded to this socket
+        connecting => 0,
+        rsize => 16384
+    };
+}
+
 sub _close {
-    # This function is not used in the main flow now but kept for completeness
-    my $client = $_[0];
-    my $server = $_[1];
-    $client->close();
-    $server->close();
+    # Close a socket and its peer
+    my $fd = $_[0];
+    my $peer = $conns{$fd}->{peer};
+    foreach my $f ($fd, $peer) {
+        if ($conns{$f}) {
+            $conns{$f}->{sock}->close();
+            delete $conns{$f};
+        }
+    }
     if ($verbose) {
         print "Proxied connection closed!\n";
     }
 }
 
 sub _connect {
-    # Connect to the server
+    # Start a non-blocking connection to the server
     my $s = new IO::Socket::INET(
         PeerAddr => $rhost,
         PeerPort => $rport,
         Proto    => 'tcp',
         Type     => SOCK_STREAM,
-    ) or die "Failed to connect to $rhost:$rport\n";
-    if ($verbose) {
-        print "Connected to remote host on $rhost:$rport\n";
-    }
+        Blocking => 0,
+    ) or return undef;
     return $s;
 }
 
@@ -129,11 +203,10 @@ sub _bind {
         LocalAddr => $lhost,
         LocalPort => $lport,
         Proto     => 'tcp',
-        Listen    => 25, 
-        ReuseAddr => 1, 
+        Listen    => 25,
+        ReuseAddr => 1,
     ) or die "Cannot bind listener on $lhost:$lport!\n";
     return $s;
 }
 
 start();
-
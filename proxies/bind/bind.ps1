@@ -3,9 +3,10 @@ class BindProxy {
     [int]$lport
     [string]$rhost
     [int]$rport
-    [string]$LastName
     [int]$data_size
     [bool]$verbose
+    [hashtable]$conns
+    [byte[]]$data
 
     # Constructor
     BindProxy([string]$lhost, [int]$lport, [string]$rhost, [int]$rport, [bool]$verbose=$true) {
@@ -15,7 +16,9 @@ class BindProxy {
         $this.rhost = $rhost
         $this.rport = $rport
         $this.verbose = $verbose
-        $this.data_size = 4096
+        $this.data_size = 65536
+        $this.conns = @{} # socket -> relay state
+        $this.data = New-Object byte[] $this.data_size
     }
 
     [void]start() {
@@ -23,173 +26,259 @@ class BindProxy {
         $s = $this._bind()
         if ($s) {
             $s.Start(25) # Listen
+            $listener = $s.Server
             if ($this.verbose) {
                 Write-Host "Listening on $($this.lhost):$($this.lport)"
             }
             try {
                 while ($true) {
-                    if ($s.Pending()) {
-                        $conn = $s.AcceptTcpClient()
+                    $read = New-Object System.Collections.ArrayList
+                    $write = New-Object System.Collections.ArrayList
+                    $errors = New-Object System.Collections.ArrayList
+                    [void]$read.Add($listener)
+                    foreach ($sock in @($this.conns.Keys)) {
+                        $st = $this.conns[$sock]
+                        if ($st.connecting) {
+                            # Windows reports a failed connect as an error
+                            [void]$write.Add($sock)
+                            [void]$errors.Add($sock)
+                            continue
+                        }
+                        $peer = $this.conns[$st.peer]
+                        if ($null -ne $st.pend) {
+                            [void]$write.Add($sock)
+                        }
+                        # Stop reading while the peer still has bytes to write
+                        if (-not $st.eof -and $null -eq $peer.pend -and -not $peer.connecting) {
+                            [void]$read.Add($sock)
+                        }
                     }
-                    else {
-                        Start-Sleep -Milliseconds 100
-                        continue
+                    # Block until a socket is ready, no polling while idle
+                    [System.Net.Sockets.Socket]::Select($read, $write, $errors, -1)
+                    foreach ($sock in $errors) {
+                        if ($this.conns.ContainsKey($sock)) {
+                            $this._close($sock)
+                        }
                     }
-                    if ($this.verbose) {
-                        $hst = $conn.Client.RemoteEndPoint
-                        $ip = $hst.Address.ToString()
-                        $port = $hst.Port
-                        Write-Host "Connection received from $($ip):$($port)"
+                    foreach ($sock in $write) {
+                        if ($this.conns.ContainsKey($sock)) {
+                            if ($this.conns[$sock].connecting) {
+                                $this._connected($sock)
+                            }
+                            else {
+                                $this._flush($sock)
+                            }
+                        }
+                    }
+                    foreach ($sock in $read) {
+                        if ($sock -eq $listener) {
+                            $this._accept($s)
+                        }
+                        elseif ($this.conns.ContainsKey($sock)) {
+                            $this._relay($sock)
+                        }
                     }
-                    $this._switch($conn)
                 }
             }
             catch [System.Management.Automation.RuntimeException] {
                 break
             }
             finally {
+                foreach ($sock in @($this.conns.Keys)) {
+                    if ($this.conns.ContainsKey($sock)) {
+                        $this._close($sock)
+                    }
+                }
                 $s.Stop()
             }
         }
     }
 
-    [void]_switch([System.Net.Sockets.TcpClient]$client) {
-        # Switch between read/write
+    [void]_accept([System.Net.Sockets.TcpListener]$s) {
+        # Accept a client and start connecting to the server
+        $conn = $s.AcceptSocket()
+        if ($this.verbose) {
+            $hst = $conn.RemoteEndPoint
+            $ip = $hst.Address.ToString()
+            $port = $hst.Port
+            Write-Host "Connection received from $($ip):$($port)"
+        }
+        $conn.Blocking = $false
+        $conn.NoDelay = $true
         $server = $this._connect()
-        if ($client -and $server) {
-            # Set sockets to non-blocking
-            $client.Client.Blocking = $false
-            $client_sock = $client.Client
-            $server.Client.Blocking = $false
-            $server_sock = $server.Client
-            # Switching toggle
-            $client_read = $true
-            $data = New-Object byte[] $this.data_size
-            while ($true) {
-                # Recv from client
-                if ($client_read) {
-                    if ($client_sock.Poll(100, [System.Net.Sockets.SelectMode]::SelectRead)) {
-                        $bytes_read = 0
-                        try {
-                            $bytes_read = $client_sock.Receive($data)
-                            if ($bytes_read -gt 0) {
-                                $received_data = $data[0..($bytes_read - 1)]
-                                $this._sendall($server_sock, $received_data)
-                            }
-                            elseif ($bytes_read -eq 0) {
-                                # Peer closed gracefully
-                                break
-                            }
-                        }
-                        catch [System.Net.Sockets.SocketException] {
-                            if ($_.Exception.NativeErrorCode -eq 10035) {
-                                # Socket open but no data available
-                                $client_read = $false
-                                Start-Sleep -Milliseconds 5
-                            }
-                            else {
-                                # Other error
-                                break
-                            }
-                        }
-                        catch {
-                            # Any other exception
-                            break
-                        }
-                    }
-                    else {
-                        $client_read = $false
-                        Start-Sleep -Milliseconds 5
-                    }
-                }
-                # Recv from server
-                if (-not $client_read) {
-                    if ($server_sock.Poll(100, [System.Net.Sockets.SelectMode]::SelectRead)) {
-                        $bytes_read = 0
-                        try {
-                            $bytes_read = $server_sock.Receive($data)
-                            if ($bytes_read -gt 0) {
-                                $received_data = $data[0..($bytes_read - 1)]
-                                $this._sendall($client_sock, $received_data)
-                            }
-                            elseif ($bytes_read -eq 0) {
-                                # Peer closed gracefully
-                                break
-                            }
-                        }
-                        catch [System.Net.Sockets.SocketException] {
-                            if ($_.Exception.NativeErrorCode -eq 10035) {
-                                # Socket open but no data available
-                                $client_read = $true
-                                Start-Sleep -Milliseconds 5
-                            }
-                            else {
-                                # Other error
-                                break
-                            }
-                        }
-                        catch {
-                            # Any other exception
-                            break
-                        }
-                    }
-                    else {
-                        $client_read = $true
-                        Start-Sleep -Milliseconds 5
-                    }
-                }
+        if (-not $server) {
+            $conn.Close()
+            if ($this.verbose) {
+                Write-Host "Proxied connection closed!"
             }
-            # Close the sockets if any are still open
-            $this._close($client, $server)
+            return
         }
+        $this.conns[$conn] = $this._state($server)
+        $this.conns[$server] = $this._state($conn)
+        $this.conns[$server].connecting = $true
     }
 
-    [void]_sendall([System.Net.Sockets.Socket]$sock, [byte[]]$data) {
-        $bytes_sent = 0
-        $total_bytes = $data.Length
+    [void]_connected([System.Net.Sockets.Socket]$sock) {
+        # Finish a non-blocking connect to the server
+        $err = $sock.GetSocketOption(
+            [System.Net.Sockets.SocketOptionLevel]::Socket,
+            [System.Net.Sockets.SocketOptionName]::Error
+        )
+        if ($err -ne 0) {
+            $this._close($sock)
+            return
+        }
+        $this.conns[$sock].connecting = $false
         $sock.NoDelay = $true
-        while ($bytes_sent -lt $total_bytes) {
-            $remaining_bytes = $total_bytes - $bytes_sent
-            $sent = $sock.Send($data, $bytes_sent, $remaining_bytes, [System.Net.Sockets.SocketFlags]::None)
-            $bytes_sent += $sent
+        if ($this.verbose) {
+            Write-Host "Connected to remote host on $($this.rhost):$($this.rport)"
         }
     }
 
-    [void]_close([System.Net.Sockets.TcpClient]$client, [System.Net.Sockets.TcpClient]$server) {
-        # Close client and server sockets
-        # Close client
-        Try {
-            $client.close()
+    [void]_relay([System.Net.Sockets.Socket]$sock) {
+        # Read from one socket and write to its peer
+        $st = $this.conns[$sock]
+        $peer = $st.peer
+        $err = [System.Net.Sockets.SocketError]::Success
+        $n = $sock.Receive($this.data, 0, $this.data_size, [System.Net.Sockets.SocketFlags]::None, [ref]$err)
+        if ($err -eq [System.Net.Sockets.SocketError]::WouldBlock) {
+            return
         }
-        Catch {}
-        # Close server
-        Try {
-            $server.close();
+        if ($err -ne [System.Net.Sockets.SocketError]::Success) {
+            $this._close($sock)
+            return
+        }
+        if ($n -eq 0) {
+            # Half-close: forward EOF once the peer has written everything
+            $st.eof = $true
+            $this._finish($peer)
+            return
+        }
+        $sent = $peer.Send($this.data, 0, $n, [System.Net.Sockets.SocketFlags]::None, [ref]$err)
+        if ($err -eq [System.Net.Sockets.SocketError]::WouldBlock) {
+            $sent = 0
+        }
+        elseif ($err -ne [System.Net.Sockets.SocketError]::Success) {
+            $this._close($sock)
+            return
+        }
+        if ($sent -lt $n) {
+            # Keep the rest until the peer is writable again
+            $rest = New-Object byte[] ($n - $sent)
+            [System.Array]::Copy($this.data, $sent, $rest, 0, $n - $sent)
+            $this.conns[$peer].pend = $rest
+            $this.conns[$peer].poff = 0
+        }
+    }
+
+    [void]_flush([System.Net.Sockets.Socket]$sock) {
+        # Write pending bytes to a socket
+        $st = $this.conns[$sock]
+        $err = [System.Net.Sockets.SocketError]::Success
+        $left = $st.pend.Length - $st.poff
+        $sent = $sock.Send($st.pend, $st.poff, $left, [System.Net.Sockets.SocketFlags]::None, [ref]$err)
+        if ($err -eq [System.Net.Sockets.SocketError]::WouldBlock) {
+            return
+        }
+        if ($err -ne [System.Net.Sockets.SocketError]::Success) {
+            $this._close($sock)
+            return
+        }
+        if ($sent -lt $left) {
+            $st.poff += $sent
+            return
+        }
+        $st.pend = $null
+        $st.poff = 0
+        $this._finish($sock)
+    }
+
+    [void]_finish([System.Net.Sockets.Socket]$sock) {
+        # Shut down a socket's write side after its peer hit EOF
+        $st = $this.conns[$sock]
+        $peer = $this.conns[$st.peer]
+        if ($peer.eof -and $null -eq $st.pend -and -not $st.shut) {
+            $st.shut = $true
+            try {
+                $sock.Shutdown([System.Net.Sockets.SocketShutdown]::Send)
+            }
+            catch {
+                $this._close($sock)
+                return
+            }
+        }
+        if ($st.eof -and $peer.eof -and $null -eq $st.pend -and $null -eq $peer.pend) {
+            $this._close($sock)
+        }
+    }
+
+    [hashtable]_state([System.Net.Sockets.Socket]$peer) {
+        # Relay state for one socket
+        return @{
+            peer = $peer # socket this one relays to
+            pend = $null # bytes waiting to be written to this socket
+            poff = 0
+            eof = $false # this socket sent EOF
+            shut = $false # EOF forwarded to this socket
+            connecting = $false
+        }
+    }
+
+    [void]_close([System.Net.Sockets.Socket]$sock) {
+        # Close a socket and its peer
+        $peer = $this.conns[$sock].peer
+        foreach ($s in @($sock, $peer)) {
+            $this.conns.Remove($s)
+            Try {
+                $s.Close()
+            }
+            Catch {}
         }
-        Catch {}
         if ($this.verbose) {
             Write-Host "Proxied connection closed!"
         }
     }
 
-    [System.Net.Sockets.TcpClient]_connect() {
-        # Connect to the server
+    [System.Net.Sockets.Socket]_connect() {
+        # Start a non-blocking connection to the server
         Try {
-            $s = New-Object System.Net.Sockets.TcpClient($this.rhost, $this.rport)
-            if ($this.verbose) {
-                Write-Host "Connected to remote host on $($this.rhost):$($this.rport)"
-            }
-            return $s
+            $addr = [System.Net.Dns]::GetHostAddresses($this.rhost)[0]
+            $s = New-Object System.Net.Sockets.Socket(
+                $addr.AddressFamily,
+                [System.Net.Sockets.SocketType]::Stream,
+                [System.Net.Sockets.ProtocolType]::Tcp
+            )
         }
         Catch {
             return $null
         }
+        $s.Blocking = $false
+        Try {
+            $s.Connect((New-Object System.Net.IPEndPoint($addr, $this.rport)))
+        }
+        Catch {
+            # Connecting in the background is reported as an error
+            $e = $_.Exception
+            while ($e -and -not ($e -is [System.Net.Sockets.SocketException])) {
+                $e = $e.InnerException
+            }
+            $pending = @(
+                [System.Net.Sockets.SocketError]::WouldBlock,
+                [System.Net.Sockets.SocketError]::InProgress,
+                [System.Net.Sockets.SocketError]::AlreadyInProgress
+            )
+            if (-not $e -or $pending -notcontains $e.SocketErrorCode) {
+                $s.Close()
+                return $null
+            }
+        }
+        return $s
     }
 
     [System.Net.Sockets.TcpListener]_bind() {
         # Bind a TCP Socket Listener
         Try {
-            $s = New-Object System.Net.Sockets.TcpListener($this.lhost, $this.lport)
+            $s = New-Object System.Net.Sockets.TcpListener([System.Net.IPAddress]::Parse($this.lhost), $this.lport)
             $s.Server.SetSocketOption([System.Net.Sockets.SocketOptionLevel]::Socket, [System.Net.Sockets.SocketOptionName]::ReuseAddress, 1)
             return $s
         }
@@ -1,74 +1,412 @@
 #! /usr/bin/env python3
 
+import os
+import sys
 import time
+import json
+import errno
+import signal
 import socket
+import selectors
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class BindProxy:
 
-    def __init__(self, lhost: str, lport: int, rhost: str, rport: str, verbose: bool=True) -> None:
+    CONNECT_DELAY = 0.25 # Seconds before racing the next address (RFC 8305)
+    DNS_TTL = 60 # Seconds a resolved host is reused
+    BIND_FAILED = 2 # Exit code of a worker that could not listen
+
+    def __init__(self, lhost: str, lport: int, rhost: str, rport: str, verbose: bool=True, splice: bool=True, workers: int=1, connect_timeout: float=10, stats: str=None, stats_interval: float=10) -> None:
         '''Initialize TCP proxy'''
         self.lhost = lhost
         self.lport = lport
         self.rhost = rhost
         self.rport = rport
-        self.data_size = 4096
+        self.data_size = 65536
         self.verbose = verbose
+        # Move bytes socket -> pipe -> socket in the kernel where possible
+        self.splice = splice and hasattr(os, "splice")
+        self.pipe_size = 1048576
+        # Worker processes share the port, the kernel spreads connections
+        self.workers = workers
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            self.workers = 1
+        self.pids = {} # worker pid -> start time
+        self.sel = None
+        self.conns = {} # socket -> relay state
+        self.connect_timeout = connect_timeout # Seconds before a dial gives up
+        self.dns = {} # (host, port) -> (expiry, addresses)
+        self.dials = [] # connections to the server still being raced
+        self.dialing = {} # connecting socket -> dial
+        self.stats = stats # JSON-lines file for stats records, None for none
+        self.stats_interval = stats_interval # Seconds between stats records
+        self.sessions = {} # client socket -> session counters
+        self.next_id = 0
+        self.totals = {"sessions": 0, "failed": 0, "bytes_up": 0, "bytes_down": 0}
+        self.started = time.monotonic()
+        self.busy = 0 # Seconds spent handling events since the last record
+        self.busy_since = self.started
+        self.next_tick = self.started + stats_interval
 
     def start(self) -> None:
         '''Start proxy'''
+        if self.workers > 1:
+            bound = self._supervise()
+        else:
+            bound = self._serve()
+        if not bound:
+            print(f"Cannot bind listener on {self.lhost}:{self.lport}!")
+            sys.exit(self.BIND_FAILED)
+
+    def _supervise(self) -> bool:
+        '''Run the workers and restart any that exit, False if they cannot listen'''
+        if self.verbose:
+            print(f"Listening on {self.lhost}:{self.lport} with {self.workers} workers")
+        signal.signal(signal.SIGTERM, self._terminate)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._dump_workers)
+        bound = True
+        try:
+            for i in range(self.workers):
+                self._spawn()
+            while self.pids:
+                pid, status = os.wait()
+                started = self.pids.pop(pid, None)
+                if started is None:
+                    continue
+                if os.WIFEXITED(status) and os.WEXITSTATUS(status) == self.BIND_FAILED:
+                    # Restarting cannot help, stop the other workers too
+                    bound = False
+                    break
+                if self.verbose:
+                    print(f"Worker {pid} exited, restarting it")
+                if time.monotonic() - started < 1:
+                    # Do not spin if workers keep dying as soon as they start
+                    time.sleep(1)
+                self._spawn()
+        except (KeyboardInterrupt, ChildProcessError):
+            pass
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except:
+                pass
+        return bound
+
+    def _spawn(self) -> None:
+        '''Fork a worker that serves connections until it dies'''
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.monotonic()
+            return
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.pids = {}
+            if not self._serve():
+                code = self.BIND_FAILED
+        except KeyboardInterrupt:
+            pass
+        except:
+            code = 1
+        os._exit(code)
+
+    def _terminate(self, signum: int, frame) -> None:
+        '''Stop the supervisor on SIGTERM'''
+        raise KeyboardInterrupt
+
+    def _dump_workers(self, signum: int, frame) -> None:
+        '''Pass a stats dump request on to every worker'''
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except:
+                pass
+
+    def _serve(self) -> bool:
+        '''Accept and relay connections in this process, False if it cannot listen'''
+        # Each worker needs its own selector, never one inherited across fork
+        self.sel = selectors.DefaultSelector()
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._dump)
         s = self._bind()
         if s:
             s.listen(25)
-            if self.verbose:
+            s.setblocking(0)
+            self.sel.register(s, selectors.EVENT_READ, self._accept)
+            if self.verbose and self.workers == 1:
                 print(f"Listening on {self.lhost}:{self.lport}")
             while 1:
                 try:
-                    conn, addr = s.accept()
-                    if self.verbose:
-                        ip, port = addr
-                        print(f"Connection received from {ip}:{port}")
-                    self._switch(conn)
+                    # Block until a socket is ready, no polling while idle
+                    events = self.sel.select(self._wake())
+                    start = time.monotonic()
+                    for key, mask in events:
+                        key.data(key.fileobj, mask)
+                    self.busy += time.monotonic() - start
                 except KeyboardInterrupt:
                     break
+        return s is not None
 
-    def _switch(self, client_sock: socket.socket) -> None:
-        '''Switch between read/write'''
-        server_sock = self._connect()
-        if client_sock and server_sock:
-            # Make sure recv is not blocking
-            client_sock.setblocking(0)
-            server_sock.setblocking(0)
-            # Switching toggle
-            client_read = True
-            while 1:
-                # Recv from client
-                if client_read:
-                    try:
-                        data = client_sock.recv(self.data_size)
-                        if data:
-                            server_sock.sendall(data)
-                        else:
-                            break
-                    except BlockingIOError:
-                        client_read = False
-                        time.sleep(0.005)
-                    except:
-                        break
-                # Recv from server
-                if not client_read:
+    def _accept(self, s: socket.socket, mask: int) -> None:
+        '''Accept a client and start connecting to the server'''
+        try:
+            conn, addr = s.accept()
+        except BlockingIOError:
+            return
+        if self.verbose:
+            ip, port = addr[:2]
+            print(f"Connection received from {ip}:{port}")
+        conn.setblocking(0)
+        self.next_id += 1
+        session = {
+            "id": self.next_id,
+            "client": f"{addr[0]}:{addr[1]}",
+            "start": time.monotonic(),
+            "connect_ms": None, # accept to server connected
+            "ttfb_ms": None, # accept to the first byte from the server
+            "bytes_up": 0, # client to server
+            "bytes_down": 0 # server to client
+        }
+        dial = self._dial(self.rhost, self.rport, self._connected)
+        if not dial:
+            self._ended(session, "connect failed")
+            self._close(conn, None)
+            return
+        dial["client"] = conn
+        dial["session"] = session
+
+    def _connected(self, dial: dict, server_sock: socket.socket) -> None:
+        '''Start relaying once the server connection is established'''
+        client_sock = dial["client"]
+        session = dial["session"]
+        if not server_sock:
+            self._ended(session, "connect failed")
+            self._close(client_sock, server_sock)
+            return
+        session["connect_ms"] = round((time.monotonic() - session["start"]) * 1000, 3)
+        self.sessions[client_sock] = session
+        self.conns[client_sock] = self._state(server_sock, session, "bytes_up")
+        self.conns[server_sock] = self._state(client_sock, session, "bytes_down")
+        if self.verbose:
+            print(f"Connected to remote host on {self.rhost}:{self.rport}")
+        self.sel.register(server_sock, selectors.EVENT_READ, self._relay)
+        self.sel.register(client_sock, selectors.EVENT_READ, self._relay)
+
+    def _relay(self, sock: socket.socket, mask: int) -> None:
+        '''Move data between a socket and its peer'''
+        state = self.conns.get(sock)
+        if not state:
+            return
+        peer = state["peer"]
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self._flush(sock)
+            if mask & selectors.EVENT_READ:
+                peer_state = self.conns[peer]
+                if peer_state["pipe"]:
+                    # Data stays in the kernel on its way to the peer
+                    n = os.splice(
+                        sock.fileno(),
+                        peer_state["pipe"][1],
+                        self.pipe_size,
+                        flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+                    )
+                    peer_state["piped"] += n
+                else:
+                    data = sock.recv(self.data_size)
+                    n = len(data)
+                    peer_state["buf"] += data
+                if n:
+                    session = state["session"]
+                    if session["ttfb_ms"] is None and state["count"] == "bytes_down":
+                        session["ttfb_ms"] = round((time.monotonic() - session["start"]) * 1000, 3)
+                    session[state["count"]] += n
+                    self._flush(peer)
+                else:
+                    # Half-close: forward EOF once pending data is written
+                    state["eof"] = True
+                    if not self._pending(peer):
+                        peer.shutdown(socket.SHUT_WR)
+        except BlockingIOError:
+            pass
+        except:
+            self._drop(sock)
+            return
+        if state["eof"] and self.conns[peer]["eof"] and \
+                not self._pending(sock) and not self._pending(peer):
+            self._drop(sock)
+            return
+        self._update(sock)
+        self._update(peer)
+
+    def _state(self, peer: socket.socket, session: dict, count: str) -> dict:
+        '''Return the relay state for a socket'''
+        pipe = None
+        if self.splice:
+            try:
+                pipe = os.pipe()
+                if fcntl and hasattr(fcntl, "F_SETPIPE_SZ"):
                     try:
-                        data = server_sock.recv(self.data_size)
-                        if data:
-                            client_sock.sendall(data)
-                        else:
-                            break
-                    except BlockingIOError:
-                        client_read = True
-                        time.sleep(0.005)
-                    except:
-                        break
-        # Close the sockets if any are still open
-        self._close(client_sock, server_sock)
+                        fcntl.fcntl(pipe[1], fcntl.F_SETPIPE_SZ, self.pipe_size)
+                    except OSError:
+                        pass
+            except OSError:
+                # Out of descriptors, copy through userspace instead
+                pipe = None
+        return {
+            "peer": peer,
+            "buf": b"", # data waiting to be written to this socket
+            "pipe": pipe, # kernel pipe carrying data to this socket
+            "piped": 0, # bytes waiting in the pipe
+            "eof": False,
+            "session": session, # counters shared with the peer
+            "count": count # session counter for bytes read from this socket
+        }
+
+    def _pending(self, sock: socket.socket) -> bool:
+        '''Return whether data is still waiting to be written to a socket'''
+        state = self.conns[sock]
+        return bool(state["buf"] or state["piped"])
+
+    def _flush(self, sock: socket.socket) -> None:
+        '''Write as much pending data to a socket as it will take'''
+        state = self.conns[sock]
+        pending = self._pending(sock)
+        if state["piped"]:
+            n = os.splice(
+                state["pipe"][0],
+                sock.fileno(),
+                state["piped"],
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+            )
+            state["piped"] -= n
+        elif state["buf"]:
+            sent = sock.send(state["buf"])
+            state["buf"] = state["buf"][sent:]
+        if pending and not self._pending(sock) and self.conns[state["peer"]]["eof"]:
+            sock.shutdown(socket.SHUT_WR)
+
+    def _update(self, sock: socket.socket) -> None:
+        '''Select read/write interest from the relay state'''
+        state = self.conns[sock]
+        events = 0
+        # Stop reading while the peer still has data queued (backpressure)
+        if not state["eof"] and not self._pending(state["peer"]):
+            events |= selectors.EVENT_READ
+        if self._pending(sock):
+            events |= selectors.EVENT_WRITE
+        key = self.sel.get_map().get(sock)
+        if not events:
+            if key:
+                self.sel.unregister(sock)
+        elif not key:
+            self.sel.register(sock, events, self._relay)
+        elif key.events != events:
+            self.sel.modify(sock, events, self._relay)
+
+    def _drop(self, sock: socket.socket) -> None:
+        '''Stop relaying a client/server pair'''
+        peer = self.conns[sock]["peer"]
+        for s in (sock, peer):
+            state = self.conns.pop(s, None)
+            try:
+                self.sel.unregister(s)
+            except:
+                pass
+            if state and state["pipe"]:
+                os.close(state["pipe"][0])
+                os.close(state["pipe"][1])
+            session = self.sessions.pop(s, None)
+            if session:
+                self._ended(session)
+        self._close(sock, peer)
+
+    def _wake(self) -> float:
+        '''Run timed work and return the select timeout'''
+        waits = [t for t in (self._race(), self._tick()) if t is not None]
+        return min(waits) if waits else None
+
+    def _tick(self) -> float:
+        '''Write a stats record every stats_interval seconds, return the next deadline'''
+        if not self.stats or not self.stats_interval:
+            return None
+        now = time.monotonic()
+        if now >= self.next_tick:
+            self._record(self._snapshot("stats"))
+            self.busy = 0
+            self.busy_since = now
+            self.next_tick = now + self.stats_interval
+        return max(self.next_tick - now, 0)
+
+    def _ended(self, session: dict, error: str=None) -> None:
+        '''Fold a finished session into the totals and record it'''
+        self.totals["sessions"] += 1
+        if error:
+            self.totals["failed"] += 1
+        self.totals["bytes_up"] += session["bytes_up"]
+        self.totals["bytes_down"] += session["bytes_down"]
+        if self.stats:
+            record = self._summary(session, time.monotonic())
+            record.update(time=round(time.time(), 3), event="session", error=error)
+            self._record(record)
+
+    def _summary(self, session: dict, now: float) -> dict:
+        '''Return the counters of one session'''
+        return {
+            "id": session["id"],
+            "client": session["client"],
+            "target": f"{self.rhost}:{self.rport}",
+            "duration_s": round(now - session["start"], 3),
+            "connect_ms": session["connect_ms"],
+            "ttfb_ms": session["ttfb_ms"],
+            "bytes_up": session["bytes_up"],
+            "bytes_down": session["bytes_down"]
+        }
+
+    def _snapshot(self, event: str) -> dict:
+        '''Return proxy-wide counters, with open sessions for a dump'''
+        now = time.monotonic()
+        record = {
+            "time": round(time.time(), 3),
+            "event": event,
+            "role": "bind",
+            "pid": os.getpid(),
+            "uptime_s": round(now - self.started, 3),
+            "active": len(self.sessions),
+            "dialing": len(self.dials),
+            # Share of time spent relaying, near 1 means the proxy is saturated
+            "busy": round(self.busy / max(now - self.busy_since, 0.001), 3)
+        }
+        record.update(self.totals)
+        for session in self.sessions.values():
+            record["bytes_up"] += session["bytes_up"]
+            record["bytes_down"] += session["bytes_down"]
+        if event == "dump":
+            record["open"] = [self._summary(s, now) for s in self.sessions.values()]
+        return record
+
+    def _record(self, record: dict) -> None:
+        '''Append a JSON line to the stats file'''
+        try:
+            with open(self.stats, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except:
+            pass
+
+    def _dump(self, signum: int, frame) -> None:
+        '''Write every counter on SIGUSR1, to stdout without a stats file'''
+        record = self._snapshot("dump")
+        if self.stats:
+            self._record(record)
+            return
+        try:
+            print(json.dumps(record), flush=True)
+        except:
+            pass
 
     def _close(self, client: socket.socket, server: socket.socket) -> None:
         '''Close client and server sockets'''
@@ -85,26 +423,122 @@ class BindProxy:
         if self.verbose:
             print("Proxied connection closed!")
 
-    def _connect(self) -> socket.socket:
-        '''Connect to the server'''
+    def _resolve(self, host: str, port: int) -> list:
+        '''Return (family, address) pairs for a host, cached for DNS_TTL seconds'''
+        now = time.monotonic()
+        cached = self.dns.get((host, port))
+        if cached and cached[0] > now:
+            return cached[1]
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((self.rhost, self.rport))
-            if self.verbose:
-                print(f"Connected to remote host on {self.rhost}:{self.rport}")
-            return s
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
         except:
+            return []
+        if not infos:
+            return []
+        # Alternate families, starting with the one the resolver prefers
+        first = [(i[0], i[4]) for i in infos if i[0] == infos[0][0]]
+        other = [(i[0], i[4]) for i in infos if i[0] != infos[0][0]]
+        addrs = []
+        for n in range(max(len(first), len(other))):
+            addrs += first[n:n + 1] + other[n:n + 1]
+        if len(self.dns) >= 1024:
+            self.dns = {k: v for k, v in self.dns.items() if v[0] > now}
+        self.dns[(host, port)] = (now + self.DNS_TTL, addrs)
+        return addrs
+
+    def _dial(self, host: str, port: int, done) -> dict:
+        '''Race connections to a host, done(dial, sock) gets the winner or None'''
+        dial = {
+            "addrs": list(self._resolve(host, port)), # addresses not tried yet
+            "socks": [], # attempts still connecting
+            "next": 0, # time to start racing the next address
+            "deadline": time.monotonic() + self.connect_timeout,
+            "done": done
+        }
+        self._attempt(dial)
+        if not dial["socks"]:
             return None
+        self.dials.append(dial)
+        return dial
+
+    def _attempt(self, dial: dict) -> None:
+        '''Start a non-blocking connection to the next address of a dial'''
+        while dial["addrs"]:
+            family, addr = dial["addrs"].pop(0)
+            s = None
+            try:
+                s = socket.socket(family, socket.SOCK_STREAM)
+                s.setblocking(0)
+                err = s.connect_ex(addr)
+                if err and err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise ConnectionError
+            except:
+                if s:
+                    s.close()
+                continue
+            dial["socks"].append(s)
+            dial["next"] = time.monotonic() + self.CONNECT_DELAY
+            self.dialing[s] = dial
+            self.sel.register(s, selectors.EVENT_WRITE, self._dialed)
+            return
+
+    def _dialed(self, sock: socket.socket, mask: int) -> None:
+        '''Finish a dial with the first attempt that connects'''
+        dial = self.dialing.pop(sock, None)
+        if not dial:
+            return
+        self.sel.unregister(sock)
+        dial["socks"].remove(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            # Refused or unreachable, race the next address at once
+            sock.close()
+            self._attempt(dial)
+            if not dial["socks"]:
+                self._finish(dial, None)
+            return
+        self._finish(dial, sock)
+
+    def _race(self) -> float:
+        '''Start due attempts and fail dials past their deadline, return the select timeout'''
+        if not self.dials:
+            return None
+        now = time.monotonic()
+        for dial in list(self.dials):
+            if dial not in self.dials:
+                continue
+            if now >= dial["deadline"]:
+                self._finish(dial, None)
+            elif dial["addrs"] and now >= dial["next"]:
+                self._attempt(dial)
+        wake = [d["deadline"] for d in self.dials]
+        wake += [d["next"] for d in self.dials if d["addrs"]]
+        if not wake:
+            return None
+        return max(min(wake) - time.monotonic(), 0)
+
+    def _finish(self, dial: dict, sock: socket.socket) -> None:
+        '''Close the losing attempts of a dial and report its result'''
+        for s in dial["socks"]:
+            self.dialing.pop(s, None)
+            self.sel.unregister(s)
+            s.close()
+        dial["socks"] = []
+        if dial in self.dials:
+            self.dials.remove(dial)
+        dial["done"](dial, sock)
 
     def _bind(self) -> socket.socket:
         '''Bind a TCP socket listener'''
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            family = socket.AF_INET6 if ":" in self.lhost else socket.AF_INET
+            s = socket.socket(family, socket.SOCK_STREAM)
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.workers > 1:
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             s.bind((self.lhost, self.lport))
             return s
         except:
             return None
 
-bndprx = BindProxy("{{LHOST}}", {{LPORT}}, "{{RHOST}}", {{RPORT}})
+bndprx = BindProxy("{{LHOST}}", {{LPORT}}, "{{RHOST}}", {{RPORT}}, workers={{WORKERS}}, connect_timeout={{CONNECT_TIMEOUT}}, stats={{STATS}}, stats_interval={{STATS_INTERVAL}})
 bndprx.start()
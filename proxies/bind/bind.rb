@@ -4,14 +4,16 @@ require 'socket'
 
 class BindProxy
 
-  def initialize(lhost, lport, rhost, rport, verbose=true)
+  def initialize(lhost, lport, rhost, rport, verbose=true, min_read=4096, max_read=262144)
     # Initialize TCP proxy
     @lhost = lhost
     @lport = lport
     @rhost = rhost
     @rport = rport
-    @data_size = 4096
+    @min_read = min_read # Read sizes adapt between these bounds
+    @max_read = max_read
     @verbose = verbose
+    @conns = {} # socket -> relay state
   end
 
   def start
@@ -23,13 +25,35 @@ class BindProxy
       end
       while true
         begin
-          conn, addr = s.accept
-          if @verbose
-            ip = addr.ip_address
-            port = addr.ip_port
-            puts "Connection received from #{ip}:#{port}"
+          readers = [s]
+          writers = []
+          @conns.each_value do |st|
+            peer = @conns[st[:peer]]
+            if st[:connecting] || !st[:pend].empty?
+              writers << st[:sock]
+            end
+            # Stop reading while the peer still has bytes to write
+            if !st[:connecting] && !st[:eof] && peer[:pend].empty? && !peer[:connecting]
+              readers << st[:sock]
+            end
+          end
+          # Block until a socket is ready, no polling while idle
+          readable, writable = IO.select(readers, writers)
+          writable.each do |sock|
+            next unless @conns.key?(sock)
+            if @conns[sock][:connecting]
+              _connected(sock)
+            else
+              _flush(sock)
+            end
+          end
+          readable.each do |sock|
+            if sock == s
+              _accept(s)
+            elsif @conns.key?(sock)
+              _relay(sock)
+            end
           end
-          _switch(conn)
         rescue Interrupt
           break
         rescue => e
@@ -40,68 +64,124 @@ class BindProxy
     end
   end
 
-  def _switch(client_sock)
-    server_sock = _connect
-    if client_sock && server_sock
-      client_read = true
-      while true
-        # Recv from client
-        if client_read
-          begin
-            data = client_sock.recv_nonblock(@data_size)
-            if data
-              _sendall(server_sock, data)
-            else
-              break
-            end
-          rescue IO::WaitReadable
-            client_read = false
-            sleep 0.005
-          rescue
-            break
-          end
-        end
-        # Recv from server
-        if !client_read
-          begin
-            data = server_sock.recv_nonblock(@data_size)
-            if data
-              _sendall(client_sock, data)
-            else
-              break
-            end
-          rescue IO::WaitReadable
-            client_read = true
-            sleep 0.005
-          rescue
-            break
-          end
-        end
+  def _accept(s)
+    # Accept waiting clients and start connecting to the server
+    while true
+      conn, addr = s.accept_nonblock(exception: false)
+      break if conn == :wait_readable
+      if @verbose
+        ip = addr.ip_address
+        port = addr.ip_port
+        puts "Connection received from #{ip}:#{port}"
       end
-      # Close the sockets if any are still open
-      _close(client_sock, server_sock)
+      conn.setsockopt(Socket::IPPROTO_TCP, Socket::TCP_NODELAY, 1)
+      server_sock = _connect
+      if !server_sock
+        _close(conn)
+        next
+      end
+      @conns[conn] = _state(conn, server_sock)
+      @conns[server_sock] = _state(server_sock, conn)
+      @conns[server_sock][:connecting] = true
     end
   end
 
-  def _sendall(sock, data)
-    bytes_sent = 0
-    while bytes_sent < data.length
-      sent_count = sock.write(data.byteslice(bytes_sent..-1))
-      bytes_sent += sent_count
+  def _connected(sock)
+    # Finish a non-blocking connect to the server
+    if sock.getsockopt(Socket::SOL_SOCKET, Socket::SO_ERROR).int != 0
+      _close(sock)
+      return
+    end
+    @conns[sock][:connecting] = false
+    sock.setsockopt(Socket::IPPROTO_TCP, Socket::TCP_NODELAY, 1)
+    if @verbose
+      puts "Connected to remote host on #{@rhost}:#{@rport}"
     end
   end
 
-  def _close(client, server)
-    # Close client and server sockets
+  def _relay(sock)
+    # Read from one socket and write to its peer
+    st = @conns[sock]
     begin
-      client.close
+      data = sock.read_nonblock(st[:rsize], exception: false)
     rescue
-      nil
+      _close(sock)
+      return
+    end
+    return if data == :wait_readable
+    if data.nil?
+      # Half-close: forward EOF once the peer has written everything
+      st[:eof] = true
+      _finish(st[:peer])
+      return
+    end
+    # Grow reads while they fill the buffer, shrink them for small messages
+    if data.bytesize == st[:rsize] && st[:rsize] < @max_read
+      st[:rsize] *= 2
+    elsif data.bytesize < st[:rsize] / 4 && st[:rsize] > @min_read
+      st[:rsize] /= 2
     end
+    @conns[st[:peer]][:pend] = data
+    _flush(st[:peer])
+  end
+
+  def _flush(sock)
+    # Write pending bytes to a socket
+    st = @conns[sock]
     begin
-      server.close
+      sent = sock.write_nonblock(st[:pend], exception: false)
     rescue
-      nil
+      _close(sock)
+      return
+    end
+    return if sent == :wait_writable
+    st[:pend] = st[:pend].byteslice(sent..-1)
+    if st[:pend].empty?
+      _finish(sock)
+    end
+  end
+
+  def _finish(sock)
+    # Shut down a socket's write side after its peer hit EOF
+    st = @conns[sock]
+    peer = @conns[st[:peer]]
+    if peer[:eof] && st[:pend].empty? && !st[:shut]
+      st[:shut] = true
+      begin
+        sock.shutdown(Socket::SHUT_WR)
+      rescue
+        nil
+      end
+    end
+    if st[:eof] && peer[:eof] && st[:pend].empty? && peer[:pend].empty?
+      _close(sock)
+    end
+  end
+
+  def _state(sock, peer)
+    # Relay state for one socket
+    {
+      sock: sock,
+      peer: peer, # socket this one relays to
+      pend: "".b, # bytes waiting to be written to this socket
+      eof: false, # this socket sent EOF
+      shut: false, # EOF forwarded to this socket
+      connecting: false,
+      rsize: 16384
+    }
+  end
+
+  def _close(sock)
+    # Close a socket and its peer
+    socks = [sock]
+    socks << @conns[sock][:peer] if @conns.key?(sock)
+    socks.each do |s|
+      @conns.delete(s)
+      begin
+        s.close
+      rescue
+        nil
+      end
     end
     if @verbose
       puts "Proxied connection closed!"
@@ -109,14 +189,11 @@ class BindProxy
   end
 
   def _connect
-    # Connect to the server
+    # Start a non-blocking connection to the server
     begin
       s = Socket.new(Socket::AF_INET, Socket::SOCK_STREAM, 0)
       addr = Socket.pack_sockaddr_in(@rport, @rhost)
-      s.connect(addr)
-      if @verbose
-        puts "Connected to remote host on #{@rhost}:#{@rport}"
-      end
+      s.connect_nonblock(addr, exception: false)
       return s
     rescue
       return nil
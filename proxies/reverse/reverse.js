@@ -0,0 +1,214 @@
+const net = require("net")
+
+// Tunnel frame header: command, channel id, payload length
+const HEADER = 9;
+const DATA = 0, OPEN = 1, CLOSE = 2, EOF = 3, HELLO = 4;
+const MULTIPLEX = 0x01; // HELLO flag: many channels at once
+const DEFAULT_FRAME = 65536; // Frame size assumed until the peer says otherwise
+
+class ReverseProxy {
+
+    constructor(chost, cport, rhost, rport, verbose=true, max_frame=262144) {
+        // Initialize reverse TCP proxy
+        this.chost = chost; // Client host
+        this.cport = cport;
+        this.rhost = rhost; // Remote host
+        this.rport = rport;
+        this.max_frame = max_frame; // Largest frame we accept
+        this.data_size = Math.min(max_frame, DEFAULT_FRAME); // Largest frame we send
+        this.verbose = verbose;
+        this.client_sock = null;
+        this.chunks = []; // Tunnel bytes not parsed yet
+        this.clen = 0;
+        this.channels = new Map(); // channel id -> channel state
+        this.blocked = new Set(); // channels whose server is not keeping up
+        this.tunnel_full = false; // client is not keeping up
+    }
+
+    start() {
+        // Start proxy
+        const s = new net.Socket();
+        s.connect({ port: this.cport, host: this.chost }, () => {
+            if (this.verbose) {
+                console.log("Proxy connected to client.");
+            }
+            // Frames are written whole, so do not wait to coalesce them
+            s.setNoDelay(true);
+            const hello = Buffer.alloc(5);
+            hello[0] = MULTIPLEX;
+            hello.writeUInt32BE(this.max_frame, 1);
+            this._send(HELLO, 0, hello);
+        });
+        s.on("data", (chunk) => {
+            this._parse(chunk);
+        });
+        s.on("drain", () => {
+            // Client caught up, let the servers send again
+            this.tunnel_full = false;
+            for (const state of this.channels.values()) {
+                state.sock.resume();
+            }
+        });
+        s.on("error", () => {});
+        s.on("close", () => {
+            // Client is gone, stop the proxy
+            this.client_sock = null;
+            for (const state of this.channels.values()) {
+                state.sock.destroy();
+            }
+        });
+        this.client_sock = s;
+    }
+
+    _parse(chunk) {
+        // Handle every complete frame received so far
+        this.chunks.push(chunk);
+        this.clen += chunk.length;
+        while (this.clen >= HEADER) {
+            let buf = this.chunks[0];
+            if (buf.length < HEADER) {
+                buf = this._merge();
+            }
+            const size = HEADER + buf.readUInt32BE(5);
+            if (this.clen < size) {
+                break;
+            }
+            if (buf.length < size) {
+                // Frame spans several reads, join them once
+                buf = this._merge();
+            }
+            const cmd = buf[0];
+            const chan = buf.readUInt32BE(1);
+            const data = buf.subarray(HEADER, size);
+            if (buf.length == size) {
+                this.chunks.shift();
+            }
+            else {
+                this.chunks[0] = buf.subarray(size);
+            }
+            this.clen -= size;
+            this._handle(cmd, chan, data);
+        }
+    }
+
+    _merge() {
+        // Join the unparsed reads into one buffer
+        const buf = Buffer.concat(this.chunks, this.clen);
+        this.chunks = [buf];
+        return buf;
+    }
+
+    _handle(cmd, chan, data) {
+        // Apply a frame from the client to its channel
+        if (cmd == HELLO) {
+            if (data.length >= 5) {
+                this.data_size = Math.min(this.max_frame, data.readUInt32BE(1));
+            }
+            return;
+        }
+        if (cmd == OPEN) {
+            this._open(chan);
+            return;
+        }
+        const state = this.channels.get(chan);
+        if (!state) {
+            // Frame for a channel that is already gone
+            return;
+        }
+        if (cmd == DATA) {
+            if (!state.eof_in && !state.closing && !state.sock.write(data)) {
+                // Stop reading the tunnel until this server drains
+                this.blocked.add(chan);
+                this.client_sock.pause();
+            }
+        }
+        else if (cmd == EOF) {
+            state.eof_in = true;
+            state.sock.end();
+        }
+        else if (cmd == CLOSE) {
+            // Flush what the server has not taken yet, then close
+            state.closing = true;
+            state.sock.end(() => {
+                state.sock.destroy();
+            });
+        }
+    }
+
+    _open(chan) {
+        // Connect a new channel to the remote host
+        const s = new net.Socket({ allowHalfOpen: true });
+        const state = {
+            sock: s,
+            eof_in: false, // client sent EOF
+            eof_out: false, // server sent EOF
+            closing: false
+        };
+        this.channels.set(chan, state);
+        if (this.tunnel_full) {
+            s.pause();
+        }
+        s.connect({ port: this.rport, host: this.rhost }, () => {
+            if (this.verbose) {
+                console.log("Proxy connected to remote host.");
+            }
+        });
+        s.on("data", (data) => {
+            for (let i = 0; i < data.length; i += this.data_size) {
+                this._send(DATA, chan, data.subarray(i, i + this.data_size));
+            }
+        });
+        s.on("end", () => {
+            state.eof_out = true;
+            this._send(EOF, chan, Buffer.alloc(0));
+        });
+        s.on("drain", () => {
+            this.blocked.delete(chan);
+            if (!this.blocked.size && this.client_sock) {
+                this.client_sock.resume();
+            }
+        });
+        s.on("error", () => {});
+        s.on("close", () => {
+            if (!state.closing && !(state.eof_in && state.eof_out)) {
+                // Failed or reset, tell the client to close its side
+                this._send(CLOSE, chan, Buffer.alloc(0));
+            }
+            this.channels.delete(chan);
+            if (this.blocked.delete(chan) && !this.blocked.size && this.client_sock) {
+                this.client_sock.resume();
+            }
+            if (this.verbose) {
+                console.log("Proxy disconnected from remote host.");
+            }
+        });
+    }
+
+    _send(cmd, chan, data) {
+        // Send a frame to the client, pausing servers when it backs up
+        if (!this.client_sock) {
+            return;
+        }
+        const header = Buffer.alloc(HEADER);
+        header[0] = cmd;
+        header.writeUInt32BE(chan, 1);
+        header.writeUInt32BE(data.length, 5);
+        this.client_sock.cork();
+        this.client_sock.write(header);
+        let ok = true;
+        if (data.length) {
+            ok = this.client_sock.write(data);
+        }
+        this.client_sock.uncork();
+        if (!ok && !this.tunnel_full) {
+            this.tunnel_full = true;
+            for (const state of this.channels.values()) {
+                state.sock.pause();
+            }
+        }
+    }
+
+}
+
+revprx = new ReverseProxy("{{CHOST}}", {{CPORT}}, "{{RHOST}}", {{RPORT}});
+revprx.start();
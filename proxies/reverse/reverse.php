@@ -4,232 +4,318 @@ class ReverseProxy {
     private $rhost;
     private $rport;
     private $data_size;
+    private $max_frame;
     private $verbose;
+    private $client_sock;
+    private $rbuf;
+    private $out;
+    private $channels;
+    private $socks;
 
-    public function __construct($chost, $cport, $rhost, $rport, $verbose=true) {
+    public function __construct($chost, $cport, $rhost, $rport, $verbose=true, $max_frame=262144) {
         $this->chost = $chost;
         $this->cport = $cport;
         $this->rhost = $rhost;
         $this->rport = $rport;
         $this->verbose = $verbose;
-        $this->data_size = 4096;
+        $this->max_frame = $max_frame; # Largest frame we accept
+        $this->data_size = min($max_frame, 65536); # Largest frame we send
+        $this->client_sock = NULL;
+        $this->rbuf = ""; # Tunnel bytes not parsed yet
+        $this->out = ""; # Frames waiting for the client
+        $this->channels = array(); # channel id -> channel state
+        $this->socks = array(); # server socket id -> channel id
     }
 
     public function start() {
         # Start proxy
-        $client_sock = $this->_connect($this->chost, $this->cport);
-        if ($client_sock) {
+        $this->client_sock = $this->_connect($this->chost, $this->cport);
+        if ($this->client_sock) {
             if ($this->verbose) {
                 echo("Proxy connected to client.\n");
             }
-            while (true) {
-                $header = $this->_recv_all($client_sock, 5);
-                if ($header) {
-                    $hdr_vals = unpack("Ccmd/Ndlen", $header);
-                    if ($hdr_vals === false) {
-                        break;
+            # Frames are written whole, so do not wait to coalesce them
+            socket_set_option($this->client_sock, SOL_TCP, TCP_NODELAY, 1);
+            socket_set_nonblock($this->client_sock);
+            # Announce a multiplexing proxy and the largest frame we accept
+            $this->_send_all(4, 0, pack("CN", 1, $this->max_frame));
+            while ($this->client_sock) {
+                $read = array();
+                $write = array();
+                $except = array();
+                $blocked = false;
+                foreach ($this->channels as $chan => $st) {
+                    if ($st["pend"] !== "") {
+                        $blocked = true;
                     }
-                    $cmd = $hdr_vals["cmd"];
-                    $data_len = $hdr_vals["dlen"];
-                    # connect to remote host
-                    if ($cmd == 1) {
-                        $server_sock = $this->_connect($this->rhost, $this->rport);
-                        if ($this->verbose) {
-                            echo("Proxy connected to remote host.\n");
-                        }
-                        $this->_switch($client_sock, $server_sock);
-                        $this->_close($server_sock);
-                        if ($this->verbose) {
-                            echo("Proxy disconnected from remote host.\n");
-                        }
+                    if (!$st["connected"]) {
+                        # Windows reports a failed connect as an exception
+                        $write[] = $st["sock"];
+                        $except[] = $st["sock"];
+                        continue;
+                    }
+                    if ($st["pend"] !== "") {
+                        $write[] = $st["sock"];
+                    }
+                    # Stop reading servers while the client is behind
+                    if (!$st["eof_out"] && !$st["closing"] && $this->out === "") {
+                        $read[] = $st["sock"];
                     }
                 }
-                else {
-                    usleep(5000);
+                # Stop reading the tunnel while a server is behind
+                if (!$blocked) {
+                    $read[] = $this->client_sock;
                 }
-            }
-            # Close other end
-            $this->_sendall($client_sock, 2, "");
-            $this->_close($client_sock);
-        }
-    }
-
-    private function _switch($client_sock, $server_sock) {
-        $server_closed = false;
-        if ($client_sock && $server_sock) {
-            # Switching toggle
-            $client_read = true;
-            while (true) {
-                # recv from client
-                if ($client_read) {
-                    $header = $this->_recv_all($client_sock, 5);
-                    if ($header === 1) { # error
-                        break;
-                    }
-                    elseif ($header === 0) { # no data
-                        $client_read = false;
-                        usleep(5000);
+                if ($this->out !== "") {
+                    $write[] = $this->client_sock;
+                }
+                # Block until a socket is ready, no polling while idle
+                if (@socket_select($read, $write, $except, null) === false) {
+                    break;
+                }
+                foreach ($except as $sock) {
+                    $this->_fail($sock);
+                }
+                foreach ($write as $sock) {
+                    if ($sock === $this->client_sock) {
+                        $this->_flush_client();
                     }
-                    elseif (strlen($header) == 5) { # Data received
-                        $hdr_vals = unpack("Ccmd/Ndlen", $header);
-                        $cmd = $hdr_vals["cmd"];
-                        $data_len = $hdr_vals["dlen"];
-                        if ($cmd == 0) {
-                            $data = $this->_recv_all($client_sock, $data_len);
-                            if (!$server_closed) {
-                                $success = $this->_sendall($server_sock, $data);
-                                if ($success === false) {
-                                    $server_closed = true;
-                                    $client_read = false;
-                                    usleep(5000);
-                                }
+                    elseif (isset($this->socks[$this->_id($sock)])) {
+                        $chan = $this->socks[$this->_id($sock)];
+                        if (!$this->channels[$chan]["connected"]) {
+                            if (socket_get_option($sock, SOL_SOCKET, SO_ERROR)) {
+                                $this->_fail($sock);
+                                continue;
                             }
-                            else {
-                                $client_read = false;
-                                usleep(5000);
+                            $this->channels[$chan]["connected"] = true;
+                            if ($this->verbose) {
+                                echo("Proxy connected to remote host.\n");
                             }
                         }
-                        elseif ($cmd == 2) { # close socket
-                            break;
-                        }
+                        $this->_service($chan);
                     }
                 }
-                # recv from server
-                if (!$client_read) {
-                    $data = "";
-                    $bytes_received = socket_recv($server_sock, $data, $this->data_size, 0);
-                    if ($bytes_received === false) {
-                        $error_code = socket_last_error($server_sock);
-                        # No data
-                        if ($error_code == SOCKET_EAGAIN || $error_code == SOCKET_EWOULDBLOCK) {
-                            $client_read = true;
-                            usleep(5000);
-                        }
-                        # Error
-                        else {
-                            $this->_send_all($client_sock, 2, "");
-                            break;
-                        }
+                foreach ($read as $sock) {
+                    if (!$this->client_sock) {
+                        break;
                     }
-                    elseif ($bytes_received === 0) {
-                        # Server gracefully closed the connection
-                        if ($server_closed) {
-                            $this->_send_all($client_sock, 2, "");
-                            break;
-                        }
-                        $server_closed = true;
-                        $client_read = true;
-                        usleep(5000);
+                    if ($sock === $this->client_sock) {
+                        $this->_tunnel();
                     }
-                    else {
-                        $success = $this->_send_all($client_sock, 0, $data);
-                        if ($success === false) {
-                            break;
-                        }
+                    elseif (isset($this->socks[$this->_id($sock)])) {
+                        $this->_relay($this->socks[$this->_id($sock)]);
                     }
                 }
             }
+            foreach (array_keys($this->channels) as $chan) {
+                $this->_drop($chan);
+            }
+            if ($this->client_sock) {
+                $this->_close($this->client_sock);
+            }
         }
     }
 
-    private function _sendall($sock, $data) {
-        # Normal socket sendall function to block until all is sent
-        try {
-            $bytes_sent = 0;
-            $total_bytes = strlen($data);
-            while ($bytes_sent < $total_bytes) {
-                $sent = socket_write($sock, substr($data, $bytes_sent), $total_bytes - $bytes_sent);
-                if ($sent === false) {
-                    return false;
-                }
-                $bytes_sent += $sent;
+    private function _tunnel() {
+        # Read frames from the client
+        $chunk = "";
+        $bytes_received = @socket_recv($this->client_sock, $chunk, $this->max_frame, 0);
+        if ($bytes_received === false) {
+            if (!$this->_would_block($this->client_sock)) {
+                $this->client_sock = NULL;
             }
-            return true;
+            return;
         }
-        catch (Exception $e) {}
+        if ($bytes_received === 0) {
+            # Client is gone, stop the proxy
+            $this->client_sock = NULL;
+            return;
+        }
+        $this->rbuf .= $chunk;
+        $pos = 0;
+        $total = strlen($this->rbuf);
+        while ($total - $pos >= 9) {
+            $hdr_vals = unpack("Ccmd/Nchan/Ndlen", $this->rbuf, $pos);
+            $end = $pos + 9 + $hdr_vals["dlen"];
+            if ($end > $total) {
+                break;
+            }
+            $data = (string)substr($this->rbuf, $pos + 9, $hdr_vals["dlen"]);
+            $pos = $end;
+            $this->_handle($hdr_vals["cmd"], $hdr_vals["chan"], $data);
+        }
+        # Keep the partial frame for the next read
+        $this->rbuf = (string)substr($this->rbuf, $pos);
     }
 
-    private function _send_all($sock, $cmd, $data) {
-        # Send data or a command
-        try {
-            $data_len = strlen($data);
-            $header = pack("CN", $cmd, $data_len);
-            $msg = $header . $data;
-            $success = $this->_sendall($sock, $msg);
-            if ($success === false) {
-                return false;
+    private function _handle($cmd, $chan, $data) {
+        # Apply a frame from the client to its channel
+        if ($cmd == 4) { # hello
+            if (strlen($data) >= 5) {
+                $hello = unpack("Cflags/Nframe", $data);
+                $this->data_size = min($this->max_frame, $hello["frame"]);
             }
-            else {
-                return true;
+            return;
+        }
+        if ($cmd == 1) { # connect to remote host
+            $server_sock = $this->_connect($this->rhost, $this->rport, false);
+            if (!$server_sock) {
+                $this->_send_all(2, $chan, "");
+                return;
             }
+            $this->channels[$chan] = array(
+                "sock" => $server_sock,
+                "pend" => "", # data waiting for the server
+                "connected" => false,
+                "eof_in" => false, # client sent EOF
+                "eof_out" => false, # server sent EOF
+                "shut" => false, # EOF forwarded to the server
+                "closing" => false
+            );
+            $this->socks[$this->_id($server_sock)] = $chan;
+            return;
+        }
+        if (!isset($this->channels[$chan])) {
+            # Frame for a channel that is already gone
+            return;
+        }
+        if ($cmd == 0) { # data
+            $this->channels[$chan]["pend"] .= $data;
+        }
+        elseif ($cmd == 3) { # client is done sending
+            $this->channels[$chan]["eof_in"] = true;
         }
-        catch (Exception $e){}
+        elseif ($cmd == 2) { # close socket
+            $this->channels[$chan]["closing"] = true;
+        }
+        $this->_service($chan);
     }
 
-    private function _recv_all($sock, $n) {
-        # TCP recv n bytes
-        # Return val of 0 = no bytes, 1 = error, str = data received
+    private function _relay($chan) {
+        # Read from a server and forward it to the client
+        $sock = $this->channels[$chan]["sock"];
         $data = "";
-        $dlen = 0;
-        while ($dlen < $n) {
-            try {
-                $chunk = "";
-                $bytes_received = socket_recv($sock, $chunk, ($n - $dlen), 0);
-                # Error
-                if ($bytes_received === false) {
-                    $error_code = socket_last_error($sock);
-                    # No Data (non-blocking)
-                    if ($error_code == SOCKET_EAGAIN || $error_code == SOCKET_EWOULDBLOCK) {
-                        if ((!$data) && ($dlen == 0)) { # Some but not all data yet
-                            return 0;
-                        }
-                    }
-                    else {
-                        return 1;
-                    }
-                }
-                # Socket closed
-                elseif ($bytes_received === 0) {
-                    return 1;
+        $bytes_received = @socket_recv($sock, $data, $this->data_size, 0);
+        if ($bytes_received === false) {
+            if (!$this->_would_block($sock)) {
+                $this->_fail($sock);
+            }
+            return;
+        }
+        if ($bytes_received === 0) {
+            $this->channels[$chan]["eof_out"] = true;
+            $this->_send_all(3, $chan, "");
+            $this->_service($chan);
+            return;
+        }
+        $this->_send_all(0, $chan, $data);
+    }
+
+    private function _service($chan) {
+        # Flush a channel, forward EOFs and drop it when both sides are done
+        $st = $this->channels[$chan];
+        if ($st["connected"] && $st["pend"] !== "") {
+            $sent = @socket_write($st["sock"], $st["pend"]);
+            if ($sent === false) {
+                if (!$this->_would_block($st["sock"])) {
+                    $this->_fail($st["sock"]);
+                    return;
                 }
-                $data .= $chunk;
-                $dlen += $bytes_received;
+                $sent = 0;
             }
-            catch (Exception $e) {
-                return 1;
+            $st["pend"] = (string)substr($st["pend"], $sent);
+            $this->channels[$chan]["pend"] = $st["pend"];
+        }
+        if ($st["connected"] && $st["pend"] === "" && $st["eof_in"] && !$st["shut"]) {
+            $this->channels[$chan]["shut"] = true;
+            @socket_shutdown($st["sock"], 1);
+        }
+        if ($st["pend"] === "" && ($st["closing"] || ($st["eof_in"] && $st["eof_out"]))) {
+            $this->_drop($chan);
+        }
+    }
+
+    private function _fail($sock) {
+        # Close a broken server socket and tell the client
+        $id = $this->_id($sock);
+        if (isset($this->socks[$id])) {
+            $chan = $this->socks[$id];
+            $this->_send_all(2, $chan, "");
+            $this->_drop($chan);
+        }
+    }
+
+    private function _drop($chan) {
+        # Close a channel's server socket and forget the channel
+        $sock = $this->channels[$chan]["sock"];
+        unset($this->socks[$this->_id($sock)]);
+        unset($this->channels[$chan]);
+        $this->_close($sock);
+        if ($this->verbose) {
+            echo("Proxy disconnected from remote host.\n");
+        }
+    }
+
+    private function _send_all($cmd, $chan, $data) {
+        # Queue a frame for the client and write as much as it takes
+        if (!$this->client_sock) {
+            return;
+        }
+        $this->out .= pack("CNN", $cmd, $chan, strlen($data)) . $data;
+        $this->_flush_client();
+    }
+
+    private function _flush_client() {
+        # Write queued frames to the client
+        $sent = @socket_write($this->client_sock, $this->out);
+        if ($sent === false) {
+            if (!$this->_would_block($this->client_sock)) {
+                $this->client_sock = NULL;
             }
+            return;
         }
-        return $data;
+        $this->out = (string)substr($this->out, $sent);
+    }
+
+    private function _would_block($sock) {
+        # Check whether the last socket error just means try again
+        $error_code = socket_last_error($sock);
+        socket_clear_error($sock);
+        return in_array($error_code, array(SOCKET_EAGAIN, SOCKET_EWOULDBLOCK, SOCKET_EINPROGRESS));
+    }
+
+    private function _id($sock) {
+        # Sockets are objects in PHP 8 and resources before
+        return is_object($sock) ? spl_object_id($sock) : (int)$sock;
     }
 
     private function _close($sock) {
         # Close socket
         try {
-            socket_close($sock);
+            @socket_close($sock);
         }
         catch (Exception $e) {}
     }
 
-    private function _connect($host, $port) {
-        # Connect to the server
-        try {
-            $s = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
-            # Set indefinite timeouts
-            socket_set_option($s, SOL_SOCKET, SO_RCVTIMEO, ['sec' => 0, 'usec' => 0]);
-            socket_set_option($s, SOL_SOCKET, SO_SNDTIMEO, ['sec' => 0, 'usec' => 0]);
-            $result = socket_connect($s, $host, $port);
-            # Set non-blocking
-            socket_set_nonblock($s);
-            if ($result) {
-                return $s;
-            }
-            else {
+    private function _connect($host, $port, $blocking=true) {
+        # Connect to a remote port
+        $s = @socket_create(AF_INET, SOCK_STREAM, SOL_TCP);
+        if (!$s) {
+            return NULL;
+        }
+        if ($blocking) {
+            if (!@socket_connect($s, $host, $port)) {
+                socket_close($s);
                 return NULL;
             }
+            return $s;
         }
-        catch (Exception $e) {
+        socket_set_nonblock($s);
+        if (!@socket_connect($s, $host, $port) && !$this->_would_block($s)) {
+            socket_close($s);
             return NULL;
         }
+        return $s;
     }
 
 }
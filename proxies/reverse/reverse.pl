@@ -1,173 +1,265 @@
 #! /usr/bin/perl
 
-use Time::HiRes qw(sleep);
+use IO::Select;
 use IO::Socket::INET;
+use Socket qw(SOL_SOCKET SO_ERROR IPPROTO_TCP TCP_NODELAY);
 
 # Initialize Values
 $chost = "{{CHOST}}";
 $cport = {{CPORT}};
 $rhost = "{{RHOST}}";
 $rport = {{RPORT}};
-$data_size = 4096;
+$max_frame = 262144; # Largest frame we accept
+$data_size = 65536; # Largest frame we send
+$min_read = 4096; # Server read sizes adapt between these bounds
 $verbose = 1;
+$client_sock = undef;
+$rbuf = ""; # Tunnel bytes not parsed yet
+$out = ""; # Frames waiting for the client
+%channels = (); # channel id -> channel state
+%socks = (); # server fileno -> channel id
 
 sub start {
     # Start proxy
-    my $client_sock = _connect($chost, $cport);
+    $client_sock = _connect($chost, $cport, 1);
     if ($client_sock) {
         if ($verbose) {
             print "Proxy connected to client.\n";
         }
-        while (1) {
-            my $header = _recv_all($client_sock, 5);
-            if ($header) {
-                my ($cmd, $data_len) = unpack("CI>", $header);
-                # connect to remote host
-                if ($cmd == 1) {
-                    my $server_sock = _connect($rhost, $rport);
-                    if ($verbose) {
-                        print "Proxy connected to remote host.\n";
-                    }
-                    _switch($client_sock, $server_sock);
-                    _close($server_sock);
-                    if ($verbose) {
-                        print "Proxy disconnected from remote host.\n";
-                    }
+        # Frames are written whole, so do not wait to coalesce them
+        setsockopt($client_sock, IPPROTO_TCP, TCP_NODELAY, 1);
+        $client_sock->blocking(0);
+        # Announce a multiplexing proxy and the largest frame we accept
+        _send_all(4, 0, pack("CI>", 1, $max_frame));
+        while ($client_sock) {
+            my $rsel = IO::Select->new();
+            my $wsel = IO::Select->new();
+            my $blocked = 0;
+            foreach my $st (values %channels) {
+                $blocked = 1 if length($st->{pend});
+                if (!$st->{connected} or length($st->{pend})) {
+                    $wsel->add($st->{sock});
+                }
+                # Stop reading servers while the client is behind
+                if ($st->{connected} and !$st->{eof_out} and !$st->{closing} and !length($out)) {
+                    $rsel->add($st->{sock});
                 }
             }
-            else {
-                sleep(0.005);
-            }
-        }
-        _close($client_sock);
-    }
-}
-
-sub _switch {
-    # Switch between read/write
-    my $client_sock = $_[0];
-    my $server_sock = $_[1];
-    my $data = "";
-    my $client_read = 1;
-    my $server_closed = 0;
-    if ($client_sock and $server_sock) {
-        while (1) {
-            # Recv from client
-            if ($client_read) {
-                my $header = _recv_all($client_sock, 5);
-                if (!defined($header)) {
-                    last;
+            # Stop reading the tunnel while a server is behind
+            $rsel->add($client_sock) if !$blocked;
+            $wsel->add($client_sock) if length($out);
+            # Block until a socket is ready, no polling while idle
+            my ($readable, $writable) = IO::Select->select($rsel, $wsel, undef);
+            foreach my $sock (@$writable) {
+                if ($sock == $client_sock) {
+                    _flush_client();
+                    next;
                 }
-                elsif ($header) {
-                    my ($cmd, $data_len) = unpack("CI>", $header);
-                    if ($cmd == 0) {
-                        $data = _recv_all($client_sock, $data_len);
-                        if (!$server_closed) {
-                            _sendall($server_sock, $data);
-                        }
-                        else {
-                            $client_read = 0;
-                            sleep(0.005);
-                        }
+                my $chan = _chan($sock);
+                next unless defined($chan);
+                if (!$channels{$chan}->{connected}) {
+                    if ($sock->sockopt(SO_ERROR)) {
+                        _fail($chan);
+                        next;
                     }
-                    elsif ($cmd == 2) { # close socket
-                        last;
+                    $channels{$chan}->{connected} = 1;
+                    setsockopt($sock, IPPROTO_TCP, TCP_NODELAY, 1);
+                    if ($verbose) {
+                        print "Proxy connected to remote host.\n";
                     }
                 }
-                else {
-                    $client_read = 0;
-                    sleep(0.005);
-                }
+                _service($chan);
             }
-            # Recv from server
-            if (!$client_read) {
-                $data = _recv($server_sock);
-                if (!defined($data)) {
-                    if ($server_closed) {
-                        _send_all($client_sock, 2, "");
-                        last;
-                    }
-                    $server_closed = 1;
-                    $client_read = 1;
-                    sleep(0.005);
-                }
-                elsif ($data) {
-                    _send_all($client_sock, 0, $data);
-                }
-                else {
-                    $client_read = 1;
-                    sleep(0.005);
+            foreach my $sock (@$readable) {
+                last if !$client_sock;
+                if ($sock == $client_sock) {
+                    _tunnel();
+                    next;
                 }
+                my $chan = _chan($sock);
+                _relay($chan) if defined($chan);
             }
         }
+        foreach my $chan (keys %channels) {
+            _drop($chan);
+        }
     }
 }
 
-sub _send_all {
-    # Send data or a command
-    my $sock = $_[0];
-    my $cmd = $_[1];
-    my $data = $_[2];
-    my $data_len = length($data);
-    my $header = pack("CI>", $cmd, $data_len);
-    my $msg = $header . $data;
-    _sendall($sock, $msg);
+sub _tunnel {
+    # Read frames from the client
+    my $bytes_read = sysread($client_sock, $rbuf, $max_frame, length($rbuf));
+    if (!defined($bytes_read)) {
+        if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+            _close($client_sock);
+            $client_sock = undef;
+        }
+        return;
+    }
+    if ($bytes_read == 0) {
+        # Client is gone, stop the proxy
+        _close($client_sock);
+        $client_sock = undef;
+        return;
+    }
+    my $pos = 0;
+    my $total = length($rbuf);
+    while ($total - $pos >= 9) {
+        my ($cmd, $chan, $data_len) = unpack("CI>I>", substr($rbuf, $pos, 9));
+        last if $pos + 9 + $data_len > $total;
+        my $data = substr($rbuf, $pos + 9, $data_len);
+        $pos += 9 + $data_len;
+        _handle($cmd, $chan, $data);
+    }
+    # Keep the partial frame for the next read
+    substr($rbuf, 0, $pos, "");
 }
 
-sub _sendall {
-    # Send until all data is sent
-    my $soc = $_[0];
-    my $data_to_send = $_[1];
-    my $total_sent = 0;
-    my $data_length = length($data_to_send);
-    while ($total_sent < $data_length) {
-        my $bytes_sent = $soc->send(substr($data_to_send, $total_sent), 0);
-        if (!defined $bytes_sent) {
-            die "Error sending data: $!";
+sub _handle {
+    # Apply a frame from the client to its channel
+    my ($cmd, $chan, $data) = @_;
+    if ($cmd == 4) { # hello
+        if (length($data) >= 5) {
+            my ($flags, $frame) = unpack("CI>", $data);
+            $data_size = $frame < $max_frame ? $frame : $max_frame;
+        }
+        return;
+    }
+    if ($cmd == 1) { # connect to remote host
+        my $server_sock = _connect($rhost, $rport, 0);
+        if (!$server_sock) {
+            _send_all(2, $chan, "");
+            return;
         }
-        $total_sent += $bytes_sent;
+        $channels{$chan} = {
+            sock => $server_sock,
+            pend => "", # data waiting for the server
+            connected => 0,
+            eof_in => 0, # client sent EOF
+            eof_out => 0, # server sent EOF
+            shut => 0, # EOF forwarded to the server
+            closing => 0,
+            rsize => 16384
+        };
+        $socks{fileno($server_sock)} = $chan;
+        return;
+    }
+    my $st = $channels{$chan};
+    if (!$st) {
+        # Frame for a channel that is already gone
+        return;
+    }
+    if ($cmd == 0) { # data
+        $st->{pend} .= $data;
+    }
+    elsif ($cmd == 3) { # client is done sending
+        $st->{eof_in} = 1;
     }
+    elsif ($cmd == 2) { # close socket
+        $st->{closing} = 1;
+    }
+    _service($chan);
 }
 
-sub _recv_all {
-    # TCP recv n bytes
-    my $so = $_[0];
-    my $n = $_[1];
+sub _relay {
+    # Read from a server and forward it to the client
+    my $chan = $_[0];
+    my $st = $channels{$chan};
     my $data = "";
-    my $chunk = "";
-    my $dlen = 0;
-    my $bytes_read = "";
-    while ($dlen < $n) {
-        if (defined($bytes_read = $so->recv($chunk, ($n - $dlen)))) {
-            if (!$bytes_read and !$chunk) {
-                # Socket is closed
-                return undef;
-            }
-            $data .= $chunk;
-            $dlen += length($chunk);
+    my $bytes_read = sysread($st->{sock}, $data, $st->{rsize});
+    if (!defined($bytes_read)) {
+        if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+            _fail($chan);
         }
-        else {
-            # No data available
-            return "";
+        return;
+    }
+    if ($bytes_read == 0) {
+        $st->{eof_out} = 1;
+        _send_all(3, $chan, "");
+        _service($chan);
+        return;
+    }
+    # Grow reads while they fill the buffer, shrink them for small messages
+    if ($bytes_read == $st->{rsize} and $st->{rsize} < $data_size) {
+        $st->{rsize} *= 2;
+    }
+    elsif ($bytes_read < $st->{rsize} / 4 and $st->{rsize} > $min_read) {
+        $st->{rsize} /= 2;
+    }
+    $st->{rsize} = $data_size if $st->{rsize} > $data_size;
+    _send_all(0, $chan, $data);
+}
+
+sub _service {
+    # Flush a channel, forward EOFs and drop it when both sides are done
+    my $chan = $_[0];
+    my $st = $channels{$chan};
+    if ($st->{connected} and length($st->{pend})) {
+        my $sent = syswrite($st->{sock}, $st->{pend});
+        if (!defined($sent)) {
+            if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+                _fail($chan);
+                return;
+            }
+            $sent = 0;
         }
+        substr($st->{pend}, 0, $sent, "");
+    }
+    if ($st->{connected} and !length($st->{pend}) and $st->{eof_in} and !$st->{shut}) {
+        $st->{shut} = 1;
+        $st->{sock}->shutdown(1);
+    }
+    if (!length($st->{pend}) and ($st->{closing} or ($st->{eof_in} and $st->{eof_out}))) {
+        _drop($chan);
     }
-    # Return available data of specified length
-    return $data;
 }
 
-sub _recv {
-    # Receive bytes
-    my $recv_sock = $_[0];
-    my $data = "";
-    my $bytes_read = "";
-    if (defined($bytes_read = $recv_sock->recv($data, $data_size))) {
-        if (!$bytes_read and !$data) {
-            # Client disconnected gracefully
-            return undef;
+sub _chan {
+    # Find the channel of a server socket
+    my $sock = $_[0];
+    my $chan = $socks{fileno($sock)};
+    return undef unless (defined($chan) and $channels{$chan} and $channels{$chan}->{sock} == $sock);
+    return $chan;
+}
+
+sub _fail {
+    # Close a broken server socket and tell the client
+    my $chan = $_[0];
+    _send_all(2, $chan, "");
+    _drop($chan);
+}
+
+sub _drop {
+    # Close a channel's server socket and forget the channel
+    my $chan = $_[0];
+    my $sock = $channels{$chan}->{sock};
+    delete $socks{fileno($sock)};
+    delete $channels{$chan};
+    _close($sock);
+    if ($verbose) {
+        print "Proxy disconnected from remote host.\n";
+    }
+}
+
+sub _send_all {
+    # Queue a frame for the client and write as much as it takes
+    my ($cmd, $chan, $data) = @_;
+    return if !$client_sock;
+    $out .= pack("CI>I>", $cmd, $chan, length($data)) . $data;
+    _flush_client();
+}
+
+sub _flush_client {
+    # Write queued frames to the client
+    my $sent = syswrite($client_sock, $out);
+    if (!defined($sent)) {
+        if (!$!{EAGAIN} and !$!{EWOULDBLOCK}) {
+            _close($client_sock);
+            $client_sock = undef;
         }
-        return $data;
+        return;
     }
-    return "";
+    substr($out, 0, $sent, "");
 }
 
 sub _close {
@@ -178,17 +270,15 @@ sub _close {
 
 sub _connect {
     # Connect to a remote port
-    my $host = $_[0];
-    my $port = $_[1];
+    my ($host, $port, $blocking) = @_;
     my $s = new IO::Socket::INET(
         PeerAddr => $host,
         PeerPort => $port,
         Proto    => 'tcp',
         Type     => SOCK_STREAM,
+        Blocking => $blocking,
     ) or return undef;
-    $s->blocking(0); # Non-blocking
     return $s;
 }
 
 start();
-
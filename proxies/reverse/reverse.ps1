@@ -24,18 +24,31 @@ class ReverseProxy {
             if ($this.verbose) {
                 Write-Host "Proxy connected to client."
             }
+            # Announce a single channel proxy
+            [byte[]]$flags = @(0)
+            $this._send_all($client_sock.Client, 4, 0, $flags)
             try {
                 while ($true) {
-                    $header = $this._recv_all($client_sock.Client, 5)
+                    $header = $this._recv_all($client_sock.Client, 9)
                     if ($header -ne $null) {
                         $hdr_obj = $this._unpack_hdr($header)
                         $cmd = $hdr_obj.cmd
+                        $chan = $hdr_obj.chan
+                        if ($hdr_obj.dlen -gt 0) {
+                            # Discard frames left over from a closed channel
+                            $this._recv_all($client_sock.Client, $hdr_obj.dlen) | Out-Null
+                        }
                         if ($cmd -eq 1) {
                             $server_sock = $this._connect($this.rhost, $this.rport)
+                            if (-not $server_sock) {
+                                [byte[]]$nodata = @()
+                                $this._send_all($client_sock.Client, 2, $chan, $nodata)
+                                continue
+                            }
                             if ($this.verbose) {
                                 Write-Host "Proxy connected to remote host."
                             }
-                            $this._switch($client_sock, $server_sock)
+                            $this._switch($client_sock, $server_sock, $chan)
                             $this._close($server_sock)
                             if ($this.verbose) {
                                 Write-Host "Proxy disconnected from remote host."
@@ -55,7 +68,7 @@ class ReverseProxy {
         }
     }
 
-    [void]_switch([System.Net.Sockets.TcpClient]$client, [System.Net.Sockets.TcpClient]$server) {
+    [void]_switch([System.Net.Sockets.TcpClient]$client, [System.Net.Sockets.TcpClient]$server, [uint32]$chan) {
         # Switch between read/write
         $server_closed = $false
         if ($client -and $server) {
@@ -67,15 +80,21 @@ class ReverseProxy {
                 # Recv from client
                 if ($client_read) {
                     try {
-                        $header = $this._recv_all($client_sock, 5)
+                        $header = $this._recv_all($client_sock, 9)
                         if ($header -ne $null) {
                             $hdr_obj = $this._unpack_hdr($header)
                             $cmd = $hdr_obj.cmd
                             $data_len = $hdr_obj.dlen
-                            if ($cmd -eq 0) { # data
-                                $data = $this._recv_all($client_sock, $data_len)
+                            $frame = $null
+                            if ($data_len -gt 0) {
+                                $frame = $this._recv_all($client_sock, $data_len)
+                            }
+                            if ($hdr_obj.chan -ne $chan) {
+                                # Only one channel is relayed at a time
+                            }
+                            elseif ($cmd -eq 0) { # data
                                 if (-not $server_closed) {
-                                    $this._sendall($server_sock, $data)
+                                    $this._sendall($server_sock, $frame)
                                 }
                                 else {
                                     $client_read = $false
@@ -85,6 +104,9 @@ class ReverseProxy {
                             elseif ($cmd -eq 2) { # close socket
                                 break
                             }
+                            elseif ($cmd -eq 3) { # client is done sending
+                                $server_sock.Shutdown([System.Net.Sockets.SocketShutdown]::Send)
+                            }
                         }
                         else {
                             $client_read = $false
@@ -113,13 +135,13 @@ class ReverseProxy {
                         $bytes_read = $server_sock.Receive($data)
                         if ($bytes_read -gt 0) {
                             $received_data = $data[0..($bytes_read - 1)]
-                            $this._send_all($client_sock, 0, $received_data)
+                            $this._send_all($client_sock, 0, $chan, $received_data)
                         }
                         else {
                             # Server socket is closed
                             if ($server_closed) {
                                 [byte[]]$nodata = @()
-                                $this._send_all($client_sock, 2, $nodata)
+                                $this._send_all($client_sock, 2, $chan, $nodata)
                                 break
                             }
                             $server_closed = $true
@@ -159,33 +181,39 @@ class ReverseProxy {
         }
     }
 
-    [void]_send_all([System.Net.Sockets.Socket]$sock, [byte]$cmd, [byte[]]$data) {
+    [void]_send_all([System.Net.Sockets.Socket]$sock, [byte]$cmd, [uint32]$chan, [byte[]]$data) {
         # Send data or a command
         $data_len = [uint32]$data.Length
-        $hdr = $this._pack_hdr($cmd, $data_len)
+        $hdr = $this._pack_hdr($cmd, $chan, $data_len)
         $msg = $hdr + $data
         $this._sendall($sock, $msg)
     }
 
-    [byte[]]_pack_hdr([byte]$cmd, [uint32]$data_len) {
+    [byte[]]_pack_hdr([byte]$cmd, [uint32]$chan, [uint32]$data_len) {
         # Pack message header
+        $chn = [System.BitConverter]::GetBytes($chan)
         $dlen = [System.BitConverter]::GetBytes($data_len)
         if ([System.BitConverter]::IsLittleEndian) {
+            [System.Array]::Reverse($chn)
             [System.Array]::Reverse($dlen)
         }
-        return [byte[]]($cmd) + $dlen
+        return [byte[]]($cmd) + $chn + $dlen
     }
 
     [pscustomobject]_unpack_hdr([byte[]]$hdr) {
         # Unpack message header
         $cmd = $hdr[0]
-        $dlen = $hdr[1..4]
+        [byte[]]$chn = $hdr[1..4]
+        [byte[]]$dlen = $hdr[5..8]
         if ([System.BitConverter]::IsLittleEndian) {
+            [System.Array]::Reverse($chn)
             [System.Array]::Reverse($dlen)
         }
+        $chan = [System.BitConverter]::ToUInt32($chn, 0)
         $data_len = [System.BitConverter]::ToUInt32($dlen, 0)
         return [PSCustomObject]@{
             cmd = $cmd
+            chan = $chan
             dlen = $data_len
         }
     }
@@ -1,121 +1,1001 @@
 #! /usr/bin/env python3
 
+import os
 import time
+import json
+import errno
+import signal
+import zlib
 import struct
 import socket
+import selectors
+import collections
 
 class ReverseProxy:
 
-    def __init__(self, chost: str, cport: int, rhost: str, rport: str, verbose: bool=True) -> None:
+    # Tunnel frame header: command, channel id, payload length
+    HEADER = struct.Struct(">BII")
+    # Striped tunnel frame header: sequence number, then the frame header
+    SEQ_HEADER = struct.Struct(">IBII")
+    # HELLO payload: feature flags, largest frame accepted
+    HELLO_BODY = struct.Struct(">BI")
+    # Optional HELLO payload tail: more feature flags
+    HELLO_MORE = struct.Struct(">B")
+    # OPEN payload: kind, then a target port followed by its host, or a forward index
+    OPEN_BODY = struct.Struct(">BH")
+    # PING payload: sender's clock, echoed back in the PONG
+    STAMP = struct.Struct(">d")
+    # RATE payload: tunnel and session limits in bytes per second, 0 for none
+    RATE_BODY = struct.Struct(">II")
+    DATA, OPEN, CLOSE, EOF, HELLO, HEARTBEAT, PING, PONG, PAUSE, RESUME, RATE = range(11)
+    MULTIPLEX = 0x01 # HELLO flag: many channels at once
+    COMPRESS = 0x02 # HELLO flag: compressed data frames are understood
+    STRIPED = 0x10 # HELLO flag: frames may be striped over several connections
+    KEEPALIVE = 0x20 # HELLO flag: heartbeats are sent while idle
+    PINGS = 0x40 # HELLO flag: PING frames are answered
+    FLOW = 0x80 # HELLO flag: PAUSE and RESUME frames are honoured
+    SHAPING = 0x01 # More HELLO flags: RATE frames are honoured
+    # 0x04 and 0x08 in the first byte once meant OPEN payloads typed by their length
+    TARGETS = 0x02 # More HELLO flags: OPEN frames may name their own target
+    FORWARDS = 0x04 # More HELLO flags: OPEN frames may pick a forward by index
+    OPEN_TARGET, OPEN_FORWARD = 1, 2 # OPEN payload kinds, an empty OPEN dials RHOST:RPORT
+    KEEP = 0xffffffff # RATE value that leaves a limit unchanged
+    COMPRESSED = 0x80 # Command flag: payload is zlib compressed
+    ZMIN = 512 # Smaller payloads are always sent raw
+    HIGH_WATER = 1048576 # Queued bytes that stop reading the side feeding a queue
+    LOW_WATER = 262144 # Queued bytes that start reading it again
+    BULK_WATER = 65536 # Tunnel backlog that stops bulk channels being read
+    BULK = 131072 # Recent bytes that make a channel bulk rather than interactive
+    HEAT_LIFE = 1 # Seconds for a channel's count of recent bytes to halve
+    BURST = 0.05 # Seconds of traffic a token bucket holds
+    QUANTUM = 4096 # Smallest token bucket, so slow limits still read whole chunks
+    DEFAULT_FRAME = 65536 # Frame size assumed until the peer says otherwise
+    CONNECT_DELAY = 0.25 # Seconds before racing the next address (RFC 8305)
+    DNS_TTL = 60 # Seconds a resolved host is reused
+
+    def __init__(self, chost: str, cport: int, rhost: str, rport: str, verbose: bool=True, max_frame: int=262144, compress: bool=False, pool_size: int=0, pool_idle: float=10, forwards: list=[], streams: int=1, heartbeat: float=10, reconnect: float=300, connect_timeout: float=10, stats: str=None, stats_interval: float=10, rate: float=0, session_rate: float=0) -> None:
         '''Initialize reverse TCP proxy'''
         self.chost = chost # Client host
         self.cport = cport
         self.rhost = rhost # Remote host
         self.rport = rport
-        self.data_size = 4096
+        self.max_frame = max_frame # Largest frame we accept
         self.verbose = verbose
+        self.sel = selectors.DefaultSelector()
+        self.streams = streams # Connections to stripe the tunnel over
+        self.heartbeat = heartbeat # Idle seconds between heartbeats, 0 disables them
+        self.reconnect = reconnect # Seconds to keep reconnecting to the client
+        self.stopped = False
+        self._reset()
+        # Reads from servers land in a scratch buffer
+        self.scratch = memoryview(bytearray(max_frame))
+        self.channels = {} # channel id -> channel state
+        self.socks = {} # server socket -> channel id
+        self.sendmsg = hasattr(socket.socket, "sendmsg")
+        self.compress = compress # Compress data frames we send
+        self.zraw = 0 # Data bytes before compression
+        self.zwire = 0 # Data bytes as sent
+        # Connections to the remote host opened ahead of OPEN frames
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle # Seconds before an unused connection is replaced
+        self.pool = {} # pooled socket -> time it connected
+        self.pool_dials = [] # pooled connections still being dialed
+        self.pool_retry = 0 # Time of the next refill after a failed connect
+        self.pool_backoff = 1
+        self.forwards = forwards # (local port, remote host, remote port) per forward
+        self.connect_timeout = connect_timeout # Seconds before a dial gives up
+        self.dns = {} # (host, port) -> (expiry, addresses)
+        self.dials = [] # connections to remote hosts still being raced
+        self.dialing = {} # connecting socket -> dial
+        self.stats = stats # JSON-lines file for stats records, None for none
+        self.stats_interval = stats_interval # Seconds between stats records and pings
+        self.totals = {"sessions": 0, "failed": 0, "bytes_up": 0, "bytes_down": 0}
+        self.tunnel = {"frames_in": 0, "frames_out": 0, "bytes_in": 0, "bytes_out": 0}
+        self.started = time.monotonic()
+        self.busy = 0 # Seconds spent handling events since the last record
+        self.busy_since = self.started
+        self.next_tick = self.started
+        # Limits on data read from servers, in KiB/s, 0 for none
+        self.bucket = self._bucket(rate * 1024) # shared by every channel
+        self.session_rate = session_rate * 1024 # each channel's own
 
     def start(self) -> None:
-        '''Start proxy'''
-        client_sock = self._connect(self.chost, self.cport)
-        if client_sock:
+        '''Start proxy, reconnecting to the client with backoff'''
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self._dump)
+        backoff = 1
+        since = time.monotonic() # When the client was last reachable
+        while not self.stopped:
+            if self._session():
+                backoff = 1
+                since = time.monotonic()
+            if self.stopped or time.monotonic() - since >= self.reconnect:
+                break
             if self.verbose:
-                print("Proxy connected to client.")
-            while 1:
+                print(f"Reconnecting to client in {backoff}s.")
+            try:
+                time.sleep(backoff)
+            except KeyboardInterrupt:
+                break
+            backoff = min(backoff * 2, 30)
+        for sock in list(self.pool):
+            self._unpool(sock)
+        for dial in self.pool_dials:
+            self._cancel(dial)
+        self._report()
+
+    def _session(self) -> bool:
+        '''Relay one tunnel until it drops, False if the client is unreachable'''
+        self._reset()
+        self.client_sock = self._connect(self.chost, self.cport)
+        if not self.client_sock:
+            return False
+        if self.verbose:
+            print("Proxy connected to client.")
+        self._link(self.client_sock)
+        flags = self.MULTIPLEX | self.COMPRESS | self.PINGS | self.FLOW
+        if self.streams > 1:
+            flags |= self.STRIPED
+        if self.heartbeat:
+            flags |= self.KEEPALIVE
+        more = self.SHAPING | self.TARGETS | self.FORWARDS
+        hello = self.HELLO_BODY.pack(flags, self.max_frame) + self.HELLO_MORE.pack(more)
+        self._send_all(self.HELLO, 0, hello)
+        timeout = self._wake()
+        while self.client_sock:
+            try:
+                events = self.sel.select(timeout)
+                start = time.monotonic()
+                for key, mask in events:
+                    key.data(key.fileobj, mask)
+                self.busy += time.monotonic() - start
+                timeout = self._wake()
+            except KeyboardInterrupt:
+                self.stopped = True
+                break
+        for chan in list(self.channels):
+            self._drop(chan)
+        for sock in self.links:
+            if self.sel.get_map().get(sock):
+                self.sel.unregister(sock)
+            self._close(sock)
+        return True
+
+    def _reset(self) -> None:
+        '''Forget the state of a previous tunnel'''
+        self.data_size = min(self.max_frame, self.DEFAULT_FRAME) # Largest frame we send
+        self.client_sock = None
+        self.links = {} # tunnel socket -> link state
+        self.order = [] # links in the order frames are striped over them
+        self.next_link = 0
+        self.striped = False # Frames carry sequence numbers
+        self.tx_seq = 0 # Sequence number of the next frame we send
+        self.rx_seq = 0 # Sequence number of the next frame to handle
+        self.reorder = {} # sequence number -> frame that arrived early
+        self.zpeer = False # Compress and the client can decompress
+        self.beats = False # Client sends heartbeats
+        self.last_rx = self.last_tx = time.monotonic()
+        self.pings = False # Client answers PING frames
+        self.rtt = None # Last tunnel round trip in milliseconds
+        self.rtt_min = None
+        self.flow = False # Client honours PAUSE and RESUME frames
+        self.backlog = 0 # Bytes queued for the client on every link
+        self.choked = False # Channel sockets are not read while the backlog drains
+        self.stalled = set() # channels whose queue stops the tunnel being read
+        self.yielding = False # Bulk channels are not read while the backlog drains
+        self.throttled = {} # channel id -> time its token buckets refill
+
+    def _wake(self) -> float:
+        '''Run timed work and return the select timeout'''
+        waits = [self._maintain(), self._race(), self._beat(), self._tick(), self._shape()]
+        waits = [t for t in waits if t is not None]
+        return min(waits) if waits else None
+
+    def _beat(self) -> float:
+        '''Send a heartbeat when idle and drop a silent tunnel, return the next deadline'''
+        if not self.heartbeat or not self.beats or not self.client_sock:
+            return None
+        now = time.monotonic()
+        if now - self.last_rx >= 3 * self.heartbeat:
+            if self.verbose:
+                print("Client stopped responding.")
+            self._lost()
+            return None
+        if now - self.last_tx >= self.heartbeat:
+            self._send_all(self.HEARTBEAT, 0, b"")
+        wake = min(self.last_tx + self.heartbeat, self.last_rx + 3 * self.heartbeat)
+        return max(wake - now, 0)
+
+    def _link(self, sock: socket.socket) -> None:
+        '''Start relaying frames over a connection to the client'''
+        # Frames are written whole, so do not wait to coalesce them
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        rbuf = bytearray(2 * (self.SEQ_HEADER.size + self.max_frame))
+        link = {
+            "sock": sock,
+            "rbuf": rbuf, # frames are received into one reusable buffer
+            "rview": memoryview(rbuf),
+            "rend": 0,
+            "outq": collections.deque(), # buffers queued for the client
+            "held": 0 # frames waiting in the reorder buffer
+        }
+        self.links[sock] = link
+        self.order.append(link)
+        self.sel.register(sock, selectors.EVENT_READ, self._tunnel)
+
+    def _stripe(self) -> None:
+        '''Open the extra connections once the client agreed to stripe'''
+        self.striped = True
+        for i in range(self.streams - 1):
+            sock = self._connect(self.chost, self.cport)
+            if not sock:
+                break
+            self._link(sock)
+        if self.verbose:
+            print(f"Tunnel striped over {len(self.links)} connections.")
+
+    def _lost(self) -> None:
+        '''End the session, start() reconnects to the client with backoff'''
+        for sock in self.links:
+            if self.sel.get_map().get(sock):
+                self.sel.unregister(sock)
+        self.client_sock = None
+
+    def _tunnel(self, sock: socket.socket, mask: int) -> None:
+        '''Read frames from and write frames to the client'''
+        link = self.links[sock]
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.backlog -= self._flush(sock, link["outq"])
+                if self.choked and self.backlog <= self.LOW_WATER:
+                    self._choke(False)
+                if self.yielding and self.backlog <= self.BULK_WATER // 4:
+                    self._yield(False)
+            if mask & selectors.EVENT_READ:
+                n = sock.recv_into(link["rview"][link["rend"]:])
+                if not n:
+                    # Client is gone, end the session
+                    self._lost()
+                    return
+                link["rend"] += n
+                self.tunnel["bytes_in"] += n
+                self.last_rx = time.monotonic()
+                self._parse(link)
+        except BlockingIOError:
+            pass
+        except:
+            self._lost()
+            return
+        self._arm(link)
+
+    def _arm(self, link: dict) -> None:
+        '''Update the events of a connection to the client'''
+        if not self.client_sock:
+            return
+        events = 0
+        # Frames after a missing one are not read until it arrives,
+        # and none are read while a channel cannot keep up without flow control
+        if not link["held"] and not self.stalled:
+            events |= selectors.EVENT_READ
+        if link["outq"]:
+            events |= selectors.EVENT_WRITE
+        sock = link["sock"]
+        key = self.sel.get_map().get(sock)
+        if not events:
+            if key:
+                self.sel.unregister(sock)
+        elif not key:
+            self.sel.register(sock, events, self._tunnel)
+        elif key.events != events:
+            self.sel.modify(sock, events, self._tunnel)
+
+    def _parse(self, link: dict) -> None:
+        '''Handle every complete frame in a link's receive buffer'''
+        rbuf = link["rbuf"]
+        pos = 0
+        while self.client_sock:
+            size = self.SEQ_HEADER.size if self.striped else self.HEADER.size
+            if link["rend"] - pos < size:
+                break
+            if self.striped:
+                seq, cmd, chan, data_len = self.SEQ_HEADER.unpack_from(rbuf, pos)
+            else:
+                seq = None
+                cmd, chan, data_len = self.HEADER.unpack_from(rbuf, pos)
+            if data_len > self.max_frame:
+                # We announced max_frame, so this header is corrupt or hostile
+                if self.verbose:
+                    print(f"Frame of {data_len} bytes from the client, tunnel dropped.")
+                self._lost()
+                return
+            end = pos + size + data_len
+            if end > link["rend"]:
+                # The buffer holds two of the largest frames, so the rest fits
+                break
+            # Payload is handed on as a view into the buffer, not a copy
+            data = link["rview"][pos + size:end]
+            pos = end
+            if seq is None:
+                self._handle(cmd, chan, data)
+            elif seq == self.rx_seq:
+                self.rx_seq = (seq + 1) & 0xffffffff
+                self._handle(cmd, chan, data)
+                self._release()
+            else:
+                # An earlier frame is still on another link
+                self.reorder[seq] = (link, cmd, chan, bytes(data))
+                link["held"] += 1
+        if pos:
+            # Keep the partial frame at the front of the buffer
+            rend = link["rend"]
+            rbuf[:rend - pos] = rbuf[pos:rend]
+            link["rend"] -= pos
+
+    def _release(self) -> None:
+        '''Handle reordered frames that are now next in sequence'''
+        while self.rx_seq in self.reorder:
+            link, cmd, chan, data = self.reorder.pop(self.rx_seq)
+            self.rx_seq = (self.rx_seq + 1) & 0xffffffff
+            link["held"] -= 1
+            self._handle(cmd, chan, data)
+            if not link["held"]:
+                self._arm(link)
+
+    def _handle(self, cmd: int, chan: int, data: memoryview) -> None:
+        '''Apply a frame from the client to its channel'''
+        self.tunnel["frames_in"] += 1
+        if cmd == self.HELLO:
+            if len(data) >= self.HELLO_BODY.size:
+                flags, peer_frame = self.HELLO_BODY.unpack_from(data)
+                self.data_size = min(self.max_frame, peer_frame)
+                self.zpeer = self.compress and bool(flags & self.COMPRESS)
+                self.beats = bool(flags & self.KEEPALIVE)
+                self.pings = bool(flags & self.PINGS)
+                self.flow = bool(flags & self.FLOW)
+                if flags & self.STRIPED and self.streams > 1 and not self.striped:
+                    # Every frame after the client's HELLO carries a sequence number
+                    self._stripe()
+            return
+        if cmd == self.HEARTBEAT:
+            return
+        if cmd == self.PING:
+            self._send_all(self.PONG, 0, bytes(data))
+            return
+        if cmd == self.PONG:
+            if len(data) == self.STAMP.size:
+                sent, = self.STAMP.unpack(data)
+                self.rtt = round((time.monotonic() - sent) * 1000, 3)
+                self.rtt_min = min(self.rtt, self.rtt_min or self.rtt)
+            return
+        if cmd == self.RATE:
+            if len(data) == self.RATE_BODY.size:
+                self._limit(chan, *self.RATE_BODY.unpack(data))
+            return
+        if cmd == self.OPEN:
+            server_sock, dial = None, None
+            kind = None
+            if len(data) >= self.OPEN_BODY.size:
+                kind, value = self.OPEN_BODY.unpack_from(data)
+            if not data:
+                host, port = self.rhost, self.rport
+                server_sock, dial = self._take()
+            elif kind == self.OPEN_TARGET:
+                # The client picked the target, pooled connections do not apply
+                host = bytes(data[self.OPEN_BODY.size:]).decode("utf-8", "replace")
+                port = value
+            elif kind == self.OPEN_FORWARD and value < len(self.forwards):
+                lport, host, port = self.forwards[value]
+            else:
+                # Unknown kind or forward, refused below
+                host, port = None, None
+            if not server_sock and not dial and host:
+                dial = self._dial(host, port, self._opened)
+            if not server_sock and not dial:
+                self.totals["sessions"] += 1
+                self.totals["failed"] += 1
+                self._send_all(self.CLOSE, chan, b"")
+                return
+            self.channels[chan] = {
+                "sock": None,
+                "queue": collections.deque(), # data waiting for the server
+                "connected": False,
+                "dial": dial, # connection attempts still racing
+                "eof_in": False, # client sent EOF
+                "eof_out": False, # server sent EOF
+                "shut": False, # EOF forwarded to the server
+                "closing": False,
+                "ack": kind == self.OPEN_TARGET, # client waits to hear the connect worked
+                "zskip": 0, # data frames to send raw before trying again
+                "zmiss": 8,
+                "queued": 0, # bytes in the queue
+                "paused": False, # the client was asked to stop sending
+                "held": False, # the client asked us to stop sending
+                "bucket": self._bucket(self.session_rate),
+                "heat": 0, # bytes read lately, decaying
+                "heated": time.monotonic(),
+                "target": f"{host}:{port}",
+                "start": time.monotonic(),
+                "connect_ms": None, # OPEN to server connected
+                "ttfb_ms": None, # OPEN to the first byte from the server
+                "bytes_up": 0, # client to server
+                "bytes_down": 0, # server to client
+                "error": None
+            }
+            if server_sock:
+                self._attach(chan, server_sock)
+            else:
+                # Pooled dials are handed over still racing
+                dial["done"] = self._opened
+                dial["chan"] = chan
+            return
+        state = self.channels.get(chan)
+        if not state:
+            # Frame for a channel that is already gone
+            return
+        if cmd & self.COMPRESSED:
+            cmd ^= self.COMPRESSED
+            data = self._inflate(data)
+            if data is None:
+                self._send_all(self.CLOSE, chan, b"")
+                self._drop(chan)
+                return
+        if cmd == self.DATA:
+            state["bytes_up"] += len(data)
+            if state["connected"] and not state["queue"]:
                 try:
-                    header = self._recv_all(client_sock, 5)
-                    if header:
-                        cmd, data_len = struct.unpack(">BI", header)
-                        # connect to remote host
-                        if cmd == 1:
-                            server_sock = self._connect(self.rhost, self.rport)
-                            if self.verbose:
-                                print("Proxy connected to remote host.")
-                            self._switch(client_sock, server_sock)
-                            self._close(server_sock)
-                            if self.verbose:
-                                print("Proxy disconnected from remote host.")
-                    else:
-                        time.sleep(0.005)
-                except KeyboardInterrupt:
+                    data = data[state["sock"].send(data):]
+                except BlockingIOError:
+                    pass
+                except:
+                    self._send_all(self.CLOSE, chan, b"")
+                    self._drop(chan)
+                    return
+            if data:
+                # The receive buffer is reused, keep a copy of the rest
+                state["queue"].append(bytes(data))
+                state["queued"] += len(data)
+                if state["queued"] > self.HIGH_WATER and not state["paused"]:
+                    self._pause(chan, True)
+        elif cmd == self.PAUSE:
+            state["held"] = True
+        elif cmd == self.RESUME:
+            state["held"] = False
+        elif cmd == self.EOF:
+            state["eof_in"] = True
+        elif cmd == self.CLOSE:
+            state["closing"] = True
+        self._service(chan)
+
+    def _relay(self, sock: socket.socket, mask: int) -> None:
+        '''Relay between a server socket and its channel'''
+        chan = self.socks.get(sock)
+        if chan is None:
+            return
+        state = self.channels[chan]
+        try:
+            if mask & selectors.EVENT_READ:
+                wait = self._shaped(state)
+                if wait:
+                    # Out of tokens, read again once they refill
+                    self.throttled[chan] = time.monotonic() + wait
+                    n = None
+                else:
+                    n = sock.recv_into(self.scratch, self._quantum(state))
+                if n:
+                    self._charge(state, n)
+                    if state["ttfb_ms"] is None:
+                        state["ttfb_ms"] = round((time.monotonic() - state["start"]) * 1000, 3)
+                    state["bytes_down"] += n
+                    cmd, data = self._deflate(state, self.scratch[:n])
+                    self._send_all(cmd, chan, data)
+                elif n == 0:
+                    state["eof_out"] = True
+                    self._send_all(self.EOF, chan, b"")
+        except BlockingIOError:
+            pass
+        except:
+            self._send_all(self.CLOSE, chan, b"")
+            self._drop(chan)
+            return
+        self._service(chan)
+
+    def _service(self, chan: int) -> None:
+        '''Flush a channel, forward EOFs and update its events'''
+        state = self.channels[chan]
+        sock = state["sock"]
+        if state["connected"]:
+            try:
+                state["queued"] -= self._flush(sock, state["queue"])
+                if state["paused"] and state["queued"] <= self.LOW_WATER:
+                    self._pause(chan, False)
+                if not state["queue"] and state["eof_in"] and not state["shut"]:
+                    state["shut"] = True
+                    sock.shutdown(socket.SHUT_WR)
+            except BlockingIOError:
+                pass
+            except:
+                self._send_all(self.CLOSE, chan, b"")
+                self._drop(chan)
+                return
+        if not state["queue"] and (state["closing"] or \
+                (state["eof_in"] and state["eof_out"])):
+            self._drop(chan)
+            return
+        self._watch(chan)
+
+    def _watch(self, chan: int) -> None:
+        '''Select a channel's events from its state'''
+        state = self.channels[chan]
+        sock = state["sock"]
+        if not state["connected"]:
+            # Data waits in the queue until the dial hands over a socket
+            return
+        events = 0
+        if state["queue"]:
+            events |= selectors.EVENT_WRITE
+        # Nothing is read while the peer or the tunnel cannot take more or the
+        # channel waits for tokens, and bulk channels yield a backed up tunnel
+        if not state["eof_out"] and not state["closing"] and \
+                not state["held"] and not self.choked and chan not in self.throttled and \
+                not (self.yielding and self._bulk(state)):
+            events |= selectors.EVENT_READ
+        key = self.sel.get_map().get(sock)
+        if not events:
+            if key:
+                self.sel.unregister(sock)
+        elif not key:
+            self.sel.register(sock, events, self._relay)
+        elif key.events != events:
+            self.sel.modify(sock, events, self._relay)
+
+    def _attach(self, chan: int, sock: socket.socket) -> None:
+        '''Start relaying a channel over its connected server socket'''
+        state = self.channels[chan]
+        state["sock"] = sock
+        state["connected"] = True
+        state["dial"] = None
+        state["connect_ms"] = round((time.monotonic() - state["start"]) * 1000, 3)
+        self.socks[sock] = chan
+        if self.verbose:
+            print("Proxy connected to remote host.")
+        if state["ack"]:
+            self._send_all(self.OPEN, chan, b"")
+        self._service(chan)
+
+    def _opened(self, dial: dict, sock: socket.socket) -> None:
+        '''Hand a channel the socket its dial won, or refuse the channel'''
+        chan = dial["chan"]
+        self.channels[chan]["dial"] = None
+        if not sock:
+            self.channels[chan]["error"] = "connect failed"
+            self._send_all(self.CLOSE, chan, b"")
+            self._drop(chan)
+            return
+        self._attach(chan, sock)
+
+    def _drop(self, chan: int) -> None:
+        '''Close a channel's server socket and forget the channel'''
+        state = self.channels.pop(chan)
+        self._ended(chan, state)
+        if chan in self.stalled:
+            self._pause(chan, False)
+        self.throttled.pop(chan, None)
+        if state["dial"]:
+            self._cancel(state["dial"])
+        sock = state["sock"]
+        if sock:
+            self.socks.pop(sock, None)
+            try:
+                self.sel.unregister(sock)
+            except:
+                pass
+            self._close(sock)
+        if self.verbose:
+            print("Proxy disconnected from remote host.")
+
+    def _maintain(self) -> float:
+        '''Expire and refill pooled connections, return the select timeout'''
+        if not self.pool_size:
+            return None
+        now = time.monotonic()
+        for sock, since in list(self.pool.items()):
+            if now - since >= self.pool_idle:
+                # The remote host may drop idle connections, replace it
+                self._unpool(sock)
+        if now >= self.pool_retry:
+            while len(self.pool) + len(self.pool_dials) < self.pool_size:
+                dial = self._dial(self.rhost, self.rport, self._pool_dialed)
+                if not dial:
+                    self._pool_failed(now)
                     break
-            self._close(client_sock)
-
-    def _switch(self, client_sock: socket.socket, server_sock: socket.socket) -> None:
-        '''Switch between read/write'''
-        server_closed = False
-        if client_sock and server_sock:
-            # Switching toggle
-            client_read = True
-            while 1:
-                # Recv from client
-                if client_read:
-                    try:
-                        header = self._recv_all(client_sock, 5)
-                        if header:
-                            cmd, data_len = struct.unpack(">BI", header)
-                            if cmd == 0:
-                                data = self._recv_all(client_sock, data_len)
-                                if not server_closed:
-                                    server_sock.sendall(data)
-                                else:
-                                    client_read = False
-                                    time.sleep(0.005)
-                            elif cmd == 2: # close socket
-                                break
-                        else:
-                            client_read = False
-                            time.sleep(0.005)
-                    except BlockingIOError:
-                        client_read = False
-                        time.sleep(0.005)
-                    except:
-                        break
-                # Recv from server
-                if not client_read:
-                    try:
-                        data = server_sock.recv(self.data_size)
-                        if data:
-                            self._send_all(client_sock, 0, data)
-                        else:
-                            # Server socket is closed
-                            if server_closed:
-                                self._send_all(client_sock, 2, b"")
-                                break
-                            server_closed = True
-                            client_read = True
-                            time.sleep(0.005)
-                    except BlockingIOError:
-                        client_read = True
-                        time.sleep(0.005)
-                    except:
-                        self._send_all(client_sock, 2, b"")
-                        break
-
-    def _send_all(self, sock: socket.socket, cmd: int, data: bytes) -> None:
-        '''Send data or a command'''
+                self.pool_dials.append(dial)
+        # Wake up for the next expiry or refill attempt
+        wake = [since + self.pool_idle for since in self.pool.values()]
+        if len(self.pool) + len(self.pool_dials) < self.pool_size:
+            wake.append(self.pool_retry)
+        if not wake:
+            return None
+        return max(min(wake) - now, 0)
+
+    def _pool_dialed(self, dial: dict, sock: socket.socket) -> None:
+        '''Keep a freshly connected socket in the pool'''
+        self.pool_dials.remove(dial)
+        if not sock:
+            self._pool_failed(time.monotonic())
+            return
+        self.pool_backoff = 1
+        self.pool[sock] = time.monotonic()
+        # Watch for the remote host closing it while it waits
+        self.sel.register(sock, selectors.EVENT_READ, self._pooled)
+
+    def _pooled(self, sock: socket.socket, mask: int) -> None:
+        '''Track a pooled connection until it is handed to a channel'''
+        if sock not in self.pool:
+            return
         try:
-            data_len = len(data)
-            header = struct.pack(">BI", cmd, data_len)
-            msg = header + data
-            sock.sendall(msg)
+            if sock.recv(1, socket.MSG_PEEK):
+                # Greeting from the remote host, leave it for the channel
+                self.sel.unregister(sock)
+                return
+        except BlockingIOError:
+            return
         except:
             pass
+        # Reset or closed before use, do not reconnect at once
+        self._pool_failed(time.monotonic())
+        self._unpool(sock)
+
+    def _pool_failed(self, now: float) -> None:
+        '''Back off refilling the pool while the remote host refuses us'''
+        self.pool_retry = now + self.pool_backoff
+        self.pool_backoff = min(self.pool_backoff * 2, 30)
+
+    def _take(self) -> tuple:
+        '''Take a (socket, dial) from the pool, connected sockets first'''
+        now = time.monotonic()
+        for sock, since in self.pool.items():
+            if now - since < self.pool_idle:
+                del self.pool[sock]
+                if self.sel.get_map().get(sock):
+                    self.sel.unregister(sock)
+                return sock, None
+        if self.pool_dials:
+            # Still connecting, but it has a head start on a new one
+            return None, self.pool_dials.pop(0)
+        return None, None
+
+    def _unpool(self, sock: socket.socket) -> None:
+        '''Close a pooled connection'''
+        self.pool.pop(sock, None)
+        if self.sel.get_map().get(sock):
+            self.sel.unregister(sock)
+        self._close(sock)
+
+    def _pause(self, chan: int, on: bool) -> None:
+        '''Stop or restart the client sending data for a channel with a full queue'''
+        state = self.channels.get(chan)
+        if state:
+            state["paused"] = on
+        stalled = bool(self.stalled)
+        if on and not self.flow:
+            # Without flow control the only lever is to stop reading the tunnel
+            self.stalled.add(chan)
+        elif not on:
+            self.stalled.discard(chan)
+        if self.flow and state:
+            self._send_all(self.PAUSE if on else self.RESUME, chan, b"")
+        if bool(self.stalled) != stalled:
+            for link in self.order:
+                self._arm(link)
+
+    def _choke(self, on: bool) -> None:
+        '''Stop or restart reading channel sockets while the tunnel backlog drains'''
+        self.choked = on
+        for chan in self.channels:
+            self._watch(chan)
+
+    def _yield(self, on: bool) -> None:
+        '''Stop or restart reading bulk channels so interactive ones find a short queue'''
+        self.yielding = on
+        for chan in self.channels:
+            self._watch(chan)
 
-    def _recv_all(self, sock: socket.socket, n: int) -> bytes:
-        '''TCP recv n bytes'''
-        data = b""
-        dlen = 0
-        while dlen < n:
+    def _bucket(self, rate: float) -> dict:
+        '''Return a full token bucket for rate bytes per second, 0 for no limit'''
+        return {"rate": rate, "tokens": self._burst(rate), "stamp": time.monotonic()}
+
+    def _burst(self, rate: float) -> int:
+        '''Return the most tokens a bucket holds'''
+        return max(int(rate * self.BURST), self.QUANTUM)
+
+    def _refill(self, bucket: dict, now: float) -> None:
+        '''Add the tokens earned since a bucket was last used'''
+        tokens = bucket["tokens"] + (now - bucket["stamp"]) * bucket["rate"]
+        bucket["tokens"] = min(tokens, self._burst(bucket["rate"]))
+        bucket["stamp"] = now
+
+    def _bulk(self, state: dict) -> bool:
+        '''Check whether a channel has moved enough lately to count as bulk'''
+        age = time.monotonic() - state["heated"]
+        return state["heat"] * 0.5 ** (age / self.HEAT_LIFE) > self.BULK
+
+    def _shaped(self, state: dict) -> float:
+        '''Return seconds until a channel may be read under the rate limits, 0 for now'''
+        now = time.monotonic()
+        buckets = [state["bucket"]]
+        if self._bulk(state):
+            # Interactive channels spend tunnel tokens but never wait for them
+            buckets.append(self.bucket)
+        wait = 0
+        for bucket in buckets:
+            if bucket["rate"]:
+                self._refill(bucket, now)
+                if bucket["tokens"] <= 0:
+                    wait = max(wait, (1 - bucket["tokens"]) / bucket["rate"])
+        return wait
+
+    def _quantum(self, state: dict) -> int:
+        '''Return how much to read from a channel without bursting past its limits'''
+        size = self.data_size
+        for bucket in (state["bucket"], self.bucket):
+            if bucket["rate"]:
+                size = min(size, self._burst(bucket["rate"]))
+        return size
+
+    def _charge(self, state: dict, n: int) -> None:
+        '''Take bytes read from a channel out of its token buckets'''
+        now = time.monotonic()
+        age = now - state["heated"]
+        state["heat"] = state["heat"] * 0.5 ** (age / self.HEAT_LIFE) + n
+        state["heated"] = now
+        for bucket in (state["bucket"], self.bucket):
+            if bucket["rate"]:
+                self._refill(bucket, now)
+                # Debt is capped so a busy interactive channel cannot starve bulk ones for long
+                bucket["tokens"] = max(bucket["tokens"] - n, -self._burst(bucket["rate"]))
+
+    def _shape(self) -> float:
+        '''Read throttled channels again once their tokens refill, return the select timeout'''
+        if not self.throttled:
+            return None
+        now = time.monotonic()
+        for chan, until in list(self.throttled.items()):
+            if until <= now:
+                del self.throttled[chan]
+                self._watch(chan)
+        if not self.throttled:
+            return None
+        return max(min(self.throttled.values()) - now, 0)
+
+    def _limit(self, chan: int, tunnel: int, session: int) -> None:
+        '''Apply limits from a RATE frame and echo the ones in force'''
+        if tunnel != self.KEEP:
+            self.bucket = self._bucket(tunnel)
+        state = self.channels.get(chan)
+        if session != self.KEEP:
+            if state:
+                state["bucket"] = self._bucket(session)
+            elif not chan:
+                # Channel 0 sets the default, for open channels too
+                self.session_rate = session
+                for other in self.channels.values():
+                    other["bucket"] = self._bucket(session)
+        # Throttled channels are checked against the new limits at once
+        for other in self.throttled:
+            self.throttled[other] = 0
+        rate = state["bucket"]["rate"] if state else self.session_rate
+        self._send_all(self.RATE, chan, self.RATE_BODY.pack(int(self.bucket["rate"]), int(rate)))
+
+    def _tick(self) -> float:
+        '''Ping the client and write a stats record every stats_interval seconds'''
+        if not self.stats_interval:
+            return None
+        now = time.monotonic()
+        if now >= self.next_tick:
+            if self.pings:
+                self._send_all(self.PING, 0, self.STAMP.pack(now))
+            if self.stats:
+                self._record(self._snapshot("stats"))
+            self.busy = 0
+            self.busy_since = now
+            self.next_tick = now + self.stats_interval
+        return max(self.next_tick - now, 0)
+
+    def _ended(self, chan: int, state: dict) -> None:
+        '''Fold a finished channel into the totals and record it'''
+        self.totals["sessions"] += 1
+        if state["error"]:
+            self.totals["failed"] += 1
+        self.totals["bytes_up"] += state["bytes_up"]
+        self.totals["bytes_down"] += state["bytes_down"]
+        if self.stats:
+            record = self._summary(chan, state, time.monotonic())
+            record.update(time=round(time.time(), 3), event="session", error=state["error"])
+            self._record(record)
+
+    def _summary(self, chan: int, state: dict, now: float) -> dict:
+        '''Return the counters of one channel'''
+        return {
+            "id": chan,
+            "target": state["target"],
+            "duration_s": round(now - state["start"], 3),
+            "connect_ms": state["connect_ms"],
+            "ttfb_ms": state["ttfb_ms"],
+            "bytes_up": state["bytes_up"],
+            "bytes_down": state["bytes_down"],
+            "bulk": self._bulk(state)
+        }
+
+    def _snapshot(self, event: str) -> dict:
+        '''Return proxy-wide counters, with open channels for a dump'''
+        now = time.monotonic()
+        record = {
+            "time": round(time.time(), 3),
+            "event": event,
+            "role": "proxy",
+            "pid": os.getpid(),
+            "uptime_s": round(now - self.started, 3),
+            "connected": bool(self.client_sock),
+            "links": len(self.links),
+            "active": len(self.channels),
+            "dialing": len(self.dials),
+            "pooled": len(self.pool),
+            "throttled": len(self.throttled),
+            "rate": self.bucket["rate"] / 1024, # KiB/s
+            "session_rate": self.session_rate / 1024,
+            "rtt_ms": self.rtt,
+            "rtt_min_ms": self.rtt_min,
+            # Share of time spent relaying, near 1 means the proxy is saturated
+            "busy": round(self.busy / max(now - self.busy_since, 0.001), 3)
+        }
+        record.update(self.totals)
+        record.update(self.tunnel)
+        for state in self.channels.values():
+            record["bytes_up"] += state["bytes_up"]
+            record["bytes_down"] += state["bytes_down"]
+        if event == "dump":
+            record["open"] = [self._summary(c, s, now) for c, s in self.channels.items()]
+        return record
+
+    def _record(self, record: dict) -> None:
+        '''Append a JSON line to the stats file'''
+        try:
+            with open(self.stats, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except:
+            pass
+
+    def _dump(self, signum: int, frame) -> None:
+        '''Write every counter on SIGUSR1, to stdout without a stats file'''
+        record = self._snapshot("dump")
+        if self.stats:
+            self._record(record)
+            return
+        try:
+            print(json.dumps(record), flush=True)
+        except:
+            pass
+
+    def _deflate(self, state: dict, data: memoryview) -> tuple:
+        '''Return the command and payload for data, compressed if it pays off'''
+        self.zraw += len(data)
+        if not self.zpeer or len(data) < self.ZMIN or state["zskip"]:
+            if state["zskip"]:
+                state["zskip"] -= 1
+            self.zwire += len(data)
+            return self.DATA, data
+        packed = zlib.compress(data, 1)
+        if len(packed) > len(data) * 0.9:
+            # Not worth it, send the next frames raw and back off further
+            state["zskip"] = state["zmiss"]
+            state["zmiss"] = min(state["zmiss"] * 2, 256)
+            self.zwire += len(data)
+            return self.DATA, data
+        state["zmiss"] = 8
+        self.zwire += len(packed)
+        return self.DATA | self.COMPRESSED, packed
+
+    def _inflate(self, data: memoryview) -> bytes:
+        '''Decompress a payload, None if it is corrupt or too large'''
+        try:
+            z = zlib.decompressobj()
+            out = z.decompress(data, self.max_frame)
+            if z.unconsumed_tail or not z.eof:
+                return None
+            return out
+        except:
+            return None
+
+    def _report(self) -> None:
+        '''Print how much compression saved on data sent'''
+        if self.verbose and self.compress and self.zraw:
+            ratio = self.zraw / max(self.zwire, 1)
+            print(f"Compressed {self.zraw} data bytes to {self.zwire} ({ratio:.2f}x)")
+
+    def _send_all(self, cmd: int, chan: int, data: bytes) -> None:
+        '''Send a frame to the client, queueing whatever does not fit'''
+        if not self.client_sock:
+            return
+        self.last_tx = time.monotonic()
+        self.tunnel["frames_out"] += 1
+        if self.striped:
+            header = self.SEQ_HEADER.pack(self.tx_seq, cmd, chan, len(data))
+            self.tx_seq = (self.tx_seq + 1) & 0xffffffff
+            link = self._pick()
+        else:
+            header = self.HEADER.pack(cmd, chan, len(data))
+            link = self.order[0]
+        self.tunnel["bytes_out"] += len(header) + len(data)
+        outq = link["outq"]
+        if outq:
+            # Older frames are still waiting, keep the order
+            outq.append(header)
+            if data:
+                outq.append(bytes(data))
+        else:
             try:
-                chunk = sock.recv(n - dlen)
-                if (not chunk) and (dlen == 0): # no data
-                    break
-                data += chunk
-                dlen += chunk.length
+                if self.sendmsg:
+                    sent = link["sock"].sendmsg([header, data])
+                else:
+                    sent = link["sock"].send(header + data)
+            except BlockingIOError:
+                sent = 0
             except:
+                self._lost()
+                return
+            if sent < len(header):
+                outq.append(header[sent:])
+                if data:
+                    outq.append(bytes(data))
+            elif sent < len(header) + len(data):
+                outq.append(bytes(data[sent - len(header):]))
+            self.backlog -= sent
+        self.backlog += len(header) + len(data)
+        if outq:
+            if self.backlog > self.BULK_WATER and not self.yielding:
+                self._yield(True)
+            if self.backlog > self.HIGH_WATER and not self.choked:
+                self._choke(True)
+            self._arm(link)
+
+    def _pick(self) -> dict:
+        '''Return the link for the next frame, preferring one with nothing queued'''
+        n = len(self.order)
+        for i in range(n):
+            link = self.order[(self.next_link + i) % n]
+            if not link["outq"]:
+                self.next_link = (self.next_link + i + 1) % n
+                return link
+        return min(self.order, key=lambda l: len(l["outq"]))
+
+    def _flush(self, sock: socket.socket, queue: collections.deque) -> int:
+        '''Write queued buffers with one gathered send per call, return bytes written'''
+        total = 0
+        while queue:
+            try:
+                if self.sendmsg:
+                    batch = [queue[i] for i in range(min(len(queue), 64))]
+                    sent = sock.sendmsg(batch)
+                else:
+                    batch = [queue[0]]
+                    sent = sock.send(queue[0])
+            except BlockingIOError:
+                break
+            total += sent
+            full = sent == sum(len(b) for b in batch)
+            while sent:
+                first = queue[0]
+                if sent >= len(first):
+                    sent -= len(first)
+                    queue.popleft()
+                else:
+                    queue[0] = memoryview(first)[sent:]
+                    sent = 0
+            if not full:
+                # Socket buffer is full, wait for writability
                 break
-        return data
+        return total
 
     def _close(self, sock: socket.socket) -> None:
         '''Close socket'''
@@ -125,14 +1005,119 @@ class ReverseProxy:
             pass
 
     def _connect(self, host: str, port: int) -> socket.socket:
-        '''Connect to a remote port'''
+        '''Connect to the client, trying each of its addresses in turn'''
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((host, port))
-            s.setblocking(0)
-            return s
+            return socket.create_connection((host, port), self.connect_timeout)
         except:
             return None
 
-revprx = ReverseProxy("{{CHOST}}", {{CPORT}}, "{{RHOST}}", {{RPORT}})
+    def _resolve(self, host: str, port: int) -> list:
+        '''Return (family, address) pairs for a host, cached for DNS_TTL seconds'''
+        now = time.monotonic()
+        cached = self.dns.get((host, port))
+        if cached and cached[0] > now:
+            return cached[1]
+        try:
+            infos = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except:
+            return []
+        if not infos:
+            return []
+        # Alternate families, starting with the one the resolver prefers
+        first = [(i[0], i[4]) for i in infos if i[0] == infos[0][0]]
+        other = [(i[0], i[4]) for i in infos if i[0] != infos[0][0]]
+        addrs = []
+        for n in range(max(len(first), len(other))):
+            addrs += first[n:n + 1] + other[n:n + 1]
+        if len(self.dns) >= 1024:
+            self.dns = {k: v for k, v in self.dns.items() if v[0] > now}
+        self.dns[(host, port)] = (now + self.DNS_TTL, addrs)
+        return addrs
+
+    def _dial(self, host: str, port: int, done) -> dict:
+        '''Race connections to a host, done(dial, sock) gets the winner or None'''
+        dial = {
+            "addrs": list(self._resolve(host, port)), # addresses not tried yet
+            "socks": [], # attempts still connecting
+            "next": 0, # time to start racing the next address
+            "deadline": time.monotonic() + self.connect_timeout,
+            "done": done
+        }
+        self._attempt(dial)
+        if not dial["socks"]:
+            return None
+        self.dials.append(dial)
+        return dial
+
+    def _attempt(self, dial: dict) -> None:
+        '''Start a non-blocking connection to the next address of a dial'''
+        while dial["addrs"]:
+            family, addr = dial["addrs"].pop(0)
+            s = None
+            try:
+                s = socket.socket(family, socket.SOCK_STREAM)
+                s.setblocking(0)
+                err = s.connect_ex(addr)
+                if err and err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    raise ConnectionError
+            except:
+                if s:
+                    s.close()
+                continue
+            dial["socks"].append(s)
+            dial["next"] = time.monotonic() + self.CONNECT_DELAY
+            self.dialing[s] = dial
+            self.sel.register(s, selectors.EVENT_WRITE, self._dialed)
+            return
+
+    def _dialed(self, sock: socket.socket, mask: int) -> None:
+        '''Finish a dial with the first attempt that connects'''
+        dial = self.dialing.pop(sock, None)
+        if not dial:
+            return
+        self.sel.unregister(sock)
+        dial["socks"].remove(sock)
+        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            # Refused or unreachable, race the next address at once
+            sock.close()
+            self._attempt(dial)
+            if not dial["socks"]:
+                self._finish(dial, None)
+            return
+        self._finish(dial, sock)
+
+    def _race(self) -> float:
+        '''Start due attempts and fail dials past their deadline, return the select timeout'''
+        if not self.dials:
+            return None
+        now = time.monotonic()
+        for dial in list(self.dials):
+            if dial not in self.dials:
+                continue
+            if now >= dial["deadline"]:
+                self._finish(dial, None)
+            elif dial["addrs"] and now >= dial["next"]:
+                self._attempt(dial)
+        wake = [d["deadline"] for d in self.dials]
+        wake += [d["next"] for d in self.dials if d["addrs"]]
+        if not wake:
+            return None
+        return max(min(wake) - time.monotonic(), 0)
+
+    def _finish(self, dial: dict, sock: socket.socket) -> None:
+        '''Close the losing attempts of a dial and report its result'''
+        self._cancel(dial)
+        dial["done"](dial, sock)
+
+    def _cancel(self, dial: dict) -> None:
+        '''Close every attempt of a dial and forget it'''
+        for s in dial["socks"]:
+            self.dialing.pop(s, None)
+            self.sel.unregister(s)
+            s.close()
+        dial["socks"] = []
+        if dial in self.dials:
+            self.dials.remove(dial)
+
+revprx = ReverseProxy("{{CHOST}}", {{CPORT}}, "{{RHOST}}", {{RPORT}}, pool_size={{POOL_SIZE}}, pool_idle={{POOL_IDLE}}, compress={{COMPRESS}}, forwards={{FORWARDS}}, streams={{STREAMS}}, heartbeat={{HEARTBEAT}}, reconnect={{RECONNECT}}, connect_timeout={{CONNECT_TIMEOUT}}, stats={{STATS}}, stats_interval={{STATS_INTERVAL}}, rate={{RATE}}, session_rate={{SESSION_RATE}})
 revprx.start()
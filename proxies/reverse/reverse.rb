@@ -4,42 +4,81 @@ require 'socket'
 
 class ReverseProxy
 
-  def initialize(chost, cport, rhost, rport, verbose=true)
+  def initialize(chost, cport, rhost, rport, verbose=true, max_frame=262144, min_read=4096)
     # Initialize TCP proxy
     @chost = chost
     @cport = cport
     @rhost = rhost
     @rport = rport
-    @data_size = 4096
+    @max_frame = max_frame # Largest frame we accept
+    @data_size = [max_frame, 65536].min # Largest frame we send
+    @min_read = min_read # Server read sizes adapt between this and data_size
     @verbose = verbose
+    @client_sock = nil
+    @rbuf = "".b # Tunnel bytes not parsed yet
+    @out = "".b # Frames waiting for the client
+    @channels = {} # channel id -> channel state
+    @socks = {} # server socket -> channel id
   end
 
   def start
     # Start proxy
-    client_sock = _connect(@chost, @cport)
-    if client_sock
+    @client_sock = _connect(@chost, @cport)
+    if @client_sock
       if @verbose
         puts "Proxy connected to client."
       end
-      while true
+      # Frames are written whole, so do not wait to coalesce them
+      @client_sock.setsockopt(Socket::IPPROTO_TCP, Socket::TCP_NODELAY, 1)
+      # Announce a multiplexing proxy and the largest frame we accept
+      _send_all(4, 0, [1, @max_frame].pack("CI>"))
+      while @client_sock
         begin
-          header = _recv_all(client_sock, 5)
-          if !(header.nil? || header.empty?)
-            cmd, data_len = header.unpack("CI>")
-            # connect to remote host
-            if cmd == 1
-              server_sock = _connect(@rhost, @rport)
-              if @verbose
-                puts "Proxy connected to remote host."
+          readers = []
+          writers = []
+          blocked = false
+          @channels.each_value do |st|
+            blocked = true if !st[:pend].empty?
+            if !st[:connected] || !st[:pend].empty?
+              writers << st[:sock]
+            end
+            # Stop reading servers while the client is behind
+            if st[:connected] && !st[:eof_out] && !st[:closing] && @out.empty?
+              readers << st[:sock]
+            end
+          end
+          # Stop reading the tunnel while a server is behind
+          readers << @client_sock if !blocked
+          writers << @client_sock if !@out.empty?
+          # Block until a socket is ready, no polling while idle
+          readable, writable = IO.select(readers, writers)
+          writable.each do |sock|
+            if sock == @client_sock
+              _flush_client
+              next
+            end
+            chan = @socks[sock]
+            next if chan.nil?
+            if !@channels[chan][:connected]
+              if sock.getsockopt(Socket::SOL_SOCKET, Socket::SO_ERROR).int != 0
+                _fail(chan)
+                next
               end
-              _switch(client_sock, server_sock)
-              _close(server_sock)
+              @channels[chan][:connected] = true
+              sock.setsockopt(Socket::IPPROTO_TCP, Socket::TCP_NODELAY, 1)
               if @verbose
-                puts "Proxy disconnected from remote host."
+                puts "Proxy connected to remote host."
               end
             end
-          else
-            sleep 0.005
+            _service(chan)
+          end
+          readable.each do |sock|
+            break if !@client_sock
+            if sock == @client_sock
+              _tunnel
+            elsif @socks.key?(sock)
+              _relay(@socks[sock])
+            end
           end
         rescue Interrupt
           break
@@ -48,107 +87,171 @@ class ReverseProxy
           break
         end
       end
+      @channels.keys.each do |chan|
+        _drop(chan)
+      end
+      _close(@client_sock) if @client_sock
     end
   end
 
-  def _switch(client_sock, server_sock)
-    server_closed = false
-    if client_sock && server_sock
-      client_read = true
-      while true
-        # Recv from client
-        if client_read
-          begin
-            header = _recv_all(client_sock, 5)
-            if !(header.nil? || header.empty?)
-              cmd, data_len = header.unpack("CI>")
-              if cmd == 0
-                data = _recv_all(client_sock, data_len)
-                if !server_closed
-                  _sendall(server_sock, data)
-                else
-                  client_read = false
-                  sleep 0.005
-                end
-              elsif cmd == 2
-                break
-              end
-            else
-              client_read = false
-              sleep 0.005
-            end
-          rescue IO::WaitReadable
-            client_read = false
-            sleep 0.005
-          rescue
-            break
-          end
-        end
-        # Recv from server
-        if !client_read
-          begin
-            data = server_sock.recv_nonblock(@data_size)
-            if !(data.nil? || data.empty?)
-              _send_all(client_sock, 0, data)              
-            else
-              if server_closed
-                _send_all(client_sock, 2, "")
-                break
-              end
-              server_closed = true
-              client_read = true
-              sleep 0.005
-            end
-          rescue IO::WaitReadable
-            client_read = true
-            sleep 0.005
-          rescue
-            _send_all(client_sock, 2, "")
-            break
-          end
-        end
+  def _tunnel
+    # Read frames from the client
+    begin
+      chunk = @client_sock.read_nonblock(@max_frame, exception: false)
+    rescue
+      chunk = nil
+    end
+    return if chunk == :wait_readable
+    if chunk.nil?
+      # Client is gone, stop the proxy
+      _close(@client_sock)
+      @client_sock = nil
+      return
+    end
+    @rbuf << chunk
+    pos = 0
+    total = @rbuf.bytesize
+    while total - pos >= 9
+      cmd, chan, data_len = @rbuf.byteslice(pos, 9).unpack("CI>I>")
+      break if pos + 9 + data_len > total
+      data = @rbuf.byteslice(pos + 9, data_len)
+      pos += 9 + data_len
+      _handle(cmd, chan, data)
+    end
+    # Keep the partial frame for the next read
+    @rbuf = @rbuf.byteslice(pos..-1)
+  end
+
+  def _handle(cmd, chan, data)
+    # Apply a frame from the client to its channel
+    if cmd == 4 # hello
+      if data.bytesize >= 5
+        _flags, frame = data.unpack("CI>")
+        @data_size = [@max_frame, frame].min
+      end
+      return
+    end
+    if cmd == 1 # connect to remote host
+      server_sock = _connect(@rhost, @rport, false)
+      if !server_sock
+        _send_all(2, chan, "")
+        return
       end
+      @channels[chan] = {
+        sock: server_sock,
+        pend: "".b, # data waiting for the server
+        connected: false,
+        eof_in: false, # client sent EOF
+        eof_out: false, # server sent EOF
+        shut: false, # EOF forwarded to the server
+        closing: false,
+        rsize: 16384
+      }
+      @socks[server_sock] = chan
+      return
     end
+    st = @channels[chan]
+    if st.nil?
+      # Frame for a channel that is already gone
+      return
+    end
+    if cmd == 0 # data
+      st[:pend] << data
+    elsif cmd == 3 # client is done sending
+      st[:eof_in] = true
+    elsif cmd == 2 # close socket
+      st[:closing] = true
+    end
+    _service(chan)
   end
 
-  def _send_all(sock, cmd, data)
-    # Send data or a command
+  def _relay(chan)
+    # Read from a server and forward it to the client
+    st = @channels[chan]
     begin
-      data_len = data.length
-      header = [cmd, data_len].pack("CI>")
-      msg = header + data
-      _sendall(sock, msg)
+      data = st[:sock].read_nonblock(st[:rsize], exception: false)
     rescue
-      nil
+      _fail(chan)
+      return
     end
-  end
-
-  def _sendall(sock, data)
-    # Block until all bytes are sent
-    bytes_sent = 0
-    while bytes_sent < data.length
-      sent_count = sock.write(data.byteslice(bytes_sent..-1))
-      bytes_sent += sent_count
+    return if data == :wait_readable
+    if data.nil?
+      st[:eof_out] = true
+      _send_all(3, chan, "")
+      _service(chan)
+      return
+    end
+    # Grow reads while they fill the buffer, shrink them for small messages
+    if data.bytesize == st[:rsize] && st[:rsize] < @data_size
+      st[:rsize] *= 2
+    elsif data.bytesize < st[:rsize] / 4 && st[:rsize] > @min_read
+      st[:rsize] /= 2
     end
+    st[:rsize] = [st[:rsize], @data_size].min
+    _send_all(0, chan, data)
   end
 
-  def _recv_all(sock, n)
-    # TCP recv n bytes
-    data = ""
-    dlen = 0
-    while dlen < n
+  def _service(chan)
+    # Flush a channel, forward EOFs and drop it when both sides are done
+    st = @channels[chan]
+    if st[:connected] && !st[:pend].empty?
       begin
-        chunk = sock.recv_nonblock(n - dlen)
-        if (chunk.nil? || chunk.empty?) && dlen == 0
-          break
-        end
-        data += chunk
-        dlen += chunk.length
+        sent = st[:sock].write_nonblock(st[:pend], exception: false)
       rescue
-        break
+        _fail(chan)
+        return
+      end
+      if sent != :wait_writable
+        st[:pend] = st[:pend].byteslice(sent..-1)
       end
     end
-    return data
+    if st[:connected] && st[:pend].empty? && st[:eof_in] && !st[:shut]
+      st[:shut] = true
+      begin
+        st[:sock].shutdown(Socket::SHUT_WR)
+      rescue
+        nil
+      end
+    end
+    if st[:pend].empty? && (st[:closing] || (st[:eof_in] && st[:eof_out]))
+      _drop(chan)
+    end
+  end
+
+  def _fail(chan)
+    # Close a broken server socket and tell the client
+    _send_all(2, chan, "")
+    _drop(chan)
+  end
+
+  def _drop(chan)
+    # Close a channel's server socket and forget the channel
+    st = @channels.delete(chan)
+    @socks.delete(st[:sock])
+    _close(st[:sock])
+    if @verbose
+      puts "Proxy disconnected from remote host."
+    end
+  end
+
+  def _send_all(cmd, chan, data)
+    # Queue a frame for the client and write as much as it takes
+    return if !@client_sock
+    @out << [cmd, chan, data.bytesize].pack("CI>I>") << data
+    _flush_client
+  end
+
+  def _flush_client
+    # Write queued frames to the client
+    begin
+      sent = @client_sock.write_nonblock(@out, exception: false)
+    rescue
+      _close(@client_sock)
+      @client_sock = nil
+      return
+    end
+    return if sent == :wait_writable
+    @out = @out.byteslice(sent..-1)
   end
 
   def _close(sock)
@@ -160,12 +263,16 @@ class ReverseProxy
     end
   end
 
-  def _connect(host, port)
+  def _connect(host, port, blocking=true)
     # Connect to a remote port
     begin
       s = Socket.new(Socket::AF_INET, Socket::SOCK_STREAM, 0)
       addr = Socket.pack_sockaddr_in(port, host)
-      s.connect(addr)
+      if blocking
+        s.connect(addr)
+      else
+        s.connect_nonblock(addr, exception: false)
+      end
       return s
     rescue
       return nil
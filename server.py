@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+
+import time
+import gzip
+import asyncio
+
+class StagingServer:
+
+    def __init__(self, host: str, port: int, files: dict, mode: str="http", verbose: bool=True, timeout: float=30) -> None:
+        '''Initialize payload staging server'''
+        self.host = host
+        self.port = port
+        self.mode = mode # http, or tcp to send the payload on connect
+        self.verbose = verbose
+        self.timeout = timeout # Seconds a client has to send its request
+        self.files = {} # URI path -> (raw bytes, gzip bytes)
+        for uri, content in files.items():
+            self.add(uri, content)
+
+    def add(self, uri: str, content: str) -> None:
+        '''Cache a payload, compressed once for every fetch'''
+        raw = content.encode("utf-8")
+        self.files["/" + uri.lstrip("/")] = (raw, gzip.compress(raw, 9))
+
+    def start(self) -> None:
+        '''Start server'''
+        try:
+            asyncio.run(self._serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def _serve(self) -> None:
+        '''Accept stager connections until interrupted'''
+        handler = self._http if self.mode == "http" else self._tcp
+        server = await asyncio.start_server(
+            handler,
+            self.host,
+            self.port,
+            reuse_address=True,
+            backlog=1024
+        )
+        if self.verbose:
+            print(f"Serving {self.mode} stagers on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def _http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Answer one HTTP request'''
+        start = time.perf_counter()
+        method, path, status, sent, encoding = "-", "-", 400, 0, "identity"
+        try:
+            request = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"),
+                self.timeout
+            )
+            lines = request.decode("latin-1").split("\r\n")
+            method, path = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            payload = self.files.get(path.split("?")[0])
+            if method not in ("GET", "HEAD"):
+                status, body = 405, b"Method Not Allowed\n"
+            elif not payload:
+                status, body = 404, b"Not Found\n"
+            else:
+                status, body = 200, payload[0]
+                if self._accepts_gzip(headers.get("accept-encoding", "")):
+                    encoding, body = "gzip", payload[1]
+            reason = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}
+            response = [
+                f"HTTP/1.1 {status} {reason[status]}",
+                "Content-Type: text/plain",
+                f"Content-Length: {len(body)}",
+                "Vary: Accept-Encoding",
+                "Connection: close"
+            ]
+            if encoding == "gzip":
+                response.append("Content-Encoding: gzip")
+            writer.write(("\r\n".join(response) + "\r\n\r\n").encode("latin-1"))
+            if method != "HEAD":
+                writer.write(body)
+                sent = len(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+        self._log(writer, f"{method} {path} {status}", sent, encoding, start)
+
+    async def _tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''Send the payload to a TCP stager'''
+        start = time.perf_counter()
+        sent = 0
+        try:
+            raw = next(iter(self.files.values()))[0]
+            writer.write(raw)
+            await writer.drain()
+            sent = len(raw)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+        self._log(writer, "TCP", sent, "identity", start)
+
+    def _accepts_gzip(self, accept: str) -> bool:
+        '''Check an Accept-Encoding header for gzip'''
+        for item in accept.split(","):
+            parts = item.strip().split(";")
+            if parts[0].strip().lower() not in ("gzip", "*"):
+                continue
+            q = 1.0
+            for param in parts[1:]:
+                name, _, value = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0
+            return q > 0
+        return False
+
+    def _log(self, writer: asyncio.StreamWriter, request: str, sent: int, encoding: str, start: float) -> None:
+        '''Print one fetch with its timing'''
+        if self.verbose:
+            peer = writer.get_extra_info("peername") or ("-", 0)
+            ms = (time.perf_counter() - start) * 1000
+            print(f"{peer[0]}:{peer[1]} {request} {sent} bytes {encoding} {ms:.1f} ms")
